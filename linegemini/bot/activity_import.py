@@ -0,0 +1,229 @@
+import csv
+import json
+import os
+import re
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import signals
+from .models import Activity
+
+# 大量匯入參數 (可用環境變數調整)
+IMPORT_BATCH_SIZE = int(os.getenv("ACTIVITY_IMPORT_BATCH_SIZE", "1000"))  # 每個交易處理的列數
+IMPORT_READ_SIZE = 64 * 1024  # JSON 每次讀取的字元數
+IMPORT_MAX_ITEM_CHARS = 1024 * 1024  # 單筆 JSON 資料的上限 (避免格式錯誤時把整個檔案讀進記憶體)
+IMPORT_MAX_ERRORS = 20  # 最多回報幾筆錯誤的內容 (其餘只計數)
+
+FORMATS = ("csv", "json", "jsonl")
+# 匯入時會比對與寫入的欄位 (external_id 是比對用的鍵)
+FIELDS = ("name", "end_date", "location", "description", "image_url", "activity_link")
+REQUIRED = ("name", "end_date", "location")
+
+_SKIP = re.compile(r"[\s,]*")
+_validate_url = URLValidator()
+
+
+class RowError(ValueError):
+    """
+    無法匯入的資料列 (缺欄位、日期或網址格式錯誤)
+    """
+
+
+def detect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    if ext == "ndjson":
+        return "jsonl"
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown file type {path!r} (use --format {'/'.join(FORMATS)})")
+    return ext
+
+
+def read_rows(f, fmt: str):
+    """
+    逐筆讀出 (列號, dict)：CSV 的列號是檔案行號，JSON 是第幾筆資料；整個檔案不會一次讀進記憶體
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "jsonl":
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield number, _loads(line)
+    elif fmt == "json":
+        yield from _json_array(f)
+    else:
+        raise ValueError(f"Unknown format {fmt!r}")
+
+
+def _loads(text: str):
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        # 單行格式錯誤只算這一筆失敗
+        return RowError(f"invalid JSON: {e}")
+
+
+def _json_array(f, read_size: int = IMPORT_READ_SIZE):
+    """
+    逐筆解析最外層是陣列的 JSON ([{...}, {...}])，記憶體裡只保留目前這一段
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(read_size)
+    pos = re.compile(r"\s*").match(buf).end()
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("JSON input must be an array of objects")
+    pos += 1
+    number = 0
+    while True:
+        pos = _SKIP.match(buf, pos).end()
+        if buf.startswith("]", pos):
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            # 這一筆還沒讀完：補讀下一段再試
+            chunk = f.read(read_size)
+            if not chunk or len(buf) - pos > IMPORT_MAX_ITEM_CHARS:
+                raise ValueError(f"invalid JSON after item {number}: {e}") from e
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        number += 1
+        yield number, item
+        pos = end
+
+
+def clean(row, key: str = "external_id") -> dict:
+    """
+    驗證並轉換一筆資料，回傳 Activity 的欄位值 (含 external_id)
+    """
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError("row is not an object")
+
+    def text(name):
+        value = row.get(name)
+        return "" if value is None else str(value).strip()
+
+    values = {"external_id": text(key)}
+    if not values["external_id"]:
+        raise RowError(f"missing {key}")
+    for name in FIELDS:
+        values[name] = text(name)
+    for name in REQUIRED:
+        if not values[name]:
+            raise RowError(f"missing {name}")
+    for name in ("external_id", "name", "location"):
+        max_length = Activity._meta.get_field(name).max_length
+        if len(values[name]) > max_length:
+            raise RowError(f"{name} is longer than {max_length} characters")
+
+    end_date = values["end_date"].replace("/", "-")
+    parsed = parse_date(end_date) if len(end_date) <= 10 else None
+    if parsed is None:
+        moment = parse_datetime(end_date)
+        parsed = moment.date() if moment else None
+    if parsed is None:
+        raise RowError(f"invalid end_date {values['end_date']!r}")
+    values["end_date"] = parsed
+
+    if values["image_url"]:
+        try:
+            _validate_url(values["image_url"])
+        except ValidationError:
+            raise RowError(f"invalid image_url {values['image_url']!r}") from None
+    # 選填欄位空白時存成 NULL (與後台留空相同)
+    values["image_url"] = values["image_url"] or None
+    values["activity_link"] = values["activity_link"] or None
+    return values
+
+
+def _apply(rows: dict, dry_run: bool) -> tuple:
+    """
+    以 external_id 比對一批資料：新的 bulk_create，有變動的 bulk_update，一批一個交易。回傳 (新增, 更新, 未變)
+    """
+    with transaction.atomic():
+        existing = Activity.objects.in_bulk(list(rows), field_name="external_id")
+        created, changed = [], []
+        for external_id, values in rows.items():
+            activity = existing.get(external_id)
+            if activity is None:
+                created.append(Activity(**values))
+            elif any(getattr(activity, name) != values[name] for name in FIELDS):
+                for name in FIELDS:
+                    setattr(activity, name, values[name])
+                changed.append(activity)
+
+        if not dry_run:
+            if created:
+                Activity.objects.bulk_create(created)
+            if changed:
+                # bulk_update 不會套用 auto_now，要自己更新 (Flex 卡片快取以 updated_at 判斷是否重建)
+                now = timezone.now()
+                for activity in changed:
+                    activity.updated_at = now
+                Activity.objects.bulk_update(changed, FIELDS + ("updated_at",))
+    return len(created), len(changed), len(rows) - len(created) - len(changed)
+
+
+def import_rows(rows, key: str = "external_id", batch_size: int = IMPORT_BATCH_SIZE,
+                dry_run: bool = False, progress=None) -> dict:
+    """
+    匯入 (列號, dict) 的 iterable (可以很大，每次只處理一批)：依 external_id 新增或更新活動，
+    錯誤的資料列略過並記錄。bulk_create / bulk_update 不會觸發 signal，
+    結束時 (包含中途出錯) 才統一清一次快取與活動索引 (signals.activities_changed)
+    """
+    summary = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "failed": 0, "batches": 0, "errors": []}
+    started = time.monotonic()
+    rows = iter(rows)
+    try:
+        while True:
+            chunk = list(islice(rows, max(1, batch_size)))
+            if not chunk:
+                break
+            batch = {}
+            for number, row in chunk:
+                try:
+                    values = clean(row, key)
+                except RowError as e:
+                    summary["failed"] += 1
+                    if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+                        summary["errors"].append((number, str(e)))
+                    continue
+                # 同一批裡重複的 external_id 以後面的為準
+                batch[values["external_id"]] = values
+            summary["rows"] += len(chunk)
+
+            if batch:
+                created, updated, unchanged = _apply(batch, dry_run)
+                summary["created"] += created
+                summary["updated"] += updated
+                summary["unchanged"] += unchanged
+            summary["batches"] += 1
+            _timing(summary, started)
+            if progress:
+                progress(summary)
+    finally:
+        # 讀檔到一半出錯時，前面已 commit 的批次也要清快取，不能讓各 worker 繼續用舊資料
+        if not dry_run and (summary["created"] or summary["updated"]):
+            transaction.on_commit(signals.activities_changed)
+
+    _timing(summary, started)
+    return summary
+
+
+def _timing(summary: dict, started: float):
+    summary["seconds"] = time.monotonic() - started
+    summary["per_second"] = summary["rows"] / summary["seconds"] if summary["seconds"] else 0.0
+
+
+def import_file(path: str, fmt: str = None, **options) -> dict:
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        return import_rows(read_rows(f, fmt or detect_format(path)), **options)
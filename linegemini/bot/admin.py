@@ -1,7 +1,38 @@
 from django.contrib import admin
-from .models import Activity
+from .models import Activity, Campaign, CircuitBreaker, Conversation, Counter, Job, StoredImage
 
 @admin.register(Activity)
 class ActivityAdmin(admin.ModelAdmin):
     list_display = ('name', 'end_date', 'location', 'description', 'image_url', 'activity_link')
-    search_fields = ('name', 'location')
+    search_fields = ('name', 'location', 'external_id')
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'available_at', 'updated_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('created_at', 'updated_at')
+
+@admin.register(Counter)
+class CounterAdmin(admin.ModelAdmin):
+    list_display = ('name', 'value')
+    search_fields = ('name',)
+
+@admin.register(StoredImage)
+class StoredImageAdmin(admin.ModelAdmin):
+    list_display = ('name', 'size', 'last_access')
+    search_fields = ('name',)
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('user_id', 'tokens', 'updated_at')
+    search_fields = ('user_id',)
+
+@admin.register(Campaign)
+class CampaignAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'sent_count', 'failed_count', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('sent_count', 'failed_count', 'created_at', 'started_at', 'finished_at')
+
+@admin.register(CircuitBreaker)
+class CircuitBreakerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'state', 'failures', 'opened_until', 'updated_at')
@@ -1,99 +1,337 @@
+import math
 import os
-import uuid
-import mimetypes
-from django.conf import settings
-from google import genai
-from google.genai import types
-import google.generativeai as old_genai # 保留舊的 SDK 用於文字對話
+import re
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import requests
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from . import (breaker, conversations, flex, gemini, image_cache, media_store, metrics, ratelimit, reply_cache,
+               search, snapshots, stats)
+from .gemini import GEMINI_API_KEY
 from .models import Activity
 
-# 從環境變數讀取 API Key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+def public_base_url(request) -> str:
+    """
+    由 request 取得對外的網站根網址 (例如 https://xxx.ngrok-free.app/)
+    """
+    base_url = request.build_absolute_uri("/")
+    # 強制將 http 轉為 https (針對 ngrok 環境)
+    if base_url.startswith("http://") and "ngrok" in base_url:
+        base_url = base_url.replace("http://", "https://")
+    return base_url
+
+
+def media_url(relative_path: str, request=None, base_url: str = None) -> str:
+    """
+    將 media 下的相對路徑轉成網址；背景 worker 沒有 request，改用排入佇列時記下的 base_url
+    """
+    if request:
+        base_url = public_base_url(request)
+    if base_url:
+        return base_url.rstrip("/") + "/" + relative_path
+    return f"/{relative_path}"  # Fallback
+
+
+# 生圖設定 (也是圖片快取 key 的一部分)
+IMAGE_CONFIG = {
+    "response_modalities": ["IMAGE"],
+    # "image_config": {"image_size": "1K"},
+}
+
+# 生圖的時間限制與備援 (可用環境變數調整)
+IMAGE_DEADLINE = float(os.getenv("IMAGE_DEADLINE", "90"))  # 整體最多等幾秒
+# 主模型超過這個秒數還沒完成就同時啟動備援；累積足夠樣本後改用主模型最近耗時的 p95
+IMAGE_HEDGE_DELAY = float(os.getenv("IMAGE_HEDGE_DELAY", "30"))
+IMAGE_HEDGE_MIN_SAMPLES = 20
+IMAGE_HEDGE_THREADS = int(os.getenv("IMAGE_HEDGE_THREADS", "8"))
+# 主模型連續失敗 (或逾時) 幾次後暫停使用多久 (秒)
+IMAGE_BREAKER_THRESHOLD = int(os.getenv("IMAGE_BREAKER_THRESHOLD", "3"))
+IMAGE_BREAKER_COOLDOWN = float(os.getenv("IMAGE_BREAKER_COOLDOWN", "120"))
+IMAGE_BREAKER = "image_primary"
+FALLBACK_IMAGE_URL = os.getenv("FALLBACK_IMAGE_URL", "https://image.pollinations.ai/prompt/{prompt}")
+IMAGE_PATHS = ("primary", "fallback")
+
+
+def _generate_image(prompt: str, photos: list = ()):
+    """
+    呼叫生圖模型，回傳 (圖片 bytes, mime_type)，沒有產生圖片則回傳 None。
+    photos 為 [(bytes, mime_type), ...]，會和提示詞一起送出 (照片合成)
+    """
+    from google.genai import types
+
+    # 共用的 client，不必每張圖重新建立
+    client = gemini.get_client()
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=prompt),
+                *(types.Part.from_bytes(data=data, mime_type=mime_type) for data, mime_type in photos),
+            ],
+        ),
+    ]
+
+    # 使用串流，拿到第一張圖就回傳 (通常只有一張)
+    for chunk in client.models.generate_content_stream(
+        model=gemini.IMAGE_MODEL,
+        contents=contents,
+        # 連線逾時設成整體期限，主模型卡住時執行緒也會在期限附近結束
+        config=types.GenerateContentConfig(**IMAGE_CONFIG,
+                                           http_options=types.HttpOptions(timeout=int(IMAGE_DEADLINE * 1000))),
+    ):
+        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+            continue
+
+        part = chunk.candidates[0].content.parts[0]
+
+        # 檢查是否有圖片資料
+        if part.inline_data and part.inline_data.data:
+            return part.inline_data.data, part.inline_data.mime_type
+    return None
 
-# 設定 Gemini API (舊版 SDK)
-if GEMINI_API_KEY:
-    old_genai.configure(api_key=GEMINI_API_KEY)
 
-def gen_ai_img(prompt: str, request=None) -> str:
+def _limited_generate_image(prompt: str, user_id: str = None, photos: list = ()):
+    # 真的要呼叫生圖模型時才消耗限流額度 (快取命中不算)
+    ratelimit.acquire(ratelimit.IMAGE, user_id)
+    return _generate_image(prompt, photos)
+
+
+def _fallback_image(prompt: str, timeout: float):
     """
-    使用 Gemini 3 Pro Image Preview 生成圖片，並回傳圖片網址
+    備援：從 Pollinations 下載圖片，回傳 (圖片 bytes, mime_type)
+    """
+    r = requests.get(FALLBACK_IMAGE_URL.format(prompt=urllib.parse.quote(prompt)), timeout=timeout)
+    r.raise_for_status()
+    mime_type = r.headers.get("Content-Type", "").split(";")[0].strip()
+    if not mime_type.startswith("image/"):
+        raise ValueError(f"Fallback returned {mime_type or 'no content type'}")
+    return r.content, mime_type
+
+
+def _cache_key(prompt: str) -> str:
+    return image_cache.cache_key(gemini.IMAGE_MODEL, prompt, IMAGE_CONFIG)
+
+
+def _primary_file(prompt: str, fresh: bool):
+    # 限流額度已在 _generate_file 開始計時前取得
+    if fresh or not image_cache.IMAGE_CACHE_ENABLED:
+        image = _generate_image(prompt)
+        return media_store.write(*image) if image else None
+    return image_cache.get_or_generate(_cache_key(prompt), lambda: _generate_image(prompt))
+
+
+def _fallback_file(prompt: str, timeout: float):
+    # 備援圖片不放進快取 (快取 key 是主模型的)，下次同樣的提示詞仍會先試主模型
+    return media_store.write(*_fallback_image(prompt, timeout))
+
+
+# 主模型最近成功的耗時 (秒)，用來估計 p95 作為啟動備援的時間點
+_primary_latencies = deque(maxlen=200)
+_latency_lock = threading.Lock()
+
+
+def hedge_delay() -> float:
+    """
+    主模型超過幾秒沒完成就同時啟動備援：樣本足夠時用最近耗時的 p95，否則用 IMAGE_HEDGE_DELAY
+    """
+    with _latency_lock:
+        samples = sorted(_primary_latencies)
+    if len(samples) < IMAGE_HEDGE_MIN_SAMPLES:
+        return min(IMAGE_HEDGE_DELAY, IMAGE_DEADLINE)
+    # nearest-rank：第 ceil(0.95 * n) 個樣本
+    return min(samples[math.ceil(len(samples) * 0.95) - 1], IMAGE_DEADLINE)
+
+
+def _image_pool() -> ThreadPoolExecutor:
+    return gemini.shared("image_pool", lambda: ThreadPoolExecutor(max_workers=IMAGE_HEDGE_THREADS,
+                                                                  thread_name_prefix="image-gen"))
+
+
+def _timed(path: str, fn):
+    """
+    執行一條生圖路徑並記錄耗時 (image.<path>.ms / .count / .error 計數器)
+    """
+    started = time.perf_counter()
+    try:
+        with metrics.span("image", path=path):
+            return fn()
+    except ratelimit.RateLimited:
+        raise
+    except Exception:
+        stats.incr(f"image.{path}.error")
+        raise
+    finally:
+        stats.incr(f"image.{path}.ms", int((time.perf_counter() - started) * 1000))
+        stats.incr(f"image.{path}.count")
+
+
+def _run_primary(prompt: str, fresh: bool):
+    """
+    在背景執行緒呼叫主模型，結束時 (不論是否已被備援搶先) 回報斷路器：
+    期限內產生圖片算成功，錯誤、沒有圖片或超過期限算失敗
+    """
+    started = time.monotonic()
+    try:
+        try:
+            file_name = _timed("primary", lambda: _primary_file(prompt, fresh))
+        except Exception as e:
+            print(f"Gemini Image Gen Error: {e}")
+            file_name = None
+
+        elapsed = time.monotonic() - started
+        if file_name and elapsed <= IMAGE_DEADLINE:
+            with _latency_lock:
+                _primary_latencies.append(elapsed)
+            breaker.record_success(IMAGE_BREAKER)
+        else:
+            if elapsed > IMAGE_DEADLINE:
+                stats.incr("image.primary.timeout")
+            breaker.record_failure(IMAGE_BREAKER, IMAGE_BREAKER_THRESHOLD, IMAGE_BREAKER_COOLDOWN)
+        return file_name
+    finally:
+        close_old_connections()
+
+
+def _run_fallback(prompt: str, timeout: float):
+    try:
+        return _timed("fallback", lambda: _fallback_file(prompt, timeout))
+    finally:
+        close_old_connections()
+
+
+def _generate_file(prompt: str, fresh: bool, user_id: str = None):
+    """
+    在 IMAGE_DEADLINE 內取得圖片檔名，回傳 (檔名, 路徑名稱) 或 (None, None)：
+    先呼叫主模型，超過 hedge_delay() 還沒完成 (或已失敗) 就同時啟動備援，先成功的那一個勝出；
+    斷路器開路時直接使用備援。超過生圖限流時丟出 ratelimit.RateLimited
+    """
+    pool = _image_pool()
+    if not breaker.allow(IMAGE_BREAKER, IMAGE_BREAKER_COOLDOWN):
+        stats.incr("image.breaker_skipped")
+        try:
+            return pool.submit(_run_fallback, prompt, IMAGE_DEADLINE).result(timeout=IMAGE_DEADLINE), "fallback"
+        except Exception as e:
+            print(f"Fallback image failed: {e}")
+            return None, None
+
+    # 先在這裡取得限流額度 (快取命中不算)，排隊的時間不算進備援與期限的計時，也不會被當成主模型逾時
+    if fresh or not image_cache.IMAGE_CACHE_ENABLED or not image_cache.lookup(_cache_key(prompt)):
+        ratelimit.acquire(ratelimit.IMAGE, user_id)
+    started = time.monotonic()
+    deadline = started + IMAGE_DEADLINE
+    primary = pool.submit(_run_primary, prompt, fresh)
+    hedge_at = started + hedge_delay()
+    fallback = None
+
+    while True:
+        if primary.done():
+            if primary.result():
+                return primary.result(), "primary"
+        if fallback is not None and fallback.done():
+            if fallback.exception() is None and fallback.result():
+                return fallback.result(), "fallback"
+            if primary.done():
+                return None, None
+
+        now = time.monotonic()
+        if now >= deadline:
+            return None, None
+        if fallback is None and (primary.done() or now >= hedge_at):
+            # 主模型失敗或太慢：啟動備援 (主模型若還在跑就繼續跑，兩者誰先完成用誰)
+            stats.incr("image.hedged")
+            fallback = pool.submit(_run_fallback, prompt, max(1.0, deadline - now))
+            continue
+        pending = [f for f in (primary, fallback) if f is not None and not f.done()]
+        if not pending:
+            return None, None
+        wait(pending, timeout=min(deadline, hedge_at) - now if fallback is None else deadline - now,
+             return_when=FIRST_COMPLETED)
+
+
+def gen_ai_img(prompt: str, request=None, base_url: str = None, fresh: bool = False, user_id: str = None) -> str:
+    """
+    使用 Gemini 3 Pro Image Preview 生成圖片，並回傳圖片網址。
+    相同的提示詞直接使用已生成的圖片 (同時送出的相同提示詞只會生成一次)；
+    fresh 為 True 時一律重新生成，讓使用者得到不同的變化。
+    主模型太慢時同時以 Pollinations 備援，整體最多等 IMAGE_DEADLINE 秒；主模型連續失敗時暫停使用 (斷路器)。
+    超過生圖限流時丟出 ratelimit.RateLimited (由佇列稍後重試)。
+    """
+    if not GEMINI_API_KEY:
+        return "https://via.placeholder.com/1024x1024?text=No+API+Key"
+
+    file_name, path = _generate_file(prompt, fresh, user_id)
+    if not file_name:
+        stats.incr("image.failed")
+        return "https://via.placeholder.com/1024x1024?text=Generation+Failed"
+
+    stats.incr(f"image.{path}.win")
+    # 產生 URL
+    image_url = media_url(f"media/{media_store.IMAGE_DIR}/{file_name}", request, base_url)
+    print(f"Generated Image URL: {image_url} ({path})")
+    return image_url
+
+
+# 照片合成的指示 (使用者的提示詞會接在後面)
+COMPOSITE_PROMPT = ("請把第一張照片中的人物自然地合成到第二張照片的場景裡，"
+                    "保留人物的臉部特徵與服裝，光線、色調與透視要和場景一致。")
+
+
+def gen_composite_img(prompt: str, photos: list, request=None, base_url: str = None, user_id: str = None) -> str:
+    """
+    把使用者的照片 (人像、場景，已縮小成 JPEG 的 [(bytes, mime_type), ...]) 與提示詞一起送給生圖模型合成，
+    回傳圖片網址，存檔與網址的處理與 gen_ai_img 相同。
+    每次合成的照片都不同，不使用快取；Pollinations 無法合成照片，所以沒有備援。
+    超過生圖限流時丟出 ratelimit.RateLimited (由佇列稍後重試)。
     """
     if not GEMINI_API_KEY:
         return "https://via.placeholder.com/1024x1024?text=No+API+Key"
 
+    full_prompt = f"{COMPOSITE_PROMPT}\n{prompt}" if prompt else COMPOSITE_PROMPT
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        model = "gemini-3-pro-image-preview" # 目前可用的生圖模型，或使用 gemini-3-pro-image-preview 如果您有權限
-
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=prompt),
-                ],
-            ),
-        ]
-        
-        generate_content_config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            # image_config=types.ImageConfig(image_size="1K"), # 修正參數名稱
-        )
-
-        # 確保 media 目錄存在
-        save_dir = os.path.join(settings.MEDIA_ROOT, 'generated_images')
-        os.makedirs(save_dir, exist_ok=True)
-
-        image_url = ""
-        
-        # 使用非串流方式簡化處理，或者使用串流
-        # 這裡依照您的範例使用串流
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
-                continue
-                
-            part = chunk.candidates[0].content.parts[0]
-            
-            # 檢查是否有圖片資料
-            if part.inline_data and part.inline_data.data:
-                # 生成唯一檔名
-                file_name = f"{uuid.uuid4()}"
-                mime_type = part.inline_data.mime_type
-                ext = mimetypes.guess_extension(mime_type) or ".png"
-                full_filename = f"{file_name}{ext}"
-                file_path = os.path.join(save_dir, full_filename)
-                
-                # 儲存檔案
-                with open(file_path, "wb") as f:
-                    f.write(part.inline_data.data)
-                
-                print(f"Image saved to: {file_path}")
-                
-                # 產生 URL
-                relative_path = f"media/generated_images/{full_filename}"
-                if request:
-                    image_url = request.build_absolute_uri(f"/{relative_path}")
-                    # 強制將 http 轉為 https (針對 ngrok 環境)
-                    if image_url.startswith("http://") and "ngrok" in image_url:
-                        image_url = image_url.replace("http://", "https://")
-                else:
-                    image_url = f"/{relative_path}" # Fallback
-                
-                print(f"Generated Image URL: {image_url}")
-                # 找到第一張圖就回傳 (通常只有一張)
-                return image_url
-                
+        image = _timed("composite", lambda: _limited_generate_image(full_prompt, user_id, photos))
+    except ratelimit.RateLimited:
+        raise
     except Exception as e:
-        print(f"Gemini Image Gen Error: {e}")
-        # 發生錯誤時回傳錯誤圖示或原本的 Pollinations 作為備援
-        import urllib.parse
-        encoded_prompt = urllib.parse.quote(prompt)
-        return f"https://image.pollinations.ai/prompt/{encoded_prompt}"
+        print(f"Gemini Composite Error: {e}")
+        image = None
+    if not image:
+        stats.incr("image.failed")
+        return "https://via.placeholder.com/1024x1024?text=Generation+Failed"
+
+    file_name = media_store.write(*image)
+    image_url = media_url(f"media/{media_store.IMAGE_DIR}/{file_name}", request, base_url)
+    print(f"Composite Image URL: {image_url}")
+    return image_url
 
-    return "https://via.placeholder.com/1024x1024?text=Generation+Failed"
+
+def image_monitor() -> dict:
+    """
+    監控用：斷路器狀態、目前的備援啟動時間與各路徑的平均耗時/成功次數
+    """
+    counters = stats.snapshot("image.")
+    paths = {}
+    for path in IMAGE_PATHS:
+        count = counters.get(f"image.{path}.count", 0)
+        paths[path] = {
+            "count": count,
+            "avg_ms": round(counters.get(f"image.{path}.ms", 0) / count) if count else None,
+            "errors": counters.get(f"image.{path}.error", 0),
+            "wins": counters.get(f"image.{path}.win", 0),
+        }
+    return {
+        "breaker": breaker.state(IMAGE_BREAKER),
+        "hedge_delay": hedge_delay(),
+        "deadline": IMAGE_DEADLINE,
+        "paths": paths,
+        "timeouts": counters.get("image.primary.timeout", 0),
+        "hedged": counters.get("image.hedged", 0),
+        "failed": counters.get("image.failed", 0),
+    }
 
 
 def get_activity_card(activity_name: str):
@@ -105,55 +343,20 @@ def get_activity_card(activity_name: str):
     """
     print(f"🔍 [Tool Calling] 正在查詢活動: {activity_name}")
     
-    # 從資料庫搜尋活動
-    # 使用 icontains 進行模糊搜尋
-    activity = Activity.objects.filter(name__icontains=activity_name).first()
+    # 先用記憶體中的 bigram 索引找最相近的活動 (可容忍多字、少字與繁簡差異)
+    activity = None
+    results = search.search_activities(activity_name, limit=1)
+    if results:
+        activity = Activity.objects.filter(pk=results[0][1]).first()
+    if activity is None and activity_name.strip():
+        # 索引找不到 (例如單一字無法切 bigram) 時退回資料庫模糊搜尋
+        activity = Activity.objects.filter(name__icontains=activity_name.strip()).first()
             
     if not activity:
         return "找不到相關活動資訊。"
 
-    # 回傳 LINE Flex Message 格式
-    return {
-        "type": "flex",
-        "altText": f"{activity.name} 活動資訊",
-        "contents": {
-            "type": "bubble",
-            "hero": {
-                "type": "image",
-                "url": activity.image_url if activity.image_url else "https://via.placeholder.com/1024x768",
-                "size": "full",
-                "aspectRatio": "20:13",
-                "aspectMode": "cover",
-            },
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": activity.name, "weight": "bold", "size": "xl"},
-                    {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "結束日期", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                            {"type": "text", "text": str(activity.end_date), "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
-                        ]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "地點", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                            {"type": "text", "text": activity.location, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
-                        ]}
-                    ]},
-                    {"type": "text", "text": activity.description, "wrap": True, "margin": "md", "color": "#666666"}
-                ]
-            },
-            "footer": {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "sm",
-                "contents": [
-                    {"type": "button", "style": "link", "height": "sm", "action": {"type": "uri", "label": "活動詳情", "uri": activity.activity_link if activity.activity_link else "https://line.me/"}}
-                ],
-                "flex": 0
-            }
-        }
-    }
+    # 回傳 LINE Flex Message 格式 (bubble 的 JSON 依活動快取，不必每次重建)
+    return flex.activity_card(activity)
 
 def get_recent_activities():
     """
@@ -161,61 +364,13 @@ def get_recent_activities():
     """
     print(f"🔍 [Tool Calling] 正在查詢最近活動列表")
     
-    # 從資料庫取得所有活動 (依日期排序)
-    activities = Activity.objects.all().order_by('end_date')[:5]
+    # 尚未結束的活動依結束日期排序；快照在活動異動或換日時才重新查詢
+    message = snapshots.recent_activities()
 
-    if not activities:
+    if message is None:
         return "目前沒有任何活動資訊。"
 
-    bubbles = []
-    for data in activities:
-        bubble = {
-            "type": "bubble",
-            "hero": {
-                "type": "image",
-                "url": data.image_url if data.image_url else "https://via.placeholder.com/1024x768",
-                "size": "full",
-                "aspectRatio": "20:13",
-                "aspectMode": "cover",
-            },
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": data.name, "weight": "bold", "size": "xl"},
-                    {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "結束日期", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                            {"type": "text", "text": str(data.end_date), "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
-                        ]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "地點", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                            {"type": "text", "text": data.location, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
-                        ]}
-                    ]},
-                    {"type": "text", "text": data.description, "wrap": True, "margin": "md", "color": "#666666"}
-                ]
-            },
-            "footer": {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "sm",
-                "contents": [
-                    {"type": "button", "style": "link", "height": "sm", "action": {"type": "uri", "label": "活動詳情", "uri": data.activity_link if data.activity_link else "https://line.me/"}}
-                ],
-                "flex": 0
-            }
-        }
-        bubbles.append(bubble)
-
-    return {
-        "type": "flex",
-        "altText": "最近活動列表",
-        "contents": {
-            "type": "carousel",
-            "contents": bubbles
-        }
-    }
+    return message
 
 def get_studio_introduction():
     """
@@ -271,45 +426,291 @@ def get_studio_introduction():
 
 my_tools = [get_activity_card, get_recent_activities, get_studio_introduction]
 
-def get_gemini_response(user_text: str):
+def _chat_config():
+    """
+    對話用的設定 (含工具宣告)，每個 worker 只建立一次
+    """
+    from google.genai import types
+
+    return gemini.shared("chat_config", lambda: types.GenerateContentConfig(
+        tools=[types.Tool(function_declarations=[
+            types.FunctionDeclaration.from_callable_with_api_option(callable=fn) for fn in my_tools
+        ])],
+        # 不使用自動 Function Calling，我們要自己處理回傳值
+        automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
+    ))
+
+def call_tool(name: str, args: dict):
+    """
+    執行模型要求的工具並回傳結果 (Flex Message dict 或文字)，未知的工具回傳 None
+    """
+    if name not in ('get_activity_card', 'get_recent_activities', 'get_studio_introduction'):
+        return None
+    metrics.inc(metrics.TOOL_CALLS, tool=name)
+    with metrics.span("tool", tool=name):
+        if name == 'get_activity_card':
+            return get_activity_card(args.get('activity_name', ''))
+        elif name == 'get_recent_activities':
+            return get_recent_activities()
+        return get_studio_introduction()
+
+# 本機意圖判斷 (在呼叫 Gemini 之前)，信心分數夠高就直接執行工具
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "1") == "1"
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.8"))
+INTENT_ACTIVITY_MIN_SCORE = float(os.getenv("INTENT_ACTIVITY_MIN_SCORE", "0.75"))
+INTENT_ACTIVITY_MIN_MARGIN = float(os.getenv("INTENT_ACTIVITY_MIN_MARGIN", "0.15"))
+
+# (正規化後的訊息要符合的 pattern, 工具名稱, 信心分數)
+INTENT_PATTERNS = [
+    (re.compile(r"^(請|幫我)?(介紹|說明)(一下)?(你們的?|貴)?(工作室|團隊|公司)(介紹)?$"), 'get_studio_introduction', 0.95),
+    (re.compile(r"^(關於我們|關於你們|你們是誰|你是誰|工作室介紹|工作室簡介)$"), 'get_studio_introduction', 0.95),
+    (re.compile(r"(介紹|認識|關於).{0,3}工作室"), 'get_studio_introduction', 0.85),
+    (re.compile(r"^(最近|近期|目前|現在|這個月|這陣子)?(有|還有)?(什麼|甚麼|哪些|那些)(好玩的|新的)?活動(嗎|呢|啊)?$"), 'get_recent_activities', 0.95),
+    (re.compile(r"^(最近|近期|最新|近期的|最近的)(的)?活動(列表|清單|資訊)?(呢|嗎)?$"), 'get_recent_activities', 0.9),
+    (re.compile(r"^活動(列表|清單|一覽)$"), 'get_recent_activities', 0.9),
+    (re.compile(r"(最近|近期).{0,4}(什麼|甚麼|哪些)活動"), 'get_recent_activities', 0.85),
+]
+
+
+def _match_activity_name(user_text: str):
+    """
+    以活動索引比對使用者訊息，回傳 (活動名稱, 分數)；
+    第一名與第二名差距太小 (不確定是哪個活動) 時回傳 None
+    """
+    results = search.search_activities(user_text, limit=2, min_score=0.0)
+    if not results:
+        return None
+    best_score, _, best_name = results[0]
+    runner_up = results[1][0] if len(results) > 1 else 0.0
+    if best_score - runner_up < INTENT_ACTIVITY_MIN_MARGIN:
+        return None
+    return best_name, best_score
+
+
+def route_intent(user_text: str):
+    """
+    不呼叫 Gemini 的本機意圖判斷，回傳 (工具名稱, 參數, 信心分數)；
+    沒有把握時回傳 None，交給 Gemini 處理
+    """
+    normalized = reply_cache.normalize(user_text)
+    if not normalized:
+        return None
+
+    # 訊息提到特定活動名稱時優先回傳活動卡片
+    match = _match_activity_name(user_text)
+    if match and match[1] >= INTENT_ACTIVITY_MIN_SCORE:
+        return 'get_activity_card', {'activity_name': match[0]}, match[1]
+
+    for pattern, tool_name, confidence in INTENT_PATTERNS:
+        if confidence >= INTENT_MIN_CONFIDENCE and pattern.search(normalized):
+            return tool_name, {}, confidence
+    return None
+
+BUSY_REPLY = "抱歉，我現在有點忙不過來，請稍後再試一次。"
+SLOW_DOWN_REPLY = "訊息有點太密集了，請稍等一下再傳。"
+
+
+def _rate_limited_reply(e: ratelimit.RateLimited) -> str:
+    # 使用者自己太頻繁時請他放慢；整體配額用完則是系統忙碌
+    return SLOW_DOWN_REPLY if e.scope == "user" else BUSY_REPLY
+
+
+def get_gemini_response(user_text: str, user_id: str = None, remember: bool = True):
+    """
+    將使用者的訊息傳送給 Gemini API 並取得回應 (支援 Function Calling 回傳 Flex Message)。
+    有 user_id 時會帶上該使用者先前的對話 (摘要 + 最近幾輪)，並記下這一輪；
+    remember 為 False 時由呼叫端在回覆送出後自行呼叫 remember_turn
+    """
+    conversation = conversations.load(user_id)
+    reply = _respond(user_text, conversations.history(conversation), user_id)
+    if remember and _rememberable(reply):
+        conversations.record(conversation, user_text, reply)
+    return reply
+
+
+def _rememberable(reply) -> bool:
+    # 忙碌、限流的回覆不是真正的回答，不記進對話
+    return reply not in (BUSY_REPLY, SLOW_DOWN_REPLY)
+
+
+def remember_turn(user_id: str, user_text: str, reply):
+    """
+    記下一輪對話 (LINE worker 在回覆成功送出後呼叫：回覆失敗而重試時，同一輪不會被記兩次)
+    """
+    if _rememberable(reply):
+        conversations.record_for(user_id, user_text, reply)
+
+
+def _immediate_reply(user_text: str, use_cache: bool):
     """
-    將使用者的訊息傳送給 Gemini API 並取得回應 (支援 Function Calling 回傳 Flex Message)
+    不需要呼叫 Gemini 就能回覆時回傳結果 (本機意圖判斷、設定錯誤、快取命中)，否則回傳 None
     """
+    # 明顯的工具意圖 (例如「介紹工作室」) 直接處理，省下一次 Gemini 呼叫
+    if INTENT_ROUTER_ENABLED:
+        routed = route_intent(user_text)
+        if routed:
+            tool_name, args, confidence = routed
+            print(f"🧭 [Intent Router] {tool_name} ({confidence:.2f})")
+            stats.incr(f"intent_router.{tool_name}")
+            return call_tool(tool_name, args)
+        stats.incr("intent_router.fallthrough")
+
     if not GEMINI_API_KEY:
         return "系統設定錯誤：找不到 GEMINI_API_KEY，請檢查 .env 檔案。"
 
+    # 熱門問題直接用快取的回覆 (文字或 Flex Message)
+    if use_cache:
+        return reply_cache.get(user_text)
+    return None
+
+
+def _contents(user_text: str, history: list):
+    if not history:
+        return user_text
+    from google.genai import types
+
+    return history + [types.Content(role="user", parts=[types.Part.from_text(text=user_text)])]
+
+
+def _respond(user_text: str, history: list, user_id: str = None):
+    # 有先前對話時同一句話的意思可能不同 (例如「在哪裡？」)，不使用快取
+    use_cache = not history
+    reply = _immediate_reply(user_text, use_cache)
+    if reply is not None:
+        return reply
+
+    # 超過限流時短暫排隊，排不到才回覆忙碌
     try:
-        # 初始化模型 (使用舊版 SDK)
-        model = old_genai.GenerativeModel(
-            model_name='gemini-2.5-flash', 
-            tools=my_tools
-        )
-        
-        # 啟動 Chat (不使用自動 Function Calling，我們要自己處理回傳值)
-        chat = model.start_chat(enable_automatic_function_calling=False)
-        
-        # 發送訊息
-        response = chat.send_message(user_text)
-        
-        # 檢查是否有 Function Call
-        if response.candidates and response.candidates[0].content.parts:
-            part = response.candidates[0].content.parts[0]
-            if part.function_call:
-                fc = part.function_call
-                if fc.name == 'get_activity_card':
-                    # 直接執行並回傳 Flex Message (Dict)
-                    return get_activity_card(fc.args['activity_name'])
-                elif fc.name == 'get_recent_activities':
-                    return get_recent_activities()
-                elif fc.name == 'get_studio_introduction':
-                    return get_studio_introduction()
-        
-        # 正常文字回應
-        if response and response.text:
-            return response.text
-        else:
-            return "Gemini 沒有回應任何內容。"
-            
+        ratelimit.acquire(ratelimit.CHAT, user_id)
+    except ratelimit.RateLimited as e:
+        return _rate_limited_reply(e)
+
+    try:
+        with metrics.span("gemini"):
+            response = gemini.get_client().models.generate_content(
+                model=gemini.CHAT_MODEL,
+                contents=_contents(user_text, history),
+                config=_chat_config(),
+            )
+        return _handle_response(user_text, response, use_cache)
+    except Exception as e:
+        print(f"Gemini API Error: {e}")
+        return BUSY_REPLY
+
+
+def _handle_response(user_text: str, response, use_cache: bool):
+    # 檢查是否有 Function Call，有的話直接執行並回傳 Flex Message (Dict)
+    for fc in response.function_calls or []:
+        result = call_tool(fc.name, fc.args or {})
+        if result is not None:
+            if use_cache:
+                reply_cache.set(user_text, result)
+            return result
+
+    # 正常文字回應
+    if response and response.text:
+        if use_cache:
+            reply_cache.set(user_text, response.text)
+        return response.text
+    else:
+        return "Gemini 沒有回應任何內容。"
+
+
+async def aget_gemini_response(user_text: str, user_id: str = None, remember: bool = True):
+    """
+    get_gemini_response 的 async 版本：Gemini 使用 async client (client.aio)，
+    資料庫相關的部分 (意圖判斷、工具、快取、對話記憶) 透過 sync_to_async 執行
+    """
+    conversation = await sync_to_async(conversations.load)(user_id)
+    history = conversations.history(conversation)
+    use_cache = not history
+
+    reply = await sync_to_async(_immediate_reply)(user_text, use_cache)
+    if reply is None:
+        try:
+            await ratelimit.aacquire(ratelimit.CHAT, user_id)
+        except ratelimit.RateLimited as e:
+            return _rate_limited_reply(e)
+        try:
+            with metrics.span("gemini"):
+                response = await gemini.get_client().aio.models.generate_content(
+                    model=gemini.CHAT_MODEL,
+                    contents=_contents(user_text, history),
+                    config=_chat_config(),
+                )
+            reply = await sync_to_async(_handle_response)(user_text, response, use_cache)
+        except Exception as e:
+            print(f"Gemini API Error: {e}")
+            return BUSY_REPLY
+
+    if remember:
+        await sync_to_async(conversations.record)(conversation, user_text, reply)
+    return reply
+
+
+def _reply_event(reply) -> tuple:
+    if flex.is_flex(reply):
+        return "flex", reply.to_dict() if hasattr(reply, "to_dict") else reply
+    return "text", {"text": str(reply)}
+
+
+def stream_gemini_response(user_text: str, user_id: str = None):
+    """
+    get_gemini_response 的串流版本 (LIFF 聊天用)，逐一產生 (事件名稱, 資料)：
+    - ("token", {"text": ...})：Gemini 每產生一段文字就送出
+    - ("flex", Flex Message)：觸發工具時送出整張卡片
+    - ("text", {"text": ...})：不經過 Gemini 的完整文字回覆 (快取、設定錯誤...)
+    - ("error", {"text": ...})：發生錯誤
+    工具判斷、快取與對話記憶的規則與 get_gemini_response 相同
+    """
+    conversation = conversations.load(user_id)
+    history = conversations.history(conversation)
+    use_cache = not history
+
+    reply = _immediate_reply(user_text, use_cache)
+    if reply is not None:
+        conversations.record(conversation, user_text, reply)
+        yield _reply_event(reply)
+        return
+
+    try:
+        ratelimit.acquire(ratelimit.CHAT, user_id)
+    except ratelimit.RateLimited as e:
+        yield "error", {"text": _rate_limited_reply(e)}
+        return
+
+    parts = []
+    try:
+        # 串流的總時間包含前端接收的時間，只記到第一段文字出現為止
+        started = time.perf_counter()
+        for chunk in gemini.get_client().models.generate_content_stream(
+            model=gemini.CHAT_MODEL,
+            contents=_contents(user_text, history),
+            config=_chat_config(),
+        ):
+            if started is not None:
+                metrics.observe(metrics.STAGE_SECONDS, time.perf_counter() - started, stage="gemini_first_chunk")
+                started = None
+            for fc in chunk.function_calls or []:
+                result = call_tool(fc.name, fc.args or {})
+                if result is not None:
+                    if use_cache:
+                        reply_cache.set(user_text, result)
+                    conversations.record(conversation, user_text, result)
+                    yield _reply_event(result)
+                    return
+            if chunk.text:
+                parts.append(chunk.text)
+                yield "token", {"text": chunk.text}
     except Exception as e:
         print(f"Gemini API Error: {e}")
-        return "抱歉，我現在有點忙不過來，請稍後再試一次。"
+        yield "error", {"text": BUSY_REPLY}
+        return
+
+    text = "".join(parts)
+    if not text:
+        yield "text", {"text": "Gemini 沒有回應任何內容。"}
+        return
+    if use_cache:
+        reply_cache.set(user_text, text)
+    conversations.record(conversation, user_text, text)
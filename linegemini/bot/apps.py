@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    # WAL 模式讓 webhook 寫入佇列時不會被 worker 的讀取擋住
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL;")
+            cursor.execute("PRAGMA synchronous=NORMAL;")
 
 
 class BotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bot'
+
+    def ready(self):
+        connection_created.connect(enable_sqlite_wal, dispatch_uid="bot_enable_sqlite_wal")
+        from . import signals  # noqa: F401  註冊 Activity 異動時的快取清除
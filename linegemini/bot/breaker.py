@@ -0,0 +1,60 @@
+from datetime import timedelta
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import stats
+from .models import CircuitBreaker
+
+
+def allow(name: str, cooldown: float) -> bool:
+    """
+    是否可以呼叫受保護的服務。開路期間回傳 False；冷卻時間過後只放行一個試探請求 (half-open)，
+    試探的結果決定要恢復還是再次開路。試探請求沒有回報結果時，cooldown 秒後會再放行一個
+    """
+    breaker = CircuitBreaker.objects.filter(name=name).first()
+    if breaker is None or breaker.state == CircuitBreaker.STATE_CLOSED:
+        return True
+    now = timezone.now()
+    if breaker.opened_until and breaker.opened_until > now:
+        return False
+    # 多個 worker 同時發現冷卻結束時，只有搶到 UPDATE 的那一個可以試探
+    return bool(CircuitBreaker.objects.filter(
+        name=name, state__in=[CircuitBreaker.STATE_OPEN, CircuitBreaker.STATE_HALF_OPEN], opened_until__lte=now,
+    ).update(state=CircuitBreaker.STATE_HALF_OPEN, opened_until=now + timedelta(seconds=cooldown)))
+
+
+def record_success(name: str):
+    if CircuitBreaker.objects.filter(name=name).exclude(state=CircuitBreaker.STATE_CLOSED, failures=0).update(
+            state=CircuitBreaker.STATE_CLOSED, failures=0, opened_until=None):
+        print(f"Circuit breaker {name} closed")
+
+
+def record_failure(name: str, threshold: int, cooldown: float) -> bool:
+    """
+    記錄一次失敗 (錯誤或逾時)；連續失敗達 threshold 次或試探失敗時開路 cooldown 秒。回傳是否因此開路
+    """
+    CircuitBreaker.objects.get_or_create(name=name)
+    CircuitBreaker.objects.filter(name=name).update(failures=F("failures") + 1)
+    opened = CircuitBreaker.objects.filter(name=name).filter(
+        Q(state=CircuitBreaker.STATE_HALF_OPEN) | Q(failures__gte=threshold)
+    ).exclude(state=CircuitBreaker.STATE_OPEN).update(
+        state=CircuitBreaker.STATE_OPEN, opened_until=timezone.now() + timedelta(seconds=cooldown))
+    if opened:
+        print(f"Circuit breaker {name} opened for {cooldown:.0f}s")
+        stats.incr(f"breaker.{name}.opened")
+    return bool(opened)
+
+
+def state(name: str) -> dict:
+    """
+    監控用的斷路器狀態
+    """
+    breaker = CircuitBreaker.objects.filter(name=name).first()
+    if breaker is None:
+        return {"state": CircuitBreaker.STATE_CLOSED, "failures": 0, "opened_until": None}
+    return {
+        "state": breaker.state,
+        "failures": breaker.failures,
+        "opened_until": breaker.opened_until.isoformat() if breaker.opened_until else None,
+    }
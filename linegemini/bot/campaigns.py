@@ -0,0 +1,183 @@
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from django.db.models import Max
+from django.utils import timezone
+
+from . import flex, stats
+from .line_api import MULTICAST_LIMIT, LineClient
+from .models import Activity, Campaign, CampaignRecipient
+from .ratelimit import TokenBucket
+
+# 推播參數 (可用環境變數調整)
+# LINE multicast 的上限是每秒 200 個請求，預設留一半給其他推播
+CAMPAIGN_RATE = float(os.getenv("CAMPAIGN_RATE", "100"))  # 每秒最多幾個 multicast 請求
+CAMPAIGN_CONCURRENCY = int(os.getenv("CAMPAIGN_CONCURRENCY", "8"))  # 同時進行的請求數
+CAMPAIGN_BATCH_SIZE = MULTICAST_LIMIT
+# 一則輪播最多 12 張卡片
+CAROUSEL_LIMIT = 12
+
+_RETRY_KEY_NAMESPACE = uuid.UUID("6f0c1f7e-3d1c-4c59-9a3e-6a6d0c1b2f10")
+
+
+def retry_key(campaign: Campaign, batch: int) -> str:
+    """
+    每個批次固定的 X-Line-Retry-Key：中斷後重送同一批時 LINE 回 409 而不會重複發送
+    """
+    return str(uuid.uuid5(_RETRY_KEY_NAMESPACE, f"{campaign.pk}:{batch}"))
+
+
+def add_recipients(campaign: Campaign, user_ids, chunk_size: int = 1000) -> int:
+    """
+    加入收件者 (可以是很大的 iterable，分段寫入)；已存在的會略過，回傳實際新增的人數
+    """
+    before = campaign.recipients.count()
+    chunk = []
+    for user_id in user_ids:
+        user_id = user_id.strip()
+        if user_id and not user_id.startswith("#"):
+            chunk.append(CampaignRecipient(campaign=campaign, user_id=user_id))
+        if len(chunk) >= chunk_size:
+            CampaignRecipient.objects.bulk_create(chunk, ignore_conflicts=True)
+            chunk = []
+    if chunk:
+        CampaignRecipient.objects.bulk_create(chunk, ignore_conflicts=True)
+    return campaign.recipients.count() - before
+
+
+def build_messages(campaign: Campaign) -> list:
+    """
+    推播內容：文字 (如果有) + 活動卡片 (一個活動) 或輪播 (多個活動)，沿用對話回覆的 Flex 版型
+    """
+    messages = []
+    if campaign.text:
+        messages.append({"type": "text", "text": campaign.text})
+    ids = campaign.activity_ids[:CAROUSEL_LIMIT]
+    activities = sorted(Activity.objects.filter(pk__in=ids).for_rendering(), key=lambda a: ids.index(a.pk))
+    if len(activities) == 1:
+        messages.append(flex.activity_card(activities[0]))
+    elif activities:
+        messages.append(flex.activity_carousel(activities, alt_text=campaign.name))
+    if not messages:
+        raise ValueError(f"Campaign {campaign} has no message content")
+    return messages
+
+
+def _batches(campaign: Campaign):
+    """
+    依序產生 (批次編號, [(pk, userId), ...])：先是上次已分配批次但還沒確認送出的 (用同一個 retry key 重送)，
+    再把尚未分配的收件者每 500 人分成新的一批。分配批次會先寫入資料庫，才送出請求
+    """
+    pending = campaign.recipients.filter(status=CampaignRecipient.STATUS_PENDING)
+    for batch in (pending.exclude(batch=None).order_by("batch")
+                  .values_list("batch", flat=True).distinct()):
+        yield batch, list(pending.filter(batch=batch).values_list("pk", "user_id"))
+
+    next_batch = (campaign.recipients.aggregate(last=Max("batch"))["last"] or 0) + 1
+    while True:
+        rows = list(pending.filter(batch=None).order_by("pk").values_list("pk", "user_id")[:CAMPAIGN_BATCH_SIZE])
+        if not rows:
+            return
+        CampaignRecipient.objects.filter(pk__in=[pk for pk, _ in rows]).update(batch=next_batch)
+        yield next_batch, rows
+        next_batch += 1
+
+
+def _send_batch(client: LineClient, bucket: TokenBucket, user_ids: list, messages: list, key: str):
+    """
+    回傳錯誤訊息，成功則回傳空字串 (在執行緒中執行，不碰資料庫)
+    """
+    bucket.acquire()
+    try:
+        client.multicast(user_ids, messages, retry_key=key)
+    except requests.HTTPError as e:
+        # 409：同一個 retry key 先前已被接受 (上次中斷前其實送出了)
+        if e.response is not None and e.response.status_code == 409:
+            return ""
+        return str(e)
+    except requests.RequestException as e:
+        return str(e)
+    return ""
+
+
+def _record(campaign: Campaign, batch: int, pks: list, error: str):
+    status = CampaignRecipient.STATUS_FAILED if error else CampaignRecipient.STATUS_SENT
+    CampaignRecipient.objects.filter(pk__in=pks).update(status=status, error=error[:500])
+    if error:
+        print(f"Campaign {campaign} batch {batch} failed: {error}")
+        campaign.failed_count += len(pks)
+        stats.incr("campaign.failed", len(pks))
+    else:
+        campaign.sent_count += len(pks)
+        stats.incr("campaign.sent", len(pks))
+    campaign.save(update_fields=["sent_count", "failed_count"])
+
+
+def retry_failed(campaign: Campaign) -> int:
+    """
+    把失敗的收件者改回等待中 (保留原本的批次與 retry key)，回傳人數
+    """
+    failed = campaign.recipients.filter(status=CampaignRecipient.STATUS_FAILED)
+    count = failed.update(status=CampaignRecipient.STATUS_PENDING, error="")
+    campaign.failed_count = max(0, campaign.failed_count - count)
+    campaign.save(update_fields=["failed_count"])
+    return count
+
+
+def send(campaign: Campaign, client: LineClient = None, rate: float = CAMPAIGN_RATE,
+         concurrency: int = CAMPAIGN_CONCURRENCY, progress=None) -> dict:
+    """
+    以 multicast 分批發送給所有尚未送出的收件者：令牌桶限制每秒請求數，同時最多 concurrency 個請求。
+    每批送出後立刻記錄進度，中斷後再呼叫一次會從沒送完的批次繼續。
+    progress(summary) 每完成一批呼叫一次。回傳 {"recipients", "requests", "failed", "seconds", "per_second"}
+    """
+    messages = build_messages(campaign)
+    if client is None:
+        client = LineClient(os.getenv("LINE_CHANNEL_ACCESS_TOKEN", ""), pool_size=concurrency)
+    bucket = TokenBucket(rate, capacity=max(1, concurrency))
+
+    campaign.status = Campaign.STATUS_SENDING
+    campaign.started_at = campaign.started_at or timezone.now()
+    campaign.save(update_fields=["status", "started_at"])
+
+    summary = {"recipients": 0, "requests": 0, "failed": 0}
+    started = time.perf_counter()
+
+    def finish(future):
+        batch, pks = inflight.pop(future)
+        error = future.result()
+        _record(campaign, batch, pks, error)
+        summary["requests"] += 1
+        summary["failed" if error else "recipients"] += len(pks)
+        if progress:
+            progress(_rates(summary, started))
+
+    inflight = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="campaign") as pool:
+        for batch, rows in _batches(campaign):
+            # 進行中的批次有上限，資料庫進度與實際送出的差距不會超過 concurrency 批
+            while len(inflight) >= concurrency:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            future = pool.submit(_send_batch, client, bucket, [user_id for _, user_id in rows], messages,
+                                 retry_key(campaign, batch))
+            inflight[future] = (batch, [pk for pk, _ in rows])
+        while inflight:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future)
+
+    if not campaign.recipients.filter(status=CampaignRecipient.STATUS_PENDING).exists():
+        campaign.status = Campaign.STATUS_DONE
+        campaign.finished_at = timezone.now()
+        campaign.save(update_fields=["status", "finished_at"])
+    return _rates(summary, started)
+
+
+def _rates(summary: dict, started: float) -> dict:
+    seconds = time.perf_counter() - started
+    return dict(summary, seconds=seconds, per_second=summary["recipients"] / seconds if seconds else 0.0)
@@ -0,0 +1,169 @@
+import os
+import unicodedata
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import gemini, metrics, ratelimit, stats
+from .models import Conversation
+
+# 對話記憶參數 (可用環境變數調整)
+CONVERSATION_ENABLED = os.getenv("CONVERSATION_ENABLED", "1") == "1"
+# 摘要加上最近對話超過這個 token 數時，把較早的對話濃縮進摘要
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1200"))
+CONVERSATION_KEEP_TURNS = int(os.getenv("CONVERSATION_KEEP_TURNS", "4"))  # 濃縮後保留的最近訊息數
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "20"))  # 最多保留的原文訊息數
+CONVERSATION_IDLE_TTL = int(os.getenv("CONVERSATION_IDLE_TTL", "1800"))  # 閒置多久 (秒) 後忘記對話
+SUMMARY_MAX_CHARS = 600
+
+USER, MODEL = "u", "m"
+_ROLES = {USER: "user", MODEL: "model"}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗估 token 數：中日韓文字約一字一個 token，其他文字約四個字元一個 token
+    """
+    text = text or ""
+    wide = sum(1 for ch in text if unicodedata.east_asian_width(ch) in ("W", "F"))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _count(summary: str, turns: list) -> int:
+    return estimate_tokens(summary) + sum(estimate_tokens(text) for _, text in turns)
+
+
+def load(user_id: str):
+    """
+    取得使用者的對話記憶 (尚未儲存的新對話也會回傳物件)；閒置過久的對話會被清空。
+    未啟用或沒有 user_id 時回傳 None。
+    """
+    if not CONVERSATION_ENABLED or not user_id:
+        return None
+    conversation = Conversation.objects.filter(user_id=user_id).first()
+    if conversation is None:
+        return Conversation(user_id=user_id)
+    if _idle(conversation):
+        conversation.summary, conversation.turns, conversation.tokens = "", [], 0
+        stats.incr("conversation.expired")
+    return conversation
+
+
+def _idle(conversation) -> bool:
+    return conversation.updated_at < timezone.now() - timedelta(seconds=CONVERSATION_IDLE_TTL)
+
+
+def history(conversation) -> list:
+    """
+    轉成 Gemini 的 contents (摘要 + 最近對話)，沒有記憶時回傳空 list
+    """
+    if conversation is None:
+        return []
+    from google.genai import types
+
+    contents = []
+    if conversation.summary:
+        contents.append(types.Content(role="user", parts=[
+            types.Part.from_text(text=f"(先前對話摘要) {conversation.summary}")]))
+        contents.append(types.Content(role="model", parts=[types.Part.from_text(text="好的，我記得。")]))
+    for role, text in conversation.turns:
+        contents.append(types.Content(role=_ROLES[role], parts=[types.Part.from_text(text=text)]))
+    return contents
+
+
+def reply_text(reply) -> str:
+    """
+    回覆轉成要記住的文字；Flex Message 只記 altText (例如「台北馬拉松 活動資訊」)
+    """
+    if hasattr(reply, "get") and reply.get("type") == "flex":
+        return reply.get("altText", "")
+    return str(reply)
+
+
+def record(conversation, user_text: str, reply):
+    """
+    記下一輪對話 (使用者訊息 + 回覆)
+    """
+    if conversation is None:
+        return
+    with transaction.atomic():
+        # 在交易裡重新讀取最新的內容再加上這一輪 (SQLite IMMEDIATE 交易一開始就取得寫入鎖)，
+        # 其他 worker 同時記下的對話或濃縮結果不會被載入時的舊內容蓋掉
+        current, created = Conversation.objects.get_or_create(user_id=conversation.user_id)
+        if not created and _idle(current):
+            current.summary, current.turns = "", []
+        turns = current.turns + [[USER, user_text], [MODEL, reply_text(reply)]]
+        current.turns = turns[-CONVERSATION_MAX_TURNS:]
+        current.tokens = _count(current.summary, current.turns)
+        current.save(update_fields=["summary", "turns", "tokens", "updated_at"])
+    conversation.pk, conversation.summary, conversation.turns, conversation.tokens = (
+        current.pk, current.summary, current.turns, current.tokens)
+
+
+def record_for(user_id: str, user_text: str, reply):
+    """
+    依 user_id 記下一輪對話 (不必先 load；未啟用或沒有 user_id 時不做事)
+    """
+    if CONVERSATION_ENABLED and user_id:
+        record(Conversation(user_id=user_id), user_text, reply)
+
+
+def summarize(summary: str, turns: list) -> str:
+    transcript = "\n".join(f"{'使用者' if role == USER else '助理'}：{text}" for role, text in turns)
+    prompt = (
+        f"請用繁體中文把以下對話濃縮成 {SUMMARY_MAX_CHARS} 字以內的摘要，"
+        "保留使用者提到的活動名稱、地點、日期與偏好，只輸出摘要本身。\n\n"
+        f"既有摘要：{summary or '無'}\n\n對話：\n{transcript}"
+    )
+    with metrics.span("gemini_summary"):
+        response = gemini.get_client().models.generate_content(model=gemini.CHAT_MODEL, contents=prompt)
+    return (response.text or "").strip()
+
+
+def compact(user_id: str) -> bool:
+    """
+    超過 token 預算時把較早的對話濃縮進摘要，只留最近幾則原文 (在回覆送出後呼叫，不影響回應時間)。
+    回傳是否有濃縮。
+    """
+    conversation = Conversation.objects.filter(user_id=user_id).first()
+    if conversation is None or conversation.tokens <= CONVERSATION_TOKEN_BUDGET:
+        return False
+    if len(conversation.turns) <= CONVERSATION_KEEP_TURNS:
+        return False
+
+    # 濃縮也會呼叫 Gemini，與對話共用整體配額；配額不足時先不濃縮，下一輪再試
+    try:
+        ratelimit.acquire(ratelimit.CHAT)
+    except ratelimit.RateLimited:
+        return False
+
+    older = conversation.turns[:-CONVERSATION_KEEP_TURNS]
+    try:
+        summary = summarize(conversation.summary, older)
+    except Exception as e:
+        # 摘要失敗就保留原本的摘要，較早的對話直接捨棄
+        print(f"Conversation summary failed: {e}")
+        summary = conversation.summary
+
+    with transaction.atomic():
+        # 摘要期間可能又記下了新的對話：只換掉被濃縮的那幾則，之後新增的保留；
+        # 其他 worker 已經濃縮過 (開頭不同) 就放棄這次的結果
+        current = Conversation.objects.filter(pk=conversation.pk).first()
+        if current is None or current.summary != conversation.summary or current.turns[:len(older)] != older:
+            return False
+        current.summary = summary[:SUMMARY_MAX_CHARS]
+        current.turns = current.turns[len(older):]
+        current.tokens = _count(current.summary, current.turns)
+        current.save(update_fields=["summary", "turns", "tokens", "updated_at"])
+    stats.incr("conversation.compacted")
+    return True
+
+
+def purge_idle() -> int:
+    """
+    刪除閒置過久的對話
+    """
+    cutoff = timezone.now() - timedelta(seconds=CONVERSATION_IDLE_TTL)
+    deleted, _ = Conversation.objects.filter(updated_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,111 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import stats
+from .models import WebhookEvent
+
+# webhook 去重參數 (可用環境變數調整)
+WEBHOOK_DEDUPE_TTL = int(os.getenv("WEBHOOK_DEDUPE_TTL", str(24 * 60 * 60)))  # 秒
+WEBHOOK_DEDUPE_LRU_SIZE = int(os.getenv("WEBHOOK_DEDUPE_LRU_SIZE", "10000"))
+
+# 這個 process 最近確認過的 webhookEventId，大部分重送不必查資料庫
+_recent = OrderedDict()
+_lock = threading.Lock()
+
+
+def event_id(event: dict) -> str:
+    return event.get("webhookEventId", "")
+
+
+def _seen_recently(key: str) -> bool:
+    with _lock:
+        if key in _recent:
+            _recent.move_to_end(key)
+            return True
+        return False
+
+
+def _remember(keys: list):
+    with _lock:
+        for key in keys:
+            _recent[key] = True
+            _recent.move_to_end(key)
+        while len(_recent) > WEBHOOK_DEDUPE_LRU_SIZE:
+            _recent.popitem(last=False)
+
+
+def clear():
+    with _lock:
+        _recent.clear()
+
+
+def _existing(keys: list) -> set:
+    return set(WebhookEvent.objects.filter(event_id__in=keys).values_list("event_id", flat=True))
+
+
+def claim_new(events: list) -> list:
+    """
+    回傳第一次收到的 events (依 webhookEventId 去重，沒有 id 的事件一律保留) 並登記它們的 id。
+    要在寫入佇列的同一個 transaction 內呼叫：寫入失敗時登記一起取消，LINE 重送時仍會處理。
+    多個 worker 同時收到同一事件時由 unique 限制決定，只有一個會成功登記
+    """
+    candidates = []
+    duplicates = 0
+    for event in events:
+        key = event_id(event)
+        if key and (_seen_recently(key) or key in candidates):
+            duplicates += 1
+        else:
+            candidates.append(key)
+
+    existing = _existing([key for key in candidates if key])
+    new_keys = set()
+    for key in candidates:
+        if not key:
+            continue
+        if key in existing:
+            duplicates += 1
+            continue
+        try:
+            with transaction.atomic():
+                WebhookEvent.objects.create(event_id=key)
+        except IntegrityError:
+            # 其他 worker 剛好先登記了同一個事件
+            duplicates += 1
+        else:
+            new_keys.add(key)
+
+    # 資料庫已有紀錄 (不論是誰寫的) 的 id 都可以放進 LRU；新登記的等 commit 後才算數
+    _remember(list(existing))
+    transaction.on_commit(lambda: _remember(list(new_keys)))
+
+    if duplicates:
+        print(f"Dropped {duplicates} duplicate webhook events")
+        stats.incr("webhook.duplicates", duplicates)
+    redeliveries = sum(1 for e in events if e.get("deliveryContext", {}).get("isRedelivery"))
+    if redeliveries:
+        stats.incr("webhook.redeliveries", redeliveries)
+
+    kept = set()
+    result = []
+    for event in events:
+        key = event_id(event)
+        if not key:
+            result.append(event)
+        elif key in new_keys and key not in kept:
+            kept.add(key)
+            result.append(event)
+    return result
+
+
+def purge_expired(ttl: int = WEBHOOK_DEDUPE_TTL) -> int:
+    """
+    刪除超過保留時間的 webhookEventId
+    """
+    deleted, _ = WebhookEvent.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+    return deleted
@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .line_api import dumps
+
+# 每個 worker 最多快取幾張活動卡片 (bubble) 的 JSON
+FLEX_CACHE_SIZE = int(os.getenv("FLEX_CACHE_SIZE", "1024"))
+
+DEFAULT_HERO_URL = "https://via.placeholder.com/1024x768"
+DEFAULT_LINK_URL = "https://line.me/"
+
+
+class FlexMessage:
+    """
+    已序列化好的 Flex Message。LineClient 送出時直接把 bytes 拼進 payload，
+    不必重建 dict 再 json.dumps；需要 dict 時 (快取、測試) 才用 to_dict() 解析。
+    """
+    __slots__ = ("alt_text", "contents_json", "_dict")
+
+    def __init__(self, alt_text: str, contents_json: bytes):
+        self.alt_text = alt_text
+        self.contents_json = contents_json
+        self._dict = None
+
+    def to_json(self) -> bytes:
+        return b'{"type":"flex","altText":' + dumps(self.alt_text) + b',"contents":' + self.contents_json + b'}'
+
+    def to_dict(self) -> dict:
+        if self._dict is None:
+            self._dict = json.loads(self.to_json())
+        return self._dict
+
+    # 讓既有用 message["altText"] / message.get("type") 的程式碼照常運作
+    def __getitem__(self, key):
+        return self.to_dict()[key]
+
+    def get(self, key, default=None):
+        return self.to_dict().get(key, default)
+
+    def __eq__(self, other):
+        if isinstance(other, FlexMessage):
+            return self.to_json() == other.to_json()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f"<FlexMessage {self.alt_text!r}>"
+
+
+def is_flex(message) -> bool:
+    return isinstance(message, FlexMessage) or (isinstance(message, dict) and message.get("type") == "flex")
+
+
+def activity_bubble(activity) -> dict:
+    """
+    單一活動的 bubble (活動卡片與輪播共用同一個版型)
+    """
+    return {
+        "type": "bubble",
+        "hero": {
+            "type": "image",
+            "url": activity.image_url if activity.image_url else DEFAULT_HERO_URL,
+            "size": "full",
+            "aspectRatio": "20:13",
+            "aspectMode": "cover",
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": activity.name, "weight": "bold", "size": "xl"},
+                {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "結束日期", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                        {"type": "text", "text": str(activity.end_date), "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
+                    ]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "地點", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                        {"type": "text", "text": activity.location, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
+                    ]}
+                ]},
+                {"type": "text", "text": activity.description, "wrap": True, "margin": "md", "color": "#666666"}
+            ]
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": [
+                {"type": "button", "style": "link", "height": "sm", "action": {"type": "uri", "label": "活動詳情", "uri": activity.activity_link if activity.activity_link else DEFAULT_LINK_URL}}
+            ],
+            "flex": 0
+        }
+    }
+
+
+# pk -> (updated_at, bubble JSON bytes)，依最近使用順序淘汰
+_bubbles = OrderedDict()
+_lock = threading.Lock()
+
+
+def bubble_json(activity) -> bytes:
+    """
+    取得活動 bubble 的 JSON；以 (pk, updated_at) 快取，活動沒有修改就不會重建
+    """
+    key = activity.pk
+    version = activity.updated_at
+    with _lock:
+        cached = _bubbles.get(key)
+        if cached is not None and cached[0] == version:
+            _bubbles.move_to_end(key)
+            return cached[1]
+
+    data = dumps(activity_bubble(activity))
+    if key is not None:
+        with _lock:
+            _bubbles[key] = (version, data)
+            _bubbles.move_to_end(key)
+            while len(_bubbles) > FLEX_CACHE_SIZE:
+                _bubbles.popitem(last=False)
+    return data
+
+
+def forget(pk):
+    """
+    活動修改或刪除時移除快取 (由 signal 呼叫)
+    """
+    with _lock:
+        _bubbles.pop(pk, None)
+
+
+def clear():
+    with _lock:
+        _bubbles.clear()
+
+
+def activity_card(activity) -> FlexMessage:
+    return FlexMessage(f"{activity.name} 活動資訊", bubble_json(activity))
+
+
+def activity_carousel(activities, alt_text: str = "最近活動列表") -> FlexMessage:
+    """
+    把快取好的 bubble 直接拼成輪播，不重建任何 dict
+    """
+    contents = b'{"type":"carousel","contents":[' + b",".join(bubble_json(a) for a in activities) + b"]}"
+    return FlexMessage(alt_text, contents)
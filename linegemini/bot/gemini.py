@@ -0,0 +1,55 @@
+import os
+import threading
+
+# 從環境變數讀取 API Key 與模型名稱
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+CHAT_MODEL = os.getenv("GEMINI_CHAT_MODEL", "gemini-2.5-flash")
+IMAGE_MODEL = os.getenv("GEMINI_IMAGE_MODEL", "gemini-3-pro-image-preview")
+# 改用其他相容的 API 端點 (例如 bench_load 的本機假 Gemini)，未設定時使用 Google 的服務
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+
+# google.genai 載入要 0.5 秒以上，只在第一次真正用到時才 import (見 get_client)，
+# webhook 只驗證簽章、寫入佇列，冷啟動時不必等 SDK 載入
+
+# 每個 worker process 共用的物件 (client、對話設定、工具宣告...)
+_registry = {}
+_lock = threading.Lock()
+
+
+def shared(name: str, factory):
+    """
+    取得名為 name 的共用物件，第一次呼叫時才用 factory() 建立，之後重複使用
+    """
+    try:
+        return _registry[name]
+    except KeyError:
+        pass
+    with _lock:
+        if name not in _registry:
+            _registry[name] = factory()
+        return _registry[name]
+
+
+def _create_client():
+    from google import genai
+    from google.genai import types
+
+    if GEMINI_BASE_URL:
+        return genai.Client(api_key=GEMINI_API_KEY, http_options=types.HttpOptions(base_url=GEMINI_BASE_URL))
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+
+def get_client():
+    """
+    整個 process 共用一個 google.genai Client (對話與生圖都用它)，
+    底層 HTTP 連線會被重複使用，不必每則訊息重新建立 client 與 TLS 連線
+    """
+    return shared("client", _create_client)
+
+
+def reset():
+    """
+    清空共用物件 (測試或更換設定時使用)
+    """
+    with _lock:
+        _registry.clear()
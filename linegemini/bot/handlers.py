@@ -0,0 +1,198 @@
+import asyncio
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+
+from . import conversations, media_store, photos
+from .ai_reply import aget_gemini_response, gen_ai_img, gen_composite_img, get_gemini_response, remember_turn
+from .jobs import KIND_IMAGE, KIND_LINE_EVENT, PermanentJobError, enqueue_image
+from .line_api import get_line_client
+from .views import (aline_reply, asend_loading_animation, line_reply, push_generated_image,
+                    send_loading_animation)
+
+PHOTO_RECEIVED_REPLY = "收到你的人像照了！請再傳一張活動場景的照片，我會把你合成進去。"
+PHOTO_COMPOSING_REPLY = "照片合成中，完成後會直接傳給你，請稍候。"
+PHOTO_INVALID_REPLY = "這張照片無法使用 (太大或不是圖片)，請換一張試試。"
+
+
+def _text_message(event: dict):
+    """
+    回傳 (使用者訊息, reply token, userId)；不是文字訊息則回傳 None
+    """
+    if event.get("type") != "message":
+        return None
+    msg = event.get("message", {})
+    if msg.get("type") != "text":
+        return None
+    return msg.get("text", ""), event.get("replyToken"), event.get("source", {}).get("userId")
+
+
+def _image_message(event: dict):
+    """
+    回傳 (訊息 id, reply token, userId)；不是使用者上傳到 LINE 的圖片則回傳 None
+    """
+    if event.get("type") != "message":
+        return None
+    msg = event.get("message", {})
+    if msg.get("type") != "image" or msg.get("contentProvider", {}).get("type", "line") != "line":
+        return None
+    return msg.get("id"), event.get("replyToken"), event.get("source", {}).get("userId")
+
+
+def _receive_photo(event: dict, message_id: str, user_id: str) -> str:
+    """
+    從 LINE 下載照片 (串流寫入磁碟) 並縮小存檔；第一張當人像、第二張當場景，
+    湊滿兩張就排入合成工作 (完成後推播)。回傳要回覆使用者的文字
+    """
+    try:
+        pending = photos.add_pending(user_id, get_line_client().iter_content(message_id))
+    except photos.PhotoError as e:
+        print(f"Photo rejected: {e}")
+        return PHOTO_INVALID_REPLY
+    if len(pending) < 2:
+        return PHOTO_RECEIVED_REPLY
+    enqueue_image("", base_url=event.get("baseUrl", ""), user_id=user_id, push=True,
+                  photos=photos.take_pending(user_id))
+    return PHOTO_COMPOSING_REPLY
+
+
+def _check_reply_error(status, e: Exception):
+    # 4xx (429 除外) 代表 reply token 失效或內容有誤，重試也不會成功
+    if status and 400 <= status < 500 and status != 429:
+        raise PermanentJobError(str(e)) from e
+    raise e
+
+
+def _remember(user_id: str, user_text: str, reply):
+    # 回覆成功送出後才記下這一輪：回覆失敗時工作會重試並再問一次 Gemini，不能重複記下同一輪；
+    # 回覆已經送出，記錄失敗也不讓工作重試
+    try:
+        remember_turn(user_id, user_text, reply)
+    except Exception as e:
+        print(f"Conversation record failed: {e}")
+
+
+def _compact(user_id: str):
+    # 回覆送出後才整理對話記憶，濃縮摘要的時間不會算在使用者等待的時間裡
+    try:
+        conversations.compact(user_id)
+    except Exception as e:
+        print(f"Conversation compaction failed: {e}")
+
+
+def handle_line_event(event: dict):
+    """
+    處理單一 LINE webhook event (由背景 worker 呼叫)
+    """
+    image = _image_message(event)
+    if image and image[2]:
+        message_id, reply_token, user_id = image
+        _reply_or_raise(reply_token, _receive_photo(event, message_id, user_id))
+        return
+
+    message = _text_message(event)
+    if message is None:
+        return
+    user_text, reply_token, user_id = message
+    print(user_text, reply_token)
+
+    if user_id:
+        send_loading_animation(user_id)
+
+    # 使用 Gemini AI 生成回應 (帶上這位使用者先前的對話)
+    ai_text = get_gemini_response(user_text, user_id=user_id, remember=False)
+    _reply_or_raise(reply_token, ai_text)
+
+    if user_id:
+        _remember(user_id, user_text, ai_text)
+        _compact(user_id)
+
+
+def _reply_or_raise(reply_token: str, message):
+    try:
+        line_reply(reply_token, message)
+    except requests.HTTPError as e:
+        _check_reply_error(e.response.status_code if e.response is not None else None, e)
+
+
+async def ahandle_line_event(event: dict):
+    """
+    handle_line_event 的 async 版本 (run_worker --async)：等待 LINE 與 Gemini 時不佔用執行緒，
+    一個 process 可以同時處理數百則對話
+    """
+    image = _image_message(event)
+    if image and image[2]:
+        # 下載與縮圖是同步的檔案處理，放在獨立執行緒
+        message_id, reply_token, user_id = image
+        reply = await sync_to_async(_receive_photo, thread_sensitive=False)(event, message_id, user_id)
+        try:
+            await aline_reply(reply_token, reply)
+        except httpx.HTTPStatusError as e:
+            _check_reply_error(e.response.status_code, e)
+        return
+
+    message = _text_message(event)
+    if message is None:
+        return
+    user_text, reply_token, user_id = message
+    print(user_text, reply_token)
+
+    # 讀取動畫與 Gemini 同時進行，不必等 LINE 回應才開始產生回覆
+    loading = asyncio.ensure_future(asend_loading_animation(user_id)) if user_id else None
+    ai_text = await aget_gemini_response(user_text, user_id=user_id, remember=False)
+    if loading is not None:
+        await loading
+
+    try:
+        await aline_reply(reply_token, ai_text)
+    except httpx.HTTPStatusError as e:
+        _check_reply_error(e.response.status_code, e)
+
+    if user_id:
+        await sync_to_async(_remember)(user_id, user_text, ai_text)
+        # 濃縮摘要會同步呼叫 Gemini，放在獨立執行緒，不卡住其他對話的資料庫存取
+        await sync_to_async(_compact, thread_sensitive=False)(user_id)
+
+
+def handle_image_job(payload: dict) -> dict:
+    """
+    生成圖片 (由背景 worker 呼叫)，回傳值會存進 Job.result 供狀態查詢
+    """
+    user_id = payload.get("user_id")
+    # 超過生圖限流時丟出 RateLimited，由佇列稍後重試
+    if payload.get("photos"):
+        try:
+            inputs = photos.read(payload["photos"])
+        except FileNotFoundError as e:
+            raise PermanentJobError(f"photo expired: {e}") from e
+        image_url = gen_composite_img(payload.get("prompt", ""), inputs, base_url=payload.get("base_url"),
+                                      user_id=user_id or None)
+        # 合成完成 (包含失敗回傳預留圖) 後就不再需要原始照片；重試中的工作會保留照片
+        photos.discard(payload["photos"])
+    else:
+        image_url = gen_ai_img(payload.get("prompt", "cute robot"), base_url=payload.get("base_url"),
+                               fresh=payload.get("fresh", False), user_id=user_id or None)
+    result = {"image_url": image_url, "preview_url": media_store.preview_url(image_url)}
+
+    if payload.get("push") and user_id:
+        # 推播失敗不重新生圖，使用者仍可從 LIFF 取得圖片
+        try:
+            push_generated_image(user_id, image_url)
+            result["pushed"] = True
+        except Exception as e:
+            print(f"Push generated image failed: {e}")
+            result["pushed"] = False
+    return result
+
+
+# 工作類型 -> 處理函式
+HANDLERS = {
+    KIND_LINE_EVENT: handle_line_event,
+    KIND_IMAGE: handle_image_job,
+}
+
+# run_worker --async 使用的 async 處理函式
+ASYNC_HANDLERS = {
+    KIND_LINE_EVENT: ahandle_line_event,
+}
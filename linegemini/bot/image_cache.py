@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+from . import media_store, stats, versioning
+
+# 生圖快取參數 (可用環境變數調整)
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "1") == "1"
+# 等待其他執行緒生成同一張圖的最長秒數
+IMAGE_CACHE_WAIT_TIMEOUT = float(os.getenv("IMAGE_CACHE_WAIT_TIMEOUT", "300"))
+
+
+def cache_key(model: str, prompt: str, config: dict) -> str:
+    """
+    同一個 (模型, 提示詞, 設定) 得到同一個 key；提示詞前後與重複的空白不影響結果
+    """
+    raw = json.dumps({"model": model, "prompt": " ".join(prompt.split()), "config": config},
+                     ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def lookup(key: str):
+    """
+    回傳已生成的檔名，沒有則回傳 None
+    """
+    directory = media_store.image_dir()
+    for ext in media_store.EXTENSIONS:
+        if os.path.exists(os.path.join(directory, key + ext)):
+            return key + ext
+    return None
+
+
+# key -> Future，同一個 process 內同時要求同一張圖時共用一次生成
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_or_generate(key: str, generate):
+    """
+    取得 key 對應的圖片檔名；沒有快取時呼叫 generate() 取得 (bytes, mime_type) 並存檔。
+    同一張圖同時只會生成一次：同 process 的執行緒等待同一個 Future，
+    其他 process 則由檔案鎖排隊，拿到鎖後發現已有檔案就直接使用。
+    generate() 沒有產生圖片 (回傳 None) 時回傳 None。
+    """
+    file_name = lookup(key)
+    if file_name:
+        stats.incr("image_cache.hit")
+        media_store.touch(file_name)
+        return file_name
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+
+    if not leader:
+        stats.incr("image_cache.shared")
+        return future.result(timeout=IMAGE_CACHE_WAIT_TIMEOUT)
+
+    try:
+        with versioning.lock(f"image-{key}"):
+            file_name = lookup(key)
+            if file_name:
+                stats.incr("image_cache.shared")
+            else:
+                stats.incr("image_cache.miss")
+                image = generate()
+                file_name = media_store.write(*image, stem=key) if image else None
+        future.set_result(file_name)
+        return file_name
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
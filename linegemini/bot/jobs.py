@@ -0,0 +1,289 @@
+import os
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import dedupe
+from .models import Job
+
+# 佇列參數 (可用環境變數調整)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "120"))  # 秒
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "2"))  # 秒，每次重試加倍
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "300"))
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "24"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))  # 同時處理的使用者數上限
+# 生圖一次要數十秒，所有 worker 加起來同時生圖的數量上限與鎖定秒數另外設定
+IMAGE_JOB_CONCURRENCY = int(os.getenv("IMAGE_JOB_CONCURRENCY", "2"))
+IMAGE_JOB_VISIBILITY_TIMEOUT = int(os.getenv("IMAGE_JOB_VISIBILITY_TIMEOUT", "300"))  # 秒
+IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv("IMAGE_JOB_MAX_ATTEMPTS", "2"))
+
+KIND_LINE_EVENT = "line_event"
+KIND_IMAGE = "image"
+
+# 工作類型 -> 全域同時執行上限 (跨所有 worker process)
+MAX_RUNNING = {
+    KIND_IMAGE: IMAGE_JOB_CONCURRENCY,
+}
+# 工作類型 -> 預設鎖定秒數、最多嘗試次數
+VISIBILITY_TIMEOUTS = {
+    KIND_IMAGE: IMAGE_JOB_VISIBILITY_TIMEOUT,
+}
+MAX_ATTEMPTS = {
+    KIND_IMAGE: IMAGE_JOB_MAX_ATTEMPTS,
+}
+
+# 對外 (LIFF 狀態查詢) 顯示的狀態名稱
+PUBLIC_STATES = {
+    Job.STATUS_PENDING: "queued",
+    Job.STATUS_RUNNING: "running",
+    Job.STATUS_DONE: "done",
+    Job.STATUS_FAILED: "failed",
+}
+
+
+class PermanentJobError(Exception):
+    """
+    不需要重試的錯誤 (例如 reply token 已失效)，工作會直接標記為失敗
+    """
+
+
+def enqueue(kind: str, payloads: list, user_key=None) -> list:
+    """
+    將多筆工作一次寫入佇列 (單一交易)，回傳建立的 Job。
+    user_key(payload) 回傳的值相同的工作會依寫入順序逐一處理。
+    """
+    now = timezone.now()
+    jobs = [
+        Job(kind=kind, payload=payload, user_key=(user_key(payload) if user_key else "") or "", available_at=now)
+        for payload in payloads
+    ]
+    return Job.objects.bulk_create(jobs)
+
+
+def line_event_user(event: dict) -> str:
+    return event.get("source", {}).get("userId", "")
+
+
+def enqueue_line_events(events: list) -> list:
+    """
+    將 LINE webhook 的 events 逐筆放入佇列；LINE 重送 (webhookEventId 已收過) 的事件直接略過，
+    不會再呼叫一次 Gemini 或重用已失效的 reply token
+    """
+    with transaction.atomic():
+        events = dedupe.claim_new(events)
+        if not events:
+            return []
+        return enqueue(KIND_LINE_EVENT, events, user_key=line_event_user)
+
+
+def enqueue_image(prompt: str, base_url: str = "", user_id: str = "", push: bool = False,
+                  fresh: bool = False, photos: list = None) -> Job:
+    """
+    將生圖需求放入佇列，立即回傳 Job (用 job.pk 查詢狀態)。
+    push 為 True 時生成完成後直接推播給 user_id；fresh 為 True 時不使用已生成的圖片。
+    photos 為已縮小的照片路徑 (人像、場景) 時改做照片合成。
+    """
+    payload = {"prompt": prompt, "base_url": base_url, "user_id": user_id,
+               "push": bool(push and user_id), "fresh": bool(fresh)}
+    if photos:
+        payload["photos"] = list(photos)
+    return enqueue(KIND_IMAGE, [payload])[0]
+
+
+def public_state(job: Job) -> str:
+    return PUBLIC_STATES.get(job.status, job.status)
+
+
+def _claimable(now):
+    # 等待中且已到可執行時間，或處理中但鎖定已過期 (worker 當掉或逾時)
+    return Q(status=Job.STATUS_PENDING, available_at__lte=now) | Q(
+        status=Job.STATUS_RUNNING, locked_until__lte=now
+    )
+
+
+def _running_count(kind: str, now):
+    # 目前鎖定中 (尚未逾時) 的同類工作數，作為 UPDATE 條件中的子查詢
+    return Coalesce(
+        Subquery(
+            Job.objects.filter(kind=OuterRef("kind"), status=Job.STATUS_RUNNING, locked_until__gt=now)
+            .order_by()
+            .values("kind")
+            .annotate(n=Count("id"))
+            .values("n")[:1],
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def claim(kind: str, limit: int, visibility_timeout: int = JOB_VISIBILITY_TIMEOUT,
+          max_attempts: int = JOB_MAX_ATTEMPTS, max_running: int = None) -> list:
+    """
+    取出最多 limit 筆可執行的工作並鎖定 visibility_timeout 秒。
+    以條件式 UPDATE 搶鎖，多個 worker process 同時取也不會拿到同一筆。
+    max_running 為跨所有 worker 的同時執行上限 (None 表示不限制)；
+    「目前執行數 < 上限」的判斷與搶鎖在同一個 UPDATE 內完成，不會超收。
+    """
+    if max_running is None:
+        max_running = MAX_RUNNING.get(kind)
+    if limit <= 0:
+        return []
+
+    now = timezone.now()
+
+    # 鎖定過期且已用完次數的工作直接標記失敗，避免無限重跑
+    Job.objects.filter(
+        kind=kind, status=Job.STATUS_RUNNING, locked_until__lte=now, attempts__gte=max_attempts
+    ).update(status=Job.STATUS_FAILED, locked_until=None, last_error="visibility timeout exceeded")
+
+    candidates = list(
+        Job.objects.filter(kind=kind)
+        .filter(_claimable(now))
+        .order_by("id")
+        .values_list("id", "user_key")[: limit * 2]
+    )
+
+    # 同一使用者若還有較早、尚未完成且目前不能取的工作 (處理中或等待重試)，
+    # 之後的工作都要等它結束，才能維持該使用者訊息的順序
+    users = {user for _, user in candidates if user}
+    first_blocker = {}
+    if users:
+        blockers = (
+            Job.objects.filter(kind=kind, user_key__in=users,
+                               status__in=[Job.STATUS_PENDING, Job.STATUS_RUNNING])
+            .exclude(_claimable(now))
+            .values_list("user_key", "id")
+        )
+        for user, pk in blockers:
+            first_blocker[user] = min(pk, first_blocker.get(user, pk))
+
+    claimed = []
+    for pk, user in candidates:
+        if user in first_blocker and first_blocker[user] < pk:
+            continue
+        target = Job.objects.filter(pk=pk).filter(_claimable(now))
+        if max_running is not None:
+            target = target.alias(running=_running_count(kind, now)).filter(running__lt=max_running)
+        updated = target.update(
+            status=Job.STATUS_RUNNING,
+            locked_until=now + timedelta(seconds=visibility_timeout),
+            attempts=F("attempts") + 1,
+        )
+        if updated:
+            claimed.append(pk)
+        elif max_running is not None:
+            # 已達全域上限 (或被搶走)，等下一輪再取
+            break
+        elif user:
+            # 被其他 worker 搶走了，同一使用者後面的工作也先不要拿
+            first_blocker[user] = min(pk, first_blocker.get(user, pk))
+        if len(claimed) >= limit:
+            break
+
+    if not claimed:
+        return []
+    return list(Job.objects.filter(pk__in=claimed).order_by("id"))
+
+
+def run_in_lanes(pool, items: list, key, fn, on_skip=None) -> list:
+    """
+    依 key(item) 將工作分成多條 lane 丟進 thread pool：
+    不同 lane 併發執行 (數量受 pool 大小限制)，同一 lane 內依原順序逐一執行。
+    key 為空的工作各自獨立一條 lane。回傳每條 lane 的 Future。
+    fn 回傳 False 時該 lane 停止，剩下的工作交給 on_skip 處理。
+    """
+    return [pool.submit(_run_lane, lane, fn, on_skip) for lane in group_lanes(items, key)]
+
+
+def group_lanes(items: list, key) -> list:
+    """
+    依 key(item) 分組並保持原順序；key 為空的工作各自獨立一組
+    """
+    lanes = OrderedDict()
+    for item in items:
+        lane_key = key(item) or ("", id(item))
+        lanes.setdefault(lane_key, []).append(item)
+    return list(lanes.values())
+
+
+def _run_lane(lane: list, fn, on_skip):
+    for i, item in enumerate(lane):
+        if fn(item) is False:
+            for skipped in lane[i + 1:]:
+                if on_skip:
+                    on_skip(skipped)
+            return
+
+
+def extend_lock(job: Job, visibility_timeout: int = JOB_VISIBILITY_TIMEOUT) -> bool:
+    """
+    開始執行前重新計算鎖定時間：同一 lane 的工作在同一次 claim 取得相同的 locked_until，
+    排在後面的要等前面的做完，輪到它時鎖可能已經快到期 (甚至過期)。
+    鎖還剩一半以上時不必寫入；回傳 False 表示鎖已過期並被其他 worker 取走，不要執行。
+    """
+    now = timezone.now()
+    if job.locked_until and job.locked_until - now > timedelta(seconds=visibility_timeout / 2):
+        return True
+    locked_until = now + timedelta(seconds=visibility_timeout)
+    updated = Job.objects.filter(
+        pk=job.pk, status=Job.STATUS_RUNNING, attempts=job.attempts, locked_until=job.locked_until
+    ).update(locked_until=locked_until)
+    if updated:
+        job.locked_until = locked_until
+    return bool(updated)
+
+
+def complete(job: Job, result=None):
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.STATUS_DONE, locked_until=None, last_error="", result=result, updated_at=timezone.now()
+    )
+
+
+def release(job: Job):
+    """
+    歸還已取出但尚未執行的工作 (不計入嘗試次數)；鎖已被其他 worker 重新取走的工作不動
+    """
+    Job.objects.filter(
+        pk=job.pk, status=Job.STATUS_RUNNING, attempts=job.attempts, locked_until=job.locked_until
+    ).update(
+        status=Job.STATUS_PENDING, locked_until=None, attempts=F("attempts") - 1, updated_at=timezone.now()
+    )
+
+
+def retry_or_fail(job: Job, error: Exception, max_attempts: int = JOB_MAX_ATTEMPTS) -> bool:
+    """
+    失敗時依指數退避重新排入佇列，超過次數或為永久錯誤則標記失敗。
+    回傳 True 表示已排入重試。
+    """
+    now = timezone.now()
+    message = f"{type(error).__name__}: {error}"[:2000]
+
+    if isinstance(error, PermanentJobError) or job.attempts >= max_attempts:
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.STATUS_FAILED, locked_until=None, last_error=message, updated_at=now
+        )
+        return False
+
+    delay = min(JOB_RETRY_BASE_DELAY * (2 ** (job.attempts - 1)), JOB_RETRY_MAX_DELAY)
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.STATUS_PENDING,
+        available_at=now + timedelta(seconds=delay),
+        locked_until=None,
+        last_error=message,
+        updated_at=now,
+    )
+    return True
+
+
+def purge_finished(retention_hours: int = JOB_RETENTION_HOURS) -> int:
+    """
+    刪除超過保留時間的已完成工作，避免資料表無限成長
+    """
+    cutoff = timezone.now() - timedelta(hours=retention_hours)
+    deleted, _ = Job.objects.filter(status=Job.STATUS_DONE, updated_at__lt=cutoff).delete()
+    return deleted
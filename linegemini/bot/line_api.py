@@ -0,0 +1,289 @@
+import asyncio
+import json
+import os
+import threading
+import uuid
+import weakref
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# LINE Messaging API 設定 (可用環境變數調整)
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me")
+# 下載使用者傳來的圖片等內容用另一個網域
+LINE_DATA_API_BASE_URL = os.getenv("LINE_DATA_API_BASE_URL", "https://api-data.line.me")
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", "10"))
+LINE_HTTP_MAX_RETRIES = int(os.getenv("LINE_HTTP_MAX_RETRIES", "3"))
+LINE_HTTP_BACKOFF = float(os.getenv("LINE_HTTP_BACKOFF", "0.5"))
+LINE_HTTP_TIMEOUT = float(os.getenv("LINE_HTTP_TIMEOUT", "30"))
+
+# 會自動重試的狀態碼 (與同步 client 的 urllib3 Retry 相同)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 純文字訊息上限 5000 字，保留一點緩衝
+TEXT_MESSAGE_LIMIT = 4900
+# 一次 multicast 最多 500 位使用者
+MULTICAST_LIMIT = 500
+# 下載內容時每次讀取的大小
+CONTENT_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(obj) -> bytes:
+    """
+    精簡的 JSON 序列化 (不跳脫中文、不加空白)，payload 大約可以小三成以上
+    """
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_payload(payload: dict) -> bytes:
+    """
+    序列化 API payload；messages 中已序列化好的訊息 (有 to_json()，例如 FlexMessage)
+    直接把 bytes 拼進去，不再轉回 dict
+    """
+    messages = payload.get("messages")
+    if not messages or not any(hasattr(m, "to_json") for m in messages):
+        return dumps(payload)
+    head = dumps({k: v for k, v in payload.items() if k != "messages"})
+    parts = b",".join(m.to_json() if hasattr(m, "to_json") else dumps(m) for m in messages)
+    return head[:-1] + (b"," if len(head) > 2 else b"") + b'"messages":[' + parts + b"]}"
+
+
+def to_messages(message) -> list:
+    """
+    將 get_gemini_response 等函式的回傳值轉成 LINE messages 陣列
+    """
+    if isinstance(message, list):
+        return message
+    if hasattr(message, "to_json") or (isinstance(message, dict) and message.get("type")):
+        return [message]
+    return [{"type": "text", "text": str(message)[:TEXT_MESSAGE_LIMIT]}]
+
+
+class LineClient:
+    """
+    共用的 LINE Messaging API client：
+    - keep-alive 的 requests.Session，連線池大小有上限，不必每次重新做 TLS 握手
+    - 429/5xx 自動重試並依指數退避，429/503 會遵守 Retry-After
+    - push/multicast 帶 X-Line-Retry-Key，重試時 LINE 不會重複發送
+    """
+
+    def __init__(self, token: str, base_url: str = LINE_API_BASE_URL,
+                 pool_size: int = LINE_HTTP_POOL_SIZE, max_retries: int = LINE_HTTP_MAX_RETRIES,
+                 backoff: float = LINE_HTTP_BACKOFF, timeout: float = LINE_HTTP_TIMEOUT,
+                 data_base_url: str = LINE_DATA_API_BASE_URL):
+        if not token:
+            print("CRITICAL ERROR: LINE_CHANNEL_ACCESS_TOKEN is not set in environment variables!")
+        self.base_url = base_url.rstrip("/")
+        self.data_base_url = data_base_url.rstrip("/")
+        self.timeout = timeout
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        })
+
+    def post(self, path: str, payload, timeout: float = None, retry_key: str = None) -> requests.Response:
+        """
+        送出 POST；payload 可以是 dict 或已序列化好的 bytes
+        """
+        body = payload if isinstance(payload, bytes) else encode_payload(payload)
+        headers = {"X-Line-Retry-Key": retry_key} if retry_key else None
+        r = self.session.post(f"{self.base_url}{path}", data=body, headers=headers,
+                              timeout=timeout or self.timeout)
+        r.raise_for_status()
+        return r
+
+    def reply(self, reply_token: str, messages: list) -> requests.Response:
+        return self.post("/v2/bot/message/reply", {"replyToken": reply_token, "messages": messages})
+
+    def push(self, to: str, messages: list, retry_key: str = None) -> requests.Response:
+        return self.post("/v2/bot/message/push", {"to": to, "messages": messages},
+                         retry_key=retry_key or str(uuid.uuid4()))
+
+    def multicast(self, to: list, messages: list, retry_key: str = None) -> requests.Response:
+        if len(to) > MULTICAST_LIMIT:
+            raise ValueError(f"multicast supports at most {MULTICAST_LIMIT} recipients, got {len(to)}")
+        return self.post("/v2/bot/message/multicast", {"to": to, "messages": messages},
+                         retry_key=retry_key or str(uuid.uuid4()))
+
+    def show_loading(self, chat_id: str, loading_seconds: int = 20) -> requests.Response:
+        return self.post("/v2/bot/chat/loading/start",
+                         {"chatId": chat_id, "loadingSeconds": loading_seconds}, timeout=10)
+
+    def bot_info(self) -> dict:
+        """
+        取得 bot 基本資料；開機預熱時用來先建立好 TLS 連線
+        """
+        r = self.session.get(f"{self.base_url}/v2/bot/info", timeout=10)
+        r.raise_for_status()
+        return r.json()
+
+    def iter_content(self, message_id: str, chunk_size: int = CONTENT_CHUNK_SIZE):
+        """
+        以串流下載使用者傳來的圖片等內容，逐段產生 bytes (不會把整個檔案讀進記憶體)
+        """
+        with self.session.get(f"{self.data_base_url}/v2/bot/message/{message_id}/content",
+                              stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            yield from r.iter_content(chunk_size)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_line_client() -> LineClient:
+    """
+    取得整個 process 共用的 LineClient (第一次呼叫時才建立)
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LineClient(os.getenv("LINE_CHANNEL_ACCESS_TOKEN", ""))
+    return _client
+
+
+class AsyncLineClient:
+    """
+    LineClient 的 async 版本 (httpx.AsyncClient)，給 ASGI view 與 async worker 使用：
+    等待 LINE 回應時不佔用執行緒，一個 process 可以同時處理數百個請求。
+    重試、Retry-After 與 X-Line-Retry-Key 的規則與 LineClient 相同。
+    """
+
+    def __init__(self, token: str, base_url: str = LINE_API_BASE_URL,
+                 pool_size: int = LINE_HTTP_POOL_SIZE, max_retries: int = LINE_HTTP_MAX_RETRIES,
+                 backoff: float = LINE_HTTP_BACKOFF, timeout: float = LINE_HTTP_TIMEOUT):
+        if not token:
+            print("CRITICAL ERROR: LINE_CHANNEL_ACCESS_TOKEN is not set in environment variables!")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        )
+
+    def _retry_delay(self, response: httpx.Response, attempt: int) -> float:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * (2 ** attempt)
+
+    async def post(self, path: str, payload, timeout: float = None, retry_key: str = None) -> httpx.Response:
+        body = payload if isinstance(payload, bytes) else encode_payload(payload)
+        headers = {"X-Line-Retry-Key": retry_key} if retry_key else None
+        for attempt in range(self.max_retries + 1):
+            r = await self.client.post(path, content=body, headers=headers,
+                                       timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+            if r.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                break
+            await asyncio.sleep(self._retry_delay(r, attempt))
+        r.raise_for_status()
+        return r
+
+    async def reply(self, reply_token: str, messages: list) -> httpx.Response:
+        return await self.post("/v2/bot/message/reply", {"replyToken": reply_token, "messages": messages})
+
+    async def push(self, to: str, messages: list, retry_key: str = None) -> httpx.Response:
+        return await self.post("/v2/bot/message/push", {"to": to, "messages": messages},
+                               retry_key=retry_key or str(uuid.uuid4()))
+
+    async def show_loading(self, chat_id: str, loading_seconds: int = 20) -> httpx.Response:
+        return await self.post("/v2/bot/chat/loading/start",
+                               {"chatId": chat_id, "loadingSeconds": loading_seconds}, timeout=10)
+
+    async def bot_info(self) -> dict:
+        r = await self.client.get("/v2/bot/info", timeout=10)
+        r.raise_for_status()
+        return r.json()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# httpx 的連線綁定在建立它的 event loop 上：只有長期存在的 loop (uvicorn、run_worker --async) 各自共用一個 client
+_async_clients = weakref.WeakKeyDictionary()
+_long_lived_loops = weakref.WeakSet()
+
+
+def mark_long_lived_loop():
+    """
+    標記目前的 event loop 會一直存在 (ASGI application 與 async worker 啟動時呼叫)，
+    之後 get_async_line_client 在這個 loop 上共用同一個 AsyncLineClient
+    """
+    _long_lived_loops.add(asyncio.get_running_loop())
+
+
+class ThreadedLineClient:
+    """
+    與 AsyncLineClient 相同介面，但在執行緒中呼叫共用的同步 LineClient。
+    WSGI / runserver (async_to_sync)、測試等情況每個請求都是新的 event loop，
+    若各建一個 httpx.AsyncClient 既無法重複使用連線，loop 結束後也沒人關閉。
+    """
+
+    async def _call(self, name: str, *args, **kwargs):
+        return await sync_to_async(getattr(get_line_client(), name), thread_sensitive=False)(*args, **kwargs)
+
+    async def post(self, path: str, payload, timeout: float = None, retry_key: str = None):
+        return await self._call("post", path, payload, timeout=timeout, retry_key=retry_key)
+
+    async def reply(self, reply_token: str, messages: list):
+        return await self._call("reply", reply_token, messages)
+
+    async def push(self, to: str, messages: list, retry_key: str = None):
+        return await self._call("push", to, messages, retry_key=retry_key)
+
+    async def show_loading(self, chat_id: str, loading_seconds: int = 20):
+        return await self._call("show_loading", chat_id, loading_seconds)
+
+    async def bot_info(self) -> dict:
+        return await self._call("bot_info")
+
+    async def aclose(self):
+        pass
+
+
+_threaded_client = ThreadedLineClient()
+
+
+def get_async_line_client():
+    """
+    取得目前 event loop 共用的 AsyncLineClient (uvicorn / async worker 整個 process 只有一個 loop)；
+    不是長期存在的 loop 時改用 ThreadedLineClient
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _long_lived_loops:
+        return _threaded_client
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncLineClient(os.getenv("LINE_CHANNEL_ACCESS_TOKEN", ""))
+    return client
+
+
+async def close_async_line_client():
+    """
+    關閉目前 event loop 的 AsyncLineClient (async worker 結束時呼叫)
+    """
+    loop = asyncio.get_running_loop()
+    _long_lived_loops.discard(loop)
+    client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
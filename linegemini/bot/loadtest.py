@@ -0,0 +1,224 @@
+"""
+離線壓力測試用的替身 (bench_load 使用)：
+- 假的上游伺服器：同時扮演 LINE Messaging API 與 Gemini API (可設定延遲、逐段串流與 Function Calling 比例)
+- 簽章正確的 webhook payload 產生器 (與 verify_line_signature 相同的 HMAC-SHA256)
+"""
+import asyncio
+import base64
+import io
+import json
+import time
+import urllib.parse
+
+from .views import line_signature
+
+# 假 Gemini 的對話回覆 (串流時逐字送出)
+FAKE_REPLY = "您好！我們最近有幾場活動，歡迎參考工作室的活動列表，也可以直接告訴我想找哪一類活動。"
+FAKE_TOOL = "get_recent_activities"
+
+
+def text_events(count: int, run_id: str = "bench", users: int = None, start: int = 0) -> list:
+    """
+    產生 count 則文字訊息事件；users 為 None 時每則來自不同使用者，
+    每則都有不同的 webhookEventId (不會被重送去重擋下)
+    """
+    events = []
+    for i in range(start, start + count):
+        user = i if users is None else i % users
+        events.append({
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "webhookEventId": f"{run_id}-{i}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"{run_id}-reply-{i}",
+            "source": {"type": "user", "userId": f"U{run_id}{user}"},
+            "message": {"id": str(i), "type": "text", "text": f"第 {i} 個問題：最近有什麼活動？"},
+        })
+    return events
+
+
+def signed_webhook(events: list, secret: str, destination: str = "Ubench") -> tuple:
+    """
+    回傳 (request body, X-Line-Signature)
+    """
+    body = json.dumps({"destination": destination, "events": events}, ensure_ascii=False).encode("utf-8")
+    return body, line_signature(body, secret)
+
+
+def percentiles(samples: list, points=(50, 95, 99)) -> dict:
+    """
+    以 nearest-rank 計算百分位數，回傳 {50: p50, 95: p95, 99: p99} (沒有樣本時為 None)
+    """
+    if not samples:
+        return {p: None for p in points}
+    ordered = sorted(samples)
+    return {p: ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))] for p in points}
+
+
+def _png(size: int = 512) -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        # 沒有 Pillow 時回傳 1x1 PNG
+        return base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+    buf = io.BytesIO()
+    Image.new("RGB", (size, size), (240, 120, 40)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class FakeUpstream:
+    """
+    假的 LINE 與 Gemini API：
+        LINE   POST /v2/bot/message/{reply,push,multicast}、/v2/bot/chat/loading/start、GET /v2/bot/info、
+               GET /v2/bot/message/<id>/content (使用者傳來的照片)
+        Gemini POST /v1beta/models/<model>:generateContent、:streamGenerateContent、GET /v1beta/models/<model>
+        備援圖 GET /fallback/<prompt>
+        統計   GET /__stats (各路徑次數、最後一次 LINE reply 的時間、Gemini 同時處理的最大數)
+    """
+
+    def __init__(self, line_ms: float = 30, gemini_ms: float = 800, token_ms: float = 20,
+                 image_ms: float = 2000, function_call_ratio: float = 0.2, image_model: str = ""):
+        self.line_delay = line_ms / 1000
+        self.gemini_delay = gemini_ms / 1000
+        self.token_delay = token_ms / 1000
+        self.image_delay = image_ms / 1000
+        self.function_call_ratio = function_call_ratio
+        self.image_model = image_model
+        self.counts = {}
+        self.last_reply_at = None
+        self.inflight = 0
+        self.peak_inflight = 0
+        self._chat_requests = 0
+        self._image = base64.b64encode(_png()).decode()
+
+    def _count(self, name: str):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _wants_tool(self) -> bool:
+        # 每 1/ratio 則回覆中固定有一則是 Function Call (可重現)
+        self._chat_requests += 1
+        n, ratio = self._chat_requests, self.function_call_ratio
+        return int(n * ratio) != int((n - 1) * ratio)
+
+    def _chat_parts(self, tool: bool) -> list:
+        if tool:
+            return [{"functionCall": {"name": FAKE_TOOL, "args": {}}}]
+        return [{"text": FAKE_REPLY}]
+
+    @staticmethod
+    def _candidate(parts: list) -> dict:
+        return {"candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP", "index": 0}],
+                "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 10, "totalTokenCount": 20}}
+
+    async def route(self, method: str, path: str, writer):
+        """
+        回傳 (status, JSON 或 bytes, content type)；串流回應直接寫入 writer 後回傳 None
+        """
+        path, _, _ = path.partition("?")
+        if path.startswith("/v2/bot/"):
+            return await self._line(method, path)
+        if path.startswith("/v1beta/models/"):
+            return await self._gemini(method, path[len("/v1beta/models/"):], writer)
+        if path.startswith("/fallback/"):
+            self._count("fallback")
+            await asyncio.sleep(self.image_delay)
+            return 200, base64.b64decode(self._image), "image/png"
+        if path == "/__stats":
+            return 200, {"counts": self.counts, "last_reply_at": self.last_reply_at,
+                         "peak_gemini_inflight": self.peak_inflight}, "application/json"
+        return 404, {"message": "not found"}, "application/json"
+
+    async def _line(self, method: str, path: str):
+        if path.endswith("/content"):
+            self._count("line.content")
+            await asyncio.sleep(self.line_delay)
+            return 200, base64.b64decode(self._image), "image/png"
+        name = "line." + path[len("/v2/bot/"):].replace("/", ".")
+        self._count(name)
+        await asyncio.sleep(self.line_delay)
+        if name == "line.message.reply":
+            self.last_reply_at = time.time()
+        if name == "line.info":
+            return 200, {"userId": "Ubench", "basicId": "@bench", "displayName": "bench"}, "application/json"
+        return 200, {}, "application/json"
+
+    async def _gemini(self, method: str, target: str, writer):
+        model, _, action = urllib.parse.unquote(target).partition(":")
+        if method == "GET":
+            self._count("gemini.get")
+            return 200, {"name": f"models/{model}", "displayName": model}, "application/json"
+
+        image = model == self.image_model
+        self._count(f"gemini.{'image' if image else 'chat'}.{action}")
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            if image:
+                await asyncio.sleep(self.image_delay)
+                parts = [{"inlineData": {"mimeType": "image/png", "data": self._image}}]
+            else:
+                await asyncio.sleep(self.gemini_delay)
+                parts = self._chat_parts(self._wants_tool())
+
+            if action != "streamGenerateContent":
+                return 200, self._candidate(parts), "application/json"
+
+            # Server-Sent Events (chunked)：文字逐字送出，每段之間延遲 token_ms
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n")
+            chunks = list(parts[0]["text"]) if "text" in parts[0] else [None]
+            for i, token in enumerate(chunks):
+                if i and self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+                event = self._candidate(parts if token is None else [{"text": token}])
+                data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+                writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return None
+        finally:
+            self.inflight -= 1
+
+    async def handle(self, reader, writer):
+        # 極簡的 HTTP/1.1 keep-alive 伺服器
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", 0)))
+
+                result = await self.route(method, path, writer)
+                if result is None:
+                    continue
+                status, body, content_type = result
+                if not isinstance(body, bytes):
+                    body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                             + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(options: dict, port_queue):
+    """
+    在獨立的 process 裡執行假的上游伺服器 (multiprocessing.Process 的 target)，啟動後把 port 放進 port_queue
+    """
+    upstream = FakeUpstream(**options)
+
+    async def main():
+        server = await asyncio.start_server(upstream.handle, "127.0.0.1", 0, backlog=1024)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from bot.models import Activity
+from bot.search import ActivityIndex
+
+CITIES = ["台北", "新北", "桃園", "台中", "台南", "高雄", "花蓮", "台東", "宜蘭", "澎湖", "金門", "南投"]
+KINDS = ["馬拉松", "跨年晚會", "科技展", "花火節", "燈會", "音樂祭", "美食節", "市集", "路跑", "藝術展",
+         "動漫展", "咖啡節", "啤酒節", "書展", "電影節", "親子營", "攝影展", "單車賽", "龍舟賽", "文化祭"]
+
+
+class Command(BaseCommand):
+    help = "在暫存測試資料庫中比較 icontains 查詢與記憶體 bigram 索引的活動搜尋速度"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=5000, help="活動筆數")
+        parser.add_argument("--queries", type=int, default=500)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self._run(options["count"], options["queries"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _run(self, count, queries):
+        rng = random.Random(42)
+        today = date.today()
+        Activity.objects.bulk_create([
+            Activity(
+                name=f"{rng.choice(CITIES)}{rng.choice(KINDS)}{i}",
+                end_date=today + timedelta(days=rng.randint(0, 365)),
+                location=rng.choice(CITIES),
+                description="benchmark",
+            )
+            for i in range(count)
+        ], batch_size=1000)
+
+        started = time.perf_counter()
+        index = ActivityIndex()
+        index.rebuild(Activity.objects.values_list("pk", "name", "location").iterator())
+        build = time.perf_counter() - started
+
+        names = list(Activity.objects.values_list("name", flat=True))
+        terms = [rng.choice(names) for _ in range(queries)]
+
+        db_times, index_times, agree = [], [], 0
+        for term in terms:
+            started = time.perf_counter()
+            db_hit = Activity.objects.filter(name__icontains=term).first()
+            db_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            results = index.search(term, limit=1)
+            index_times.append(time.perf_counter() - started)
+            agree += bool(results and db_hit and results[0][2] == db_hit.name)
+
+        # 原本 icontains 找不到的變體寫法
+        variants = [f"{t}活動" for t in terms[:100]]
+        db_found = sum(Activity.objects.filter(name__icontains=v).exists() for v in variants)
+        index_found = sum(bool(index.search(v, limit=1, min_score=0.3)) for v in variants)
+
+        self.stdout.write(f"activities={count} queries={queries} index build={build * 1000:.1f} ms")
+        self.stdout.write(self._format("icontains (SQLite scan)", db_times))
+        self.stdout.write(self._format("bigram index (memory)", index_times))
+        self.stdout.write(f"same top result for exact names: {agree}/{queries}")
+        self.stdout.write(f"'<name>活動' variants found: icontains {db_found}/100, index {index_found}/100")
+
+    def _format(self, label, samples):
+        samples = sorted(samples)
+        p95 = samples[int(len(samples) * 0.95) - 1]
+        return (f"{label:26s} mean={statistics.mean(samples) * 1000:7.3f} ms "
+                f"p50={statistics.median(samples) * 1000:7.3f} ms p95={p95 * 1000:7.3f} ms")
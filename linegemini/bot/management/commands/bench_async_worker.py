@@ -0,0 +1,164 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from bot import gemini, jobs
+from bot.line_api import AsyncLineClient, LineClient
+from bot.models import Job
+
+
+async def _stub_connection(reader, writer, delay):
+    # 極簡的 HTTP/1.1 keep-alive 伺服器：讀完請求後延遲 delay 秒回 200 {}
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _serve_stub(delay, port_queue):
+    async def main():
+        server = await asyncio.start_server(lambda r, w: _stub_connection(r, w, delay), "127.0.0.1", 0,
+                                            backlog=1024)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+class _FakeReply:
+    function_calls = None
+
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeGemini:
+    """
+    模擬 Gemini：固定延遲後回覆，並記錄同時進行中的對話數
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.inflight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self.models = self
+        self.aio = mock.Mock(models=mock.Mock(generate_content=self.agenerate_content))
+
+    def _enter(self):
+        with self._lock:
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+
+    def _exit(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def generate_content(self, **kwargs):
+        self._enter()
+        time.sleep(self.delay)
+        self._exit()
+        return _FakeReply("好的")
+
+    async def agenerate_content(self, **kwargs):
+        self._enter()
+        await asyncio.sleep(self.delay)
+        self._exit()
+        return _FakeReply("好的")
+
+
+class Command(BaseCommand):
+    help = "以本機 LINE stub 與假的 Gemini 比較 thread worker 與 async worker 同時處理的對話數與總時間"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=500, help="webhook 事件數 (每則來自不同使用者)")
+        parser.add_argument("--gemini-ms", type=float, default=800.0, help="假 Gemini 的回覆延遲")
+        parser.add_argument("--line-ms", type=float, default=30.0, help="LINE stub 每個請求的延遲")
+        parser.add_argument("--threads", type=int, default=8, help="thread worker 的 --concurrency")
+        parser.add_argument("--async-concurrency", type=int, default=500)
+        parser.add_argument("--modes", default="threads,async", help="要比較的模式，以逗號分隔")
+
+    def handle(self, *args, **options):
+        # LINE stub 是另一個 process 裡的 asyncio 伺服器，本身不會成為瓶頸，也不與 worker 搶 GIL
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve_stub, args=(options["line_ms"] / 1000, port_queue),
+                                         daemon=True)
+        server.start()
+        self.base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+        setup_test_environment()
+        # 用實體檔案 (WAL + 等待鎖) 而不是記憶體資料庫，多執行緒寫入的行為才與正式環境相同
+        tmp_dir = tempfile.mkdtemp()
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(tmp_dir, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            modes = {"threads": ["--concurrency", str(options["threads"])],
+                     "async": ["--async", "--concurrency", str(options["async_concurrency"])]}
+            self.stdout.write(f"events={options['events']} gemini={options['gemini_ms']}ms "
+                              f"line={options['line_ms']}ms")
+            for name in options["modes"].split(","):
+                elapsed, peak = self._run(options, modes[name])
+                self.stdout.write(f"{name:8s} elapsed={elapsed:7.2f}s  peak in-flight={peak:4d}  "
+                                  f"throughput={options['events'] / elapsed:7.1f} events/s")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            server.terminate()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _run(self, options, args):
+        Job.objects.all().delete()
+        events = [
+            {"type": "message", "replyToken": f"r{i}", "source": {"userId": f"U{i}"},
+             "message": {"type": "text", "text": f"第 {i} 個問題"}}
+            for i in range(options["events"])
+        ]
+        jobs.enqueue_line_events(events)
+
+        fake = _FakeGemini(options["gemini_ms"] / 1000)
+        sync_client = LineClient("t", base_url=self.base_url, pool_size=options["threads"])
+        with mock.patch.object(gemini, "get_client", return_value=fake), \
+                mock.patch("bot.ai_reply.GEMINI_API_KEY", "bench"), \
+                mock.patch("bot.conversations.CONVERSATION_ENABLED", False), \
+                mock.patch("bot.ai_reply.reply_cache.REPLY_CACHE_ENABLED", False), \
+                mock.patch("bot.views.get_line_client", return_value=sync_client), \
+                mock.patch("bot.views.get_async_line_client", side_effect=self._async_client):
+            started = time.perf_counter()
+            call_command("run_worker", "--once", "--poll-interval", "0.01", *args, stdout=mock.MagicMock())
+            elapsed = time.perf_counter() - started
+
+        done = Job.objects.filter(status=Job.STATUS_DONE).count()
+        if done != options["events"]:
+            self.stderr.write(f"only {done}/{options['events']} jobs completed")
+        return elapsed, fake.peak
+
+    def _async_client(self):
+        # 與 get_async_line_client 相同：每個 event loop 共用一個 client
+        loop = asyncio.get_running_loop()
+        client = getattr(loop, "_bench_line_client", None)
+        if client is None:
+            client = loop._bench_line_client = AsyncLineClient("t", base_url=self.base_url)
+        return client
@@ -0,0 +1,57 @@
+import json
+import time
+from datetime import date, datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from bot import flex
+from bot.line_api import encode_payload
+from bot.models import Activity
+
+
+def _legacy_payload(activities):
+    # 舊流程：每次請求手寫 bubble dict，再由 requests 的 json= 序列化整個 payload
+    bubbles = [flex.activity_bubble(a) for a in activities]
+    message = {"type": "flex", "altText": "最近活動列表", "contents": {"type": "carousel", "contents": bubbles}}
+    return json.dumps({"replyToken": "r" * 32, "messages": [message]}).encode("utf-8")
+
+
+def _cached_payload(activities):
+    message = flex.activity_carousel(activities)
+    return encode_payload({"replyToken": "r" * 32, "messages": [message]})
+
+
+class Command(BaseCommand):
+    help = "比較每次重建 Flex 輪播與拼接快取 bubble JSON 的建構時間"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bubbles", type=int, default=10)
+        parser.add_argument("--iterations", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        updated = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        activities = [
+            Activity(pk=i + 1, name=f"台北馬拉松 {i}", end_date=date(2026, 12, 20), location="台北市政府廣場",
+                     description="一年一度的城市路跑活動，歡迎全家大小一起參加！" * 2,
+                     image_url=f"https://example.com/{i}.jpg", activity_link=f"https://example.com/{i}",
+                     updated_at=updated)
+            for i in range(options["bubbles"])
+        ]
+        flex.clear()
+        _cached_payload(activities)  # 暖快取
+
+        assert json.loads(_legacy_payload(activities)) == json.loads(_cached_payload(activities))
+
+        n = options["iterations"]
+        results = {}
+        for label, fn in (("rebuild dict + json.dumps", _legacy_payload), ("splice cached bubbles", _cached_payload)):
+            started = time.perf_counter()
+            for _ in range(n):
+                body = fn(activities)
+            results[label] = ((time.perf_counter() - started) / n, len(body))
+
+        self.stdout.write(f"{options['bubbles']}-bubble carousel, {n} iterations")
+        for label, (seconds, size) in results.items():
+            self.stdout.write(f"{label:28s} {seconds * 1e6:8.1f} us/payload  {size} bytes")
+        before, after = (r[0] for r in results.values())
+        self.stdout.write(f"saved {(before - after) * 1e6:.1f} us per carousel ({before / after:.1f}x faster)")
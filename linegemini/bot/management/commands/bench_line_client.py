@@ -0,0 +1,85 @@
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from bot.line_api import LineClient
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支援 keep-alive
+    disable_nagle_algorithm = True  # 否則 header 與 body 分開送出時會卡 delayed ACK
+    connect_delay = 0.0
+
+    def setup(self):
+        # 模擬每條新連線的 TCP/TLS 握手往返時間
+        time.sleep(self.connect_delay)
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "對本機 LINE API stub 比較每次新連線的 requests.post 與共用連線池的 LineClient 延遲"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=300)
+        parser.add_argument("--connect-delay-ms", type=float, default=20.0,
+                            help="stub 對每條新連線加的延遲，模擬到 api.line.me 的握手時間")
+
+    def handle(self, *args, **options):
+        _StubHandler.connect_delay = options["connect_delay_ms"] / 1000
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        payload = {"replyToken": "x" * 32, "messages": [{"type": "text", "text": "哈囉" * 50}]}
+        calls = options["calls"]
+
+        def per_call():
+            # 舊寫法：每次重建 header 並開新連線
+            r = requests.post(f"{base_url}/v2/bot/message/reply",
+                              headers={"Authorization": "Bearer t", "Content-Type": "application/json"},
+                              json=payload, timeout=30)
+            r.raise_for_status()
+
+        client = LineClient("t", base_url=base_url)
+
+        try:
+            before = self._measure(per_call, calls)
+            after = self._measure(lambda: client.reply(payload["replyToken"], payload["messages"]), calls)
+        finally:
+            server.shutdown()
+
+        self.stdout.write(f"calls={calls} connect_delay={options['connect_delay_ms']}ms")
+        self.stdout.write(self._format("requests.post (new connection)", before))
+        self.stdout.write(self._format("LineClient (pooled keep-alive)", after))
+        saved = statistics.mean(before) - statistics.mean(after)
+        self.stdout.write(f"saved per call: {saved * 1000:.2f} ms")
+
+    def _measure(self, fn, calls):
+        fn()  # 暖身
+        samples = []
+        for _ in range(calls):
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    def _format(self, label, samples):
+        samples = sorted(samples)
+        p95 = samples[int(len(samples) * 0.95) - 1]
+        return (f"{label:34s} mean={statistics.mean(samples) * 1000:7.2f} ms "
+                f"p50={statistics.median(samples) * 1000:7.2f} ms p95={p95 * 1000:7.2f} ms")
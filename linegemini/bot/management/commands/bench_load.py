@@ -0,0 +1,303 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bot import gemini, loadtest
+
+BENCH_SECRET = "bench-secret"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _ms(value) -> str:
+    return "   n/a" if value is None else f"{value * 1000:6.1f}"
+
+
+class Command(BaseCommand):
+    help = ("離線壓力測試：以本機的假 LINE / Gemini 伺服器啟動完整的 web (gunicorn) 與 worker，"
+            "送出簽章正確的 webhook，回報 webhook 延遲 p50/p95/p99、每秒處理的事件數與每分鐘完成的生圖數")
+
+    def add_arguments(self, parser):
+        # 負載
+        parser.add_argument("--events", type=int, default=500, help="webhook 事件數")
+        parser.add_argument("--batch", type=int, default=1, help="每個 webhook request 帶幾則事件")
+        parser.add_argument("--users", type=int, default=None, help="使用者數 (預設每則事件不同使用者)")
+        parser.add_argument("--concurrency", type=int, default=50, help="同時送出的 webhook request 數")
+        parser.add_argument("--rate", type=float, default=0, help="每秒送出的 request 數 (0 = 盡量快)")
+        parser.add_argument("--images", type=int, default=10, help="LIFF 生圖工作數 (0 = 不測)")
+        parser.add_argument("--chats", type=int, default=0, help="LIFF 串流聊天數 (量測第一段文字的時間)")
+        parser.add_argument("--timeout", type=float, default=300, help="等待 worker 處理完的最長秒數")
+        # 伺服器設定
+        parser.add_argument("--web-workers", type=int, default=2, help="gunicorn worker 數")
+        parser.add_argument("--worker-mode", choices=["async", "threads"], default="async")
+        parser.add_argument("--worker-concurrency", type=int, default=200)
+        parser.add_argument("--worker-processes", type=int, default=1, help="webhook 事件 worker 的 process 數")
+        parser.add_argument("--image-concurrency", type=int, default=2)
+        parser.add_argument("--rate-limit", action="store_true",
+                            help="保留 Gemini 限流 (預設關閉，量測的是處理能力而不是配額)")
+        parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                            help="傳給 web 與 worker 的額外環境變數 (可重複)")
+        # 假的上游服務
+        parser.add_argument("--line-ms", type=float, default=30.0, help="假 LINE API 每個請求的延遲")
+        parser.add_argument("--gemini-ms", type=float, default=800.0, help="假 Gemini 對話回覆的延遲")
+        parser.add_argument("--token-ms", type=float, default=20.0, help="串流時每段文字之間的延遲")
+        parser.add_argument("--image-ms", type=float, default=2000.0, help="假 Gemini 生圖的延遲")
+        parser.add_argument("--function-call-ratio", type=float, default=0.2,
+                            help="回覆 Function Call (工具) 而不是文字的比例")
+        parser.add_argument("--json", dest="json_path", help="另外把結果寫成 JSON 檔")
+        parser.add_argument("--keep", action="store_true", help="保留暫存目錄 (資料庫與各 process 的 log)")
+
+    def handle(self, *args, **options):
+        self.processes = []
+        self.tmp_dir = tempfile.mkdtemp(prefix="bench_load_")
+        try:
+            self.upstream_url = self._start_upstream(options)
+            self.env = self._environment(options)
+            self._migrate()
+            self.web_url = self._start_web(options)
+            self._start_workers(options)
+            results = asyncio.run(self._drive(options))
+        finally:
+            for process in reversed(self.processes):
+                process.terminate()
+            for process in self.processes:
+                try:
+                    process.wait(timeout=10) if isinstance(process, subprocess.Popen) else process.join(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if options["keep"]:
+                self.stdout.write(f"logs: {self.tmp_dir}")
+            else:
+                shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+        self._report(options, results)
+        if options["json_path"]:
+            with open(options["json_path"], "w") as f:
+                json.dump(results, f, indent=2)
+
+    # ---- 啟動 ----
+
+    def _start_upstream(self, options) -> str:
+        port_queue = multiprocessing.Queue()
+        upstream_options = {
+            "line_ms": options["line_ms"], "gemini_ms": options["gemini_ms"], "token_ms": options["token_ms"],
+            "image_ms": options["image_ms"], "function_call_ratio": options["function_call_ratio"],
+            "image_model": gemini.IMAGE_MODEL,
+        }
+        process = multiprocessing.Process(target=loadtest.serve, args=(upstream_options, port_queue), daemon=True)
+        process.start()
+        self.processes.append(process)
+        return f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    def _environment(self, options) -> dict:
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE="linegemini.settings",
+            DATABASE_PATH=os.path.join(self.tmp_dir, "bench.sqlite3"),
+            MEDIA_ROOT=os.path.join(self.tmp_dir, "media"),
+            BOT_STATE_DIR=os.path.join(self.tmp_dir, "var"),
+            LINE_API_BASE_URL=self.upstream_url,
+            LINE_DATA_API_BASE_URL=self.upstream_url,
+            LINE_CHANNEL_ACCESS_TOKEN="bench",
+            LINE_CHANNEL_SECRET=BENCH_SECRET,
+            GEMINI_API_KEY="bench",
+            GEMINI_BASE_URL=self.upstream_url,
+            FALLBACK_IMAGE_URL=self.upstream_url + "/fallback/{prompt}",
+            IMAGE_JOB_CONCURRENCY=str(options["image_concurrency"]),
+            PYTHONUNBUFFERED="1",
+        )
+        if not options["rate_limit"]:
+            env["RATE_LIMIT_ENABLED"] = "0"
+        for item in options["env"]:
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError(f"--env expects KEY=VALUE, got {item!r}")
+            env[key] = value
+        return env
+
+    def _spawn(self, args: list, name: str):
+        log = open(os.path.join(self.tmp_dir, f"{name}.log"), "wb")
+        process = subprocess.Popen(args, cwd=settings.BASE_DIR, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def _migrate(self):
+        subprocess.run([sys.executable, "manage.py", "migrate", "--noinput"], cwd=settings.BASE_DIR, env=self.env,
+                       check=True, capture_output=True)
+
+    def _start_web(self, options) -> str:
+        port = _free_port()
+        self._spawn([sys.executable, "-m", "gunicorn", "linegemini.asgi:application",
+                     "-k", "uvicorn_worker.UvicornWorker", "--preload",
+                     "-w", str(options["web_workers"]), "-b", f"127.0.0.1:{port}"], "web")
+        url = f"http://127.0.0.1:{port}"
+        token = self.env.get("METRICS_TOKEN")
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            try:
+                if httpx.get(url + "/bot/healthz/warm", headers=headers, timeout=5).status_code == 200:
+                    return url
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise CommandError(f"web server did not start, see {self.tmp_dir}/web.log")
+
+    def _start_workers(self, options):
+        mode = ["--async"] if options["worker_mode"] == "async" else []
+        for i in range(options["worker_processes"]):
+            self._spawn([sys.executable, "manage.py", "run_worker", *mode,
+                         "--concurrency", str(options["worker_concurrency"])], f"worker{i}")
+        if options["images"]:
+            self._spawn([sys.executable, "manage.py", "run_worker", "--kind", "image",
+                         "--concurrency", str(options["image_concurrency"])], "image_worker")
+
+    # ---- 負載 ----
+
+    async def _drive(self, options) -> dict:
+        limits = httpx.Limits(max_connections=max(options["concurrency"], 10))
+        async with httpx.AsyncClient(base_url=self.web_url, limits=limits, timeout=60) as client:
+            results = {"webhook": await self._webhooks(client, options)}
+            if options["images"]:
+                results["images"] = await self._image_jobs(client, options)
+            if options["chats"]:
+                results["chats"] = await self._chat_streams(client, options)
+            results["upstream"] = (await client.get(self.upstream_url + "/__stats")).json()
+        return results
+
+    async def _upstream_replies(self, client) -> tuple:
+        stats = (await client.get(self.upstream_url + "/__stats")).json()
+        return stats["counts"].get("line.message.reply", 0), stats["last_reply_at"]
+
+    async def _webhooks(self, client, options) -> dict:
+        run_id = uuid.uuid4().hex[:8]
+        events = loadtest.text_events(options["events"], run_id=run_id, users=options["users"])
+        batch = max(1, options["batch"])
+        requests = [loadtest.signed_webhook(events[i:i + batch], BENCH_SECRET) for i in range(0, len(events), batch)]
+        baseline, _ = await self._upstream_replies(client)
+
+        latencies, errors = [], 0
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        started_wall, started = time.time(), time.perf_counter()
+
+        async def send(i, body, signature):
+            nonlocal errors
+            if options["rate"]:
+                await asyncio.sleep(max(0.0, started + i / options["rate"] - time.perf_counter()))
+            async with semaphore:
+                sent = time.perf_counter()
+                try:
+                    response = await client.post("/bot/webhook/", content=body, headers={
+                        "Content-Type": "application/json", "X-Line-Signature": signature})
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - sent)
+
+        await asyncio.gather(*(send(i, body, signature) for i, (body, signature) in enumerate(requests)))
+        send_seconds = time.perf_counter() - started
+
+        # 等 worker 把每則事件都回覆完 (假 LINE 收到的 reply 數)
+        deadline = time.monotonic() + options["timeout"]
+        replied, last_reply_at = 0, None
+        while time.monotonic() < deadline:
+            replied, last_reply_at = await self._upstream_replies(client)
+            replied -= baseline
+            if replied >= len(events):
+                break
+            await asyncio.sleep(0.2)
+        processing_seconds = (last_reply_at - started_wall) if replied and last_reply_at else None
+
+        p = loadtest.percentiles(latencies)
+        return {
+            "requests": len(requests), "events": len(events), "errors": errors, "replied": replied,
+            "p50": p[50], "p95": p[95], "p99": p[99],
+            "requests_per_second": len(requests) / send_seconds,
+            "events_per_second": replied / processing_seconds if processing_seconds else 0.0,
+        }
+
+    async def _image_jobs(self, client, options) -> dict:
+        run_id = uuid.uuid4().hex[:8]
+        started = time.perf_counter()
+        status_urls = []
+        for i in range(options["images"]):
+            response = await client.post("/bot/liff/generate/", json={"prompt": f"bench {run_id} image {i}"})
+            status_urls.append(response.json()["status_url"])
+
+        pending, done, failed = set(status_urls), 0, 0
+        deadline = time.monotonic() + options["timeout"]
+        while pending and time.monotonic() < deadline:
+            for url in list(pending):
+                status = (await client.get(url)).json()["status"]
+                if status in ("done", "failed"):
+                    pending.discard(url)
+                    done += status == "done"
+                    failed += status == "failed"
+            if pending:
+                await asyncio.sleep(0.2)
+        elapsed = time.perf_counter() - started
+        return {"jobs": len(status_urls), "done": done, "failed": failed, "unfinished": len(pending),
+                "seconds": elapsed, "jobs_per_minute": done / elapsed * 60}
+
+    async def _chat_streams(self, client, options) -> dict:
+        first, total = [], []
+        semaphore = asyncio.Semaphore(options["concurrency"])
+
+        async def chat(i):
+            async with semaphore:
+                sent = time.perf_counter()
+                async with client.stream("GET", "/bot/liff/chat/",
+                                         params={"text": f"第 {i} 個問題", "userId": f"Uchat{i}"}) as response:
+                    async for line in response.aiter_lines():
+                        if line.startswith("event:") and not first_seen[i]:
+                            first_seen[i] = True
+                            first.append(time.perf_counter() - sent)
+                total.append(time.perf_counter() - sent)
+
+        first_seen = [False] * options["chats"]
+        await asyncio.gather(*(chat(i) for i in range(options["chats"])))
+        p_first, p_total = loadtest.percentiles(first), loadtest.percentiles(total)
+        return {"chats": options["chats"], "first_p50": p_first[50], "first_p95": p_first[95],
+                "total_p50": p_total[50], "total_p95": p_total[95]}
+
+    def _report(self, options, results):
+        webhook = results["webhook"]
+        self.stdout.write(
+            f"config: web-workers={options['web_workers']} worker={options['worker_mode']}"
+            f"x{options['worker_processes']} concurrency={options['worker_concurrency']} "
+            f"line={options['line_ms']:.0f}ms gemini={options['gemini_ms']:.0f}ms image={options['image_ms']:.0f}ms")
+        self.stdout.write(
+            f"webhook  requests={webhook['requests']} errors={webhook['errors']}  "
+            f"p50={_ms(webhook['p50'])}ms p95={_ms(webhook['p95'])}ms p99={_ms(webhook['p99'])}ms  "
+            f"{webhook['requests_per_second']:.1f} req/s")
+        self.stdout.write(
+            f"events   replied={webhook['replied']}/{webhook['events']}  "
+            f"{webhook['events_per_second']:.1f} events/s")
+        if "images" in results:
+            images = results["images"]
+            self.stdout.write(
+                f"images   done={images['done']}/{images['jobs']} failed={images['failed']}  "
+                f"{images['jobs_per_minute']:.1f} jobs/min")
+        if "chats" in results:
+            chats = results["chats"]
+            self.stdout.write(
+                f"chats    first event p50={_ms(chats['first_p50'])}ms p95={_ms(chats['first_p95'])}ms  "
+                f"total p50={_ms(chats['total_p50'])}ms p95={_ms(chats['total_p95'])}ms")
+        self.stdout.write(f"upstream {json.dumps(results['upstream']['counts'], sort_keys=True)}")
@@ -0,0 +1,70 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# 在全新的 Python process 裡量測：Django 設定、載入整個 app (urls → views)、第一個 webhook 回應
+CHILD_SCRIPT = r"""
+import base64, hashlib, hmac, json, os, sys, time
+started = time.perf_counter()
+if os.environ.get("BENCH_EAGER_SDK") == "1":
+    import google.genai, google.genai.types
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "linegemini.settings")
+import django
+django.setup()
+setup_done = time.perf_counter()
+import linegemini.urls
+import_done = time.perf_counter()
+from django.test import Client
+body = json.dumps({"destination": "bench", "events": []}).encode()
+signature = base64.b64encode(hmac.new(os.environ["LINE_CHANNEL_SECRET"].encode(), body, hashlib.sha256).digest())
+response = Client().post("/bot/webhook/", body, content_type="application/json",
+                         HTTP_X_LINE_SIGNATURE=signature.decode())
+first_done = time.perf_counter()
+print(json.dumps({
+    "setup_ms": (setup_done - started) * 1000,
+    "import_ms": (import_done - started) * 1000,
+    "first_response_ms": (first_done - started) * 1000,
+    "status": response.status_code,
+    "sdk_loaded": "google.genai" in sys.modules,
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = "量測冷啟動：載入 app 的時間與第一個 webhook 回應的時間 (每次都是全新的 process)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument("--eager-sdk", action="store_true",
+                            help="另外量測開機就 import google.genai 的情況作為對照")
+
+    def handle(self, *args, **options):
+        modes = [("lazy", False)] + ([("eager", True)] if options["eager_sdk"] else [])
+        for name, eager in modes:
+            samples = [self._run_child(eager) for _ in range(options["runs"])]
+            summary = {key: statistics.median(s[key] for s in samples)
+                       for key in ("setup_ms", "import_ms", "first_response_ms", "process_ms")}
+            statuses = {s["status"] for s in samples}
+            self.stdout.write(
+                f"{name:5s} setup={summary['setup_ms']:7.1f}ms  import={summary['import_ms']:7.1f}ms  "
+                f"first response={summary['first_response_ms']:7.1f}ms  "
+                f"process start→response={summary['process_ms']:7.1f}ms  "
+                f"status={sorted(statuses)}  sdk loaded={samples[0]['sdk_loaded']}"
+            )
+
+    def _run_child(self, eager: bool) -> dict:
+        env = dict(os.environ, LINE_CHANNEL_SECRET="bench-secret", BENCH_EAGER_SDK="1" if eager else "0")
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", CHILD_SCRIPT], cwd=settings.BASE_DIR, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        process_ms = (time.perf_counter() - started) * 1000
+        # 只取最後一行 JSON (app 載入時可能會印出其他訊息)
+        result = json.loads(out.strip().splitlines()[-1])
+        result["process_ms"] = process_ms
+        return result
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from bot import activity_import
+
+
+class Command(BaseCommand):
+    help = "從售票系統匯出的 CSV / JSON 大量匯入活動：以外部編號比對，新的新增、有變動的更新，可重複執行"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV (第一列為欄位名稱)、JSON 陣列或 JSON Lines 檔")
+        parser.add_argument("--format", choices=activity_import.FORMATS,
+                            help="檔案格式 (預設依副檔名判斷，.ndjson 視為 jsonl)")
+        parser.add_argument("--key", default="external_id", help="外部編號的欄位名稱 (預設 external_id)")
+        parser.add_argument("--batch-size", type=int, default=activity_import.IMPORT_BATCH_SIZE,
+                            help="每個交易處理的列數")
+        parser.add_argument("--dry-run", action="store_true", help="只驗證並統計，不寫入資料庫")
+
+    def handle(self, *args, **options):
+        try:
+            summary = activity_import.import_file(
+                options["path"], options["format"], key=options["key"], batch_size=options["batch_size"],
+                dry_run=options["dry_run"], progress=self._progress)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for number, message in summary["errors"]:
+            self.stderr.write(f"  row {number}: {message}")
+        if summary["failed"] > len(summary["errors"]):
+            self.stderr.write(f"  ... and {summary['failed'] - len(summary['errors'])} more invalid rows")
+        self.stdout.write(
+            f"{'Dry run' if options['dry_run'] else 'Done'}: {summary['rows']} rows in {summary['batches']} batches, "
+            f"{summary['created']} created, {summary['updated']} updated, {summary['unchanged']} unchanged, "
+            f"{summary['failed']} invalid, {summary['seconds']:.1f}s ({summary['per_second']:.0f} rows/s)"
+        )
+
+    def _progress(self, summary):
+        if summary["batches"] % 10 == 0:
+            self.stdout.write(f"  {summary['rows']} rows, {summary['per_second']:.0f} rows/s")
@@ -0,0 +1,201 @@
+import asyncio
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from bot import conversations, dedupe, jobs, metrics, photos, ratelimit, stats, warmup
+from bot.handlers import ASYNC_HANDLERS, HANDLERS
+from bot.line_api import close_async_line_client, mark_long_lived_loop
+
+
+def _observe_wait(job):
+    # 從寫入佇列到開始處理的等待時間 (重試的工作從上次可取出的時間算起)
+    waited = (timezone.now() - max(job.created_at, job.available_at)).total_seconds()
+    metrics.observe(metrics.STAGE_SECONDS, max(0.0, waited), stage="queue_wait", kind=job.kind)
+
+
+class Command(BaseCommand):
+    help = "從本機佇列取出 webhook 事件或生圖工作並在背景處理 (可設定併發數、重試次數與鎖定逾時)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kind", default=jobs.KIND_LINE_EVENT, help="要處理的工作類型")
+        parser.add_argument("--concurrency", type=int, default=jobs.WORKER_CONCURRENCY,
+                            help="同時處理的使用者數 (同一使用者的事件仍依序處理)")
+        parser.add_argument("--max-attempts", type=int, default=None,
+                            help="最多嘗試次數 (預設依工作類型)")
+        parser.add_argument("--visibility-timeout", type=int, default=None,
+                            help="取出後鎖定秒數，逾時未完成會被其他 worker 重新取出 (預設依工作類型)")
+        parser.add_argument("--poll-interval", type=float, default=0.5, help="佇列為空時的輪詢間隔 (秒)")
+        parser.add_argument("--once", action="store_true", help="清空佇列後就結束 (測試或排程用)")
+        parser.add_argument("--async", dest="use_async", action="store_true",
+                            help="以 asyncio 處理 (async LINE/Gemini client)，--concurrency 可以設到數百")
+
+    def handle(self, *args, **options):
+        kind = options["kind"]
+        handler = (ASYNC_HANDLERS if options["use_async"] else HANDLERS).get(kind)
+        if handler is None:
+            raise CommandError(f"Unknown job kind: {kind}")
+
+        concurrency = max(1, options["concurrency"])
+        if options["max_attempts"] is None:
+            options["max_attempts"] = jobs.MAX_ATTEMPTS.get(kind, jobs.JOB_MAX_ATTEMPTS)
+        if options["visibility_timeout"] is None:
+            options["visibility_timeout"] = jobs.VISIBILITY_TIMEOUTS.get(kind, jobs.JOB_VISIBILITY_TIMEOUT)
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        mode = "async" if options["use_async"] else "threads"
+        self.stdout.write(f"Worker started: kind={kind} concurrency={concurrency} mode={mode}")
+        if options["use_async"]:
+            asyncio.run(self._serve_async(kind, handler, concurrency, options))
+            self.stdout.write("Worker stopped.")
+            return
+
+        # 常駐的 worker 先開好連線，佇列裡的第一則訊息不必等 SDK 載入與 TLS 握手
+        if not options["once"]:
+            self.stdout.write(f"Warm-up: {warmup.warm()}")
+
+        inflight = set()
+        last_purge = 0.0
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"worker-{kind}") as pool:
+            while not self._stopping:
+                inflight = {f for f in inflight if not f.done()}
+                free = concurrency - len(inflight)
+
+                claimed = jobs.claim(
+                    kind, free,
+                    visibility_timeout=options["visibility_timeout"],
+                    max_attempts=options["max_attempts"],
+                )
+                inflight.update(jobs.run_in_lanes(
+                    pool, claimed,
+                    key=lambda job: job.user_key,
+                    fn=lambda job: self._run(handler, job, options["max_attempts"], options["visibility_timeout"]),
+                    on_skip=jobs.release,
+                ))
+
+                if time.monotonic() - last_purge > 3600:
+                    jobs.purge_finished()
+                    conversations.purge_idle()
+                    ratelimit.purge_idle()
+                    dedupe.purge_expired()
+                    metrics.purge_dead()
+                    photos.purge()
+                    last_purge = time.monotonic()
+                # 閒置時也把累積的計數寫進資料庫，/bot/stats/ 不會一直看不到
+                stats.flush_if_due()
+
+                if not claimed:
+                    if options["once"] and not inflight:
+                        break
+                    time.sleep(options["poll_interval"])
+
+            # 收到停止訊號後等待進行中的工作完成
+            for future in inflight:
+                future.result()
+
+        self.stdout.write("Worker stopped.")
+
+    def _run(self, handler, job, max_attempts, visibility_timeout):
+        """
+        回傳 False 代表工作排入重試 (或已被其他 worker 取走)，同一使用者後面的事件要先歸還以維持順序
+        """
+        if not jobs.extend_lock(job, visibility_timeout):
+            print(f"Job {job} lock expired and was reclaimed, skipping")
+            return False
+        _observe_wait(job)
+        try:
+            with metrics.span("job", kind=job.kind):
+                result = handler(job.payload)
+        except Exception as e:
+            print(f"Job {job} failed: {e}")
+            return not jobs.retry_or_fail(job, e, max_attempts=max_attempts)
+        else:
+            jobs.complete(job, result)
+            return True
+        finally:
+            close_old_connections()
+
+    async def _serve_async(self, kind, handler, concurrency, options):
+        """
+        asyncio 版的主迴圈：每條 lane (同一使用者的事件) 是一個 task，
+        資料庫操作透過 sync_to_async 在同一個執行緒依序執行
+        """
+        mark_long_lived_loop()
+        if not options["once"]:
+            self.stdout.write(f"Warm-up: {await warmup.awarm()}")
+        claim = sync_to_async(jobs.claim)
+        inflight = set()
+        last_purge = 0.0
+        try:
+            while not self._stopping:
+                inflight = {t for t in inflight if not t.done()}
+                free = concurrency - len(inflight)
+
+                claimed = await claim(
+                    kind, free,
+                    visibility_timeout=options["visibility_timeout"],
+                    max_attempts=options["max_attempts"],
+                )
+                for lane in jobs.group_lanes(claimed, key=lambda job: job.user_key):
+                    inflight.add(asyncio.create_task(self._run_lane_async(handler, lane, options["max_attempts"],
+                                                                         options["visibility_timeout"])))
+
+                if time.monotonic() - last_purge > 3600:
+                    await sync_to_async(jobs.purge_finished)()
+                    await sync_to_async(conversations.purge_idle)()
+                    await sync_to_async(ratelimit.purge_idle)()
+                    await sync_to_async(dedupe.purge_expired)()
+                    metrics.purge_dead()
+                    photos.purge()
+                    last_purge = time.monotonic()
+                if stats.due():
+                    await sync_to_async(stats.flush_if_due)()
+
+                if not claimed or len(claimed) >= free:
+                    if options["once"] and not inflight:
+                        break
+                    # 有進行中的 task 時等到其中一個完成 (或輪詢間隔到) 再取新工作，
+                    # 避免不斷查詢佇列而佔住處理資料庫的執行緒
+                    if inflight:
+                        await asyncio.wait(inflight, timeout=options["poll_interval"],
+                                           return_when=asyncio.FIRST_COMPLETED)
+                    else:
+                        await asyncio.sleep(options["poll_interval"])
+
+            # 收到停止訊號後等待進行中的工作完成
+            await asyncio.gather(*inflight)
+        finally:
+            await close_async_line_client()
+
+    async def _run_lane_async(self, handler, lane, max_attempts, visibility_timeout):
+        for i, job in enumerate(lane):
+            if await self._run_async(handler, job, max_attempts, visibility_timeout) is False:
+                for skipped in lane[i + 1:]:
+                    await sync_to_async(jobs.release)(skipped)
+                return
+
+    async def _run_async(self, handler, job, max_attempts, visibility_timeout):
+        if not await sync_to_async(jobs.extend_lock)(job, visibility_timeout):
+            print(f"Job {job} lock expired and was reclaimed, skipping")
+            return False
+        _observe_wait(job)
+        try:
+            with metrics.span("job", kind=job.kind):
+                result = await handler(job.payload)
+        except Exception as e:
+            print(f"Job {job} failed: {e}")
+            return not await sync_to_async(jobs.retry_or_fail)(job, e, max_attempts=max_attempts)
+        else:
+            await sync_to_async(jobs.complete)(job, result)
+            return True
+
+    def _stop(self, signum, frame):
+        self._stopping = True
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from bot import campaigns, conversations
+from bot.models import Activity, Campaign, Conversation
+
+
+class Command(BaseCommand):
+    help = "以 multicast 分批發送行銷推播 (活動卡片/輪播 + 文字)，中斷後再執行同一個名稱會接續發送"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", help="推播名稱 (已存在則接續發送)")
+        parser.add_argument("--audience-file", help="收件者 userId 清單檔，一行一個")
+        parser.add_argument("--recent-chatters", action="store_true",
+                            help="加入最近 CONVERSATION_IDLE_TTL 秒 (預設 30 分鐘) 內跟機器人對話過的使用者；"
+                                 "閒置的對話會被刪除，更早的使用者請用 --audience-file")
+        parser.add_argument("--activity", type=int, action="append", default=[], dest="activity_ids",
+                            help="要推播的活動 id (可重複指定)")
+        parser.add_argument("--upcoming", type=int, default=0, help="推播最近 N 個尚未結束的活動")
+        parser.add_argument("--text", default="", help="附加的文字訊息")
+        parser.add_argument("--rate", type=float, default=campaigns.CAMPAIGN_RATE, help="每秒最多幾個 multicast 請求")
+        parser.add_argument("--concurrency", type=int, default=campaigns.CAMPAIGN_CONCURRENCY,
+                            help="同時進行的請求數")
+        parser.add_argument("--retry-failed", action="store_true", help="重送先前失敗的收件者")
+
+    def handle(self, *args, **options):
+        campaign, created = Campaign.objects.get_or_create(name=options["name"])
+        if created or campaign.status == Campaign.STATUS_DRAFT:
+            activity_ids = list(options["activity_ids"])
+            if options["upcoming"]:
+                activity_ids += list(Activity.objects.upcoming().values_list("pk", flat=True)[:options["upcoming"]])
+            campaign.activity_ids = activity_ids[:campaigns.CAROUSEL_LIMIT]
+            campaign.text = options["text"]
+            campaign.save(update_fields=["activity_ids", "text"])
+        elif options["activity_ids"] or options["upcoming"] or options["text"]:
+            # 已開始發送的推播不能改內容，否則前後收到的人內容不同
+            self.stderr.write(f"Campaign {campaign} is {campaign.status}; message options are ignored.")
+
+        added = 0
+        if options["audience_file"]:
+            with open(options["audience_file"], encoding="utf-8") as f:
+                added += campaigns.add_recipients(campaign, f)
+        if options["recent_chatters"]:
+            cutoff = timezone.now() - timedelta(seconds=conversations.CONVERSATION_IDLE_TTL)
+            chatters = campaigns.add_recipients(
+                campaign, Conversation.objects.filter(updated_at__gte=cutoff)
+                .values_list("user_id", flat=True).iterator())
+            self.stdout.write(f"Added {chatters} users who chatted in the last "
+                              f"{conversations.CONVERSATION_IDLE_TTL // 60} minutes")
+            added += chatters
+        if options["retry_failed"]:
+            self.stdout.write(f"Retrying {campaigns.retry_failed(campaign)} failed recipients")
+
+        total = campaign.recipients.count()
+        if not total:
+            raise CommandError("Campaign has no recipients (use --audience-file or --recent-chatters)")
+        self.stdout.write(f"Campaign {campaign}: {total} recipients (+{added}), "
+                          f"{campaign.sent_count} already sent")
+
+        try:
+            result = campaigns.send(campaign, rate=options["rate"], concurrency=max(1, options["concurrency"]),
+                                    progress=self._progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"Done: {result['recipients']} recipients in {result['requests']} requests, "
+            f"{result['failed']} failed, {result['seconds']:.1f}s ({result['per_second']:.0f} recipients/s)"
+        )
+
+    def _progress(self, summary):
+        if summary["requests"] % 20 == 0:
+            self.stdout.write(f"  {summary['recipients']} sent, {summary['failed']} failed, "
+                              f"{summary['per_second']:.0f} recipients/s")
@@ -0,0 +1,167 @@
+import io
+import mimetypes
+import os
+import uuid
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import stats
+from .models import StoredImage
+
+# 生成圖片的儲存參數 (可用環境變數調整)
+MEDIA_STORE_QUOTA_MB = int(os.getenv("MEDIA_STORE_QUOTA_MB", "500"))
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2048"))  # 原圖最長邊 (px)
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "480"))  # 預覽圖最長邊 (px)
+# 命中時更新最後使用時間的最小間隔，避免熱門圖片每次都寫資料庫
+MEDIA_STORE_TOUCH_INTERVAL = int(os.getenv("MEDIA_STORE_TOUCH_INTERVAL", "60"))
+
+# LINE 圖片訊息的限制：原圖 10MB、預覽圖 1MB，只接受 JPEG/PNG
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+PREVIEW_MAX_BYTES = 1024 * 1024
+
+IMAGE_DIR = "generated_images"
+PREVIEW_DIR = "previews"
+EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def image_dir() -> str:
+    path = os.path.join(settings.MEDIA_ROOT, IMAGE_DIR)
+    os.makedirs(os.path.join(path, PREVIEW_DIR), exist_ok=True)
+    return path
+
+
+def _write_atomic(path: str, data: bytes):
+    # 先寫暫存檔再 rename，其他 process 不會讀到寫一半的檔案
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _encode_jpeg(image, max_bytes: int, quality: int = 90) -> bytes:
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    while True:
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=quality, optimize=True)
+        if buf.tell() <= max_bytes or quality <= 40:
+            return buf.getvalue()
+        quality -= 15
+
+
+def _process(data: bytes, mime_type: str):
+    """
+    回傳 (原圖 bytes, 副檔名, 預覽圖 bytes 或 None)。
+    原圖超過邊長或 LINE 大小限制、或不是 JPEG/PNG 時縮小並轉成 JPEG；預覽圖一律是小張 JPEG。
+    """
+    ext = mimetypes.guess_extension(mime_type or "") or ".png"
+    if ext not in EXTENSIONS:
+        ext = ".png"
+    try:
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        # 沒有安裝 Pillow 或無法解析的格式：原樣保存，預覽圖沿用原圖
+        print(f"Image processing skipped: {e}")
+        return data, ext, None
+
+    if max(image.size) > IMAGE_MAX_SIDE or len(data) > IMAGE_MAX_BYTES or image.format not in ("PNG", "JPEG"):
+        capped = image.copy()
+        capped.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        data, ext = _encode_jpeg(capped, IMAGE_MAX_BYTES), ".jpg"
+    else:
+        ext = ".png" if image.format == "PNG" else ".jpg"
+
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+    return data, ext, _encode_jpeg(preview, PREVIEW_MAX_BYTES, quality=80)
+
+
+def write(data: bytes, mime_type: str, stem: str = None) -> str:
+    """
+    保存生成的圖片 (限制大小的原圖 + 預覽圖) 並登錄到索引，回傳原圖檔名。
+    stem 為 None 時以 uuid 命名。寫入後若超過磁碟配額會淘汰最久沒被使用的圖片。
+    """
+    stem = stem or str(uuid.uuid4())
+    original, ext, preview = _process(data, mime_type)
+    directory = image_dir()
+
+    name = stem + ext
+    _write_atomic(os.path.join(directory, name), original)
+    print(f"Image saved to: {os.path.join(directory, name)}")
+
+    preview_name = ""
+    if preview is not None:
+        preview_name = f"{PREVIEW_DIR}/{stem}.jpg"
+        _write_atomic(os.path.join(directory, preview_name), preview)
+
+    StoredImage.objects.update_or_create(name=name, defaults={
+        "preview_name": preview_name,
+        "size": len(original) + len(preview or b""),
+        "last_access": timezone.now(),
+    })
+    enforce_quota()
+    return name
+
+
+def touch(name: str):
+    """
+    圖片被重複使用時更新最後使用時間 (LRU 依據)
+    """
+    now = timezone.now()
+    StoredImage.objects.filter(
+        name=name, last_access__lt=now - timedelta(seconds=MEDIA_STORE_TOUCH_INTERVAL)
+    ).update(last_access=now)
+
+
+def _remove(image: StoredImage):
+    directory = os.path.join(settings.MEDIA_ROOT, IMAGE_DIR)
+    for name in (image.name, image.preview_name):
+        if name:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    StoredImage.objects.filter(pk=image.pk).delete()
+
+
+def enforce_quota(quota_bytes: int = None) -> int:
+    """
+    總大小超過配額時依最後使用時間由舊到新刪除，回傳刪除的張數
+    """
+    if quota_bytes is None:
+        quota_bytes = MEDIA_STORE_QUOTA_MB * 1024 * 1024
+    total = StoredImage.objects.aggregate(total=Sum("size"))["total"] or 0
+    if total <= quota_bytes:
+        return 0
+
+    evicted = 0
+    for image in StoredImage.objects.order_by("last_access").iterator():
+        if total <= quota_bytes:
+            break
+        _remove(image)
+        total -= image.size
+        evicted += 1
+    stats.incr("media_store.evicted", evicted)
+    return evicted
+
+
+def preview_url(image_url: str) -> str:
+    """
+    由原圖網址找出對應的預覽圖網址；不是本站生成的圖片 (或沒有預覽圖) 時回傳原網址
+    """
+    marker = f"/media/{IMAGE_DIR}/"
+    path = urlsplit(image_url or "").path
+    if marker not in path:
+        return image_url
+    name = path.split(marker, 1)[1]
+    preview_name = StoredImage.objects.filter(name=name).values_list("preview_name", flat=True).first()
+    if not preview_name:
+        return image_url
+    return image_url[:image_url.index(marker)] + marker + preview_name
@@ -0,0 +1,127 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from .media_store import IMAGE_DIR
+
+# uuid 命名的圖片 (每次重新生成、照片合成) 不會被改寫成別的內容，可以長期 immutable 快取
+MEDIA_CACHE_MAX_AGE = int(os.getenv("MEDIA_CACHE_MAX_AGE", str(60 * 60 * 24 * 365)))
+# 以提示詞快取 key 命名的圖片被配額淘汰後，同一個網址可能重新生成不同的內容：
+# 只短期快取，之後以 ETag 確認是否變更
+MEDIA_REVALIDATE_MAX_AGE = int(os.getenv("MEDIA_REVALIDATE_MAX_AGE", "3600"))
+RANGE_CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_UUID_NAME_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.[a-z]+$")
+
+
+def _etag(st) -> str:
+    # 以大小與修改時間當 ETag，不必讀檔案內容
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def _parse_range(header: str, size: int):
+    """
+    解析單一區段的 Range (例如 bytes=0-1023、bytes=-500)，回傳 (start, end)；
+    不支援或無效的格式 (例如 bytes=5-3) 回傳 None，依 RFC 9110 忽略 Range 回傳整個檔案；
+    格式正確但無法滿足的範圍 (起點超過檔案大小) 回傳 False
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        length = int(end)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+def _read_range(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_generated_image(request, path: str):
+    """
+    提供 media/generated_images 下的圖片 (DEBUG=False 也可用)：
+    uuid 命名的圖片長期 immutable 快取，其餘短期快取後以 ETag / If-None-Match 確認 (304)，
+    單一區段 Range 回 206。整個檔案用 FileResponse 分段讀取回傳
+    (WSGI 伺服器提供 wsgi.file_wrapper 時可用 sendfile；ASGI 的 uvicorn worker 是分段送出)
+    """
+    try:
+        full_path = safe_join(os.path.join(settings.MEDIA_ROOT, IMAGE_DIR), path)
+        st = os.stat(full_path)
+    except (SuspiciousFileOperation, ValueError, OSError):
+        raise Http404("Image not found")
+    if not os.path.isfile(full_path):
+        raise Http404("Image not found")
+
+    etag = _etag(st)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(st.st_mtime),
+        "Cache-Control": (f"public, max-age={MEDIA_CACHE_MAX_AGE}, immutable"
+                          if _UUID_NAME_RE.match(os.path.basename(path))
+                          else f"public, max-age={MEDIA_REVALIDATE_MAX_AGE}, must-revalidate"),
+        "Accept-Ranges": "bytes",
+    }
+
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        response = HttpResponseNotModified()
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+    byte_range = None
+    range_header = request.headers.get("Range")
+    if range_header and (not request.headers.get("If-Range") or request.headers["If-Range"] == etag):
+        byte_range = _parse_range(range_header, st.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{st.st_size}"
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(full_path, "rb"))
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        response = StreamingHttpResponse(_read_range(full_path, start, length), status=206,
+                                         content_type=content_type)
+        response["Content-Length"] = str(length)
+        response["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+
+    for key, value in headers.items():
+        response[key] = value
+    return response
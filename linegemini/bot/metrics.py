@@ -0,0 +1,317 @@
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from . import stats
+
+# 各階段耗時的統計參數 (可用環境變數調整)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# 每個 process 把自己的統計寫進 BOT_STATE_DIR/metrics/<pid>-<id>.json 的間隔 (秒)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# 已結束的 process 留下的檔案保留多久 (秒)，之後由 run_worker 的定期清理刪除
+METRICS_RETENTION = int(os.getenv("METRICS_RETENTION", str(60 * 60 * 24)))
+
+# 耗時分布的 bucket 上限 (秒)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = "bot_stage_duration_seconds"
+STAGE_ERRORS = "bot_stage_errors_total"
+STAGE_INFLIGHT = "bot_stage_inflight"
+TOOL_CALLS = "bot_tool_calls_total"
+
+HELP = {
+    STAGE_SECONDS: ("histogram", "各處理階段的耗時 (秒)"),
+    STAGE_ERRORS: ("counter", "各處理階段丟出例外的次數"),
+    STAGE_INFLIGHT: ("gauge", "目前正在進行的階段數"),
+    TOOL_CALLS: ("counter", "依工具名稱統計的工具呼叫次數"),
+}
+
+# (名稱, labels) -> 數值；histogram 的數值是 [各 bucket 次數..., +Inf 次數, 總和 (秒)]
+_counters = {}
+_gauges = {}
+_histograms = {}
+_lock = threading.Lock()
+_dirty = False
+_flusher = None
+# 檔名除了 pid 再加上每個 process 啟動時產生的 id：BOT_STATE_DIR 保留下來而容器重啟時 pid 常被重用，
+# 只用 pid 會覆蓋已結束 process 的累計值，總數就變少了
+_instance_id = uuid.uuid4().hex
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name: str, amount: int = 1, **labels):
+    """
+    計數器加 amount (只更新記憶體，由背景執行緒定期寫檔)
+    """
+    if not METRICS_ENABLED:
+        return
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+        _dirty = True
+    _ensure_flusher()
+
+
+def observe(name: str, seconds: float, **labels):
+    """
+    記錄一次耗時到 histogram
+    """
+    if not METRICS_ENABLED:
+        return
+    _observe(_key(name, labels), seconds)
+    _ensure_flusher()
+
+
+def _observe(key: tuple, seconds: float):
+    global _dirty
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        values[index] += 1
+        values[-1] += seconds
+        _dirty = True
+
+
+def _gauge_add(key: tuple, delta: int):
+    global _dirty
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+        _dirty = True
+
+
+class span:
+    """
+    量測一個處理階段：
+        with metrics.span("gemini"):
+            ...
+    記錄耗時 (bot_stage_duration_seconds)、進行中的數量 (bot_stage_inflight) 與例外次數 (bot_stage_errors_total)，
+    可以用在 async 函式裡包住 await
+    """
+    __slots__ = ("_key", "_gauge_key", "_started")
+
+    def __init__(self, stage: str, **labels):
+        labels["stage"] = stage
+        self._key = _key(STAGE_SECONDS, labels)
+        self._gauge_key = (STAGE_INFLIGHT, self._key[1])
+
+    def __enter__(self):
+        if METRICS_ENABLED:
+            _gauge_add(self._gauge_key, 1)
+            _ensure_flusher()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not METRICS_ENABLED:
+            return False
+        _observe(self._key, time.perf_counter() - self._started)
+        _gauge_add(self._gauge_key, -1)
+        if exc_type is not None:
+            inc(STAGE_ERRORS, **dict(self._key[1]))
+        return False
+
+
+def local_snapshot() -> dict:
+    """
+    這個 process 目前的統計 (寫檔與測試用)
+    """
+    with _lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "gauges": [[name, list(labels), value] for (name, labels), value in _gauges.items()],
+            "histograms": [[name, list(labels), list(values)] for (name, labels), values in _histograms.items()],
+        }
+
+
+def reset():
+    global _dirty
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+        _dirty = False
+
+
+def _directory() -> str:
+    path = os.path.join(settings.BOT_STATE_DIR, "metrics")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def flush():
+    """
+    把這個 process 的統計 (累計值) 寫到 BOT_STATE_DIR/metrics/<pid>-<id>.json；
+    各 worker 寫各自的檔案，讀取時再加總
+    """
+    global _dirty
+    with _lock:
+        if not _dirty:
+            return
+        _dirty = False
+    data = local_snapshot()
+    data["pid"] = os.getpid()
+    path = os.path.join(_directory(), f"{os.getpid()}-{_instance_id}.json")
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(f"Metrics flush failed: {e}")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+        _flusher.start()
+
+
+def _after_fork():
+    # gunicorn --preload 時 worker 由已載入的 master fork 出來：不繼承 master 的統計與寫檔執行緒
+    global _lock, _flusher, _instance_id
+    _lock = threading.Lock()
+    _flusher = None
+    _instance_id = uuid.uuid4().hex
+    reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_files():
+    directory = _directory()
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def collect() -> dict:
+    """
+    加總所有 process 的統計。已結束的 process 的計數器與 histogram 仍然算進去 (總數不會因為 worker 重啟而變少)，
+    進行中的數量只算還活著的 process
+    """
+    flush()
+    counters, gauges, histograms = {}, {}, {}
+    for data in _read_files():
+        alive = _alive(data.get("pid", 0))
+        for name, labels, value in data.get("counters", []):
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in data.get("gauges", []):
+            key = (name, tuple(map(tuple, labels)))
+            gauges[key] = gauges.get(key, 0) + (value if alive else 0)
+        for name, labels, values in data.get("histograms", []):
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.get(key)
+            histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+    return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+def purge_dead(retention: int = METRICS_RETENTION) -> int:
+    """
+    刪除已結束超過 retention 秒的 process 留下的檔案
+    """
+    directory = _directory()
+    cutoff = time.time() - retention
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        # <pid>-<id>.json 與寫入中途留下的 <pid>-<id>.json.<hex>.tmp
+        pid = name.split(".", 1)[0].split("-", 1)[0]
+        try:
+            if pid.isdigit() and not _alive(int(pid)) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """
+    Prometheus text format (0.0.4)：各階段的 histogram / 計數器 / 進行中數量，
+    加上資料庫裡的 stats 計數器 (bot_stats_total{name="..."})
+    """
+    data = collect()
+    families = {}
+    for kind in ("counters", "gauges", "histograms"):
+        for (name, labels), value in data[kind].items():
+            families.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(families):
+        kind, help_text = HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(families[name]):
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), value[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(float(bound))
+                lines.append(f"{name}_bucket{_labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(float(value[-1]))}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+    counters = stats.snapshot()
+    if counters:
+        lines.append("# HELP bot_stats_total 跨 worker 共用的計數器 (/bot/stats/)")
+        lines.append("# TYPE bot_stats_total counter")
+        for name, value in counters.items():
+            lines.append(f'bot_stats_total{{name="{_escape(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
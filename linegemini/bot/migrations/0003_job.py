@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0002_alter_activity_end_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32, verbose_name='工作類型')),
+                ('payload', models.JSONField(verbose_name='內容')),
+                ('status', models.CharField(choices=[('pending', '等待中'), ('running', '處理中'), ('done', '完成'), ('failed', '失敗')], default='pending', max_length=16, verbose_name='狀態')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='嘗試次數')),
+                ('available_at', models.DateTimeField(verbose_name='可執行時間')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='鎖定到期')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='最後錯誤')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='建立時間')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新時間')),
+            ],
+            options={
+                'verbose_name': '背景工作',
+                'verbose_name_plural': '背景工作列表',
+                'indexes': [models.Index(fields=['kind', 'status', 'available_at'], name='bot_job_claim_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='user_key',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='使用者 (同一使用者依序處理)'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['kind', 'user_key', 'status'], name='bot_job_user_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_job_user_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='名稱')),
+                ('value', models.BigIntegerField(default=0, verbose_name='數值')),
+            ],
+            options={
+                'verbose_name': '計數器',
+                'verbose_name_plural': '計數器',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReplyCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True, verbose_name='正規化訊息雜湊')),
+                ('value', models.JSONField(verbose_name='回覆 (文字或 Flex Message)')),
+                ('expires_at', models.DateTimeField(verbose_name='到期時間')),
+                ('last_access', models.DateTimeField(db_index=True, verbose_name='最後使用時間')),
+            ],
+            options={
+                'verbose_name': '回覆快取',
+                'verbose_name_plural': '回覆快取',
+            },
+        ),
+    ]
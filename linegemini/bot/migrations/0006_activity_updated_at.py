@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_reply_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='更新時間'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_activity_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activity',
+            name='end_date',
+            field=models.DateField(db_index=True, verbose_name='活動結束日期'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_activity_end_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='result',
+            field=models.JSONField(blank=True, null=True, verbose_name='結果'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_job_result'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='原圖檔名')),
+                ('preview_name', models.CharField(blank=True, default='', max_length=120, verbose_name='預覽圖檔名')),
+                ('size', models.PositiveIntegerField(default=0, verbose_name='原圖與預覽圖合計大小 (bytes)')),
+                ('last_access', models.DateTimeField(db_index=True, verbose_name='最後使用時間')),
+            ],
+            options={
+                'verbose_name': '生成圖片',
+                'verbose_name_plural': '生成圖片',
+            },
+        ),
+    ]
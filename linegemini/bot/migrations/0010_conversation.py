@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0009_stored_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=64, unique=True, verbose_name='LINE userId')),
+                ('summary', models.TextField(blank=True, default='', verbose_name='先前對話摘要')),
+                ('turns', models.JSONField(default=list, verbose_name='最近對話')),
+                ('tokens', models.PositiveIntegerField(default=0, verbose_name='估計 token 數')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True, verbose_name='最後對話時間')),
+            ],
+            options={
+                'verbose_name': '對話記憶',
+                'verbose_name_plural': '對話記憶',
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0010_conversation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='名稱')),
+                ('activity_ids', models.JSONField(blank=True, default=list, verbose_name='活動 (依序組成卡片或輪播)')),
+                ('text', models.TextField(blank=True, default='', verbose_name='文字訊息')),
+                ('status', models.CharField(choices=[('draft', '草稿'), ('sending', '發送中'), ('done', '已完成')], default='draft', max_length=16, verbose_name='狀態')),
+                ('sent_count', models.PositiveIntegerField(default=0, verbose_name='已送出')),
+                ('failed_count', models.PositiveIntegerField(default=0, verbose_name='失敗')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='建立時間')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始發送')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='發送完成')),
+            ],
+            options={
+                'verbose_name': '行銷推播',
+                'verbose_name_plural': '行銷推播',
+            },
+        ),
+        migrations.CreateModel(
+            name='CampaignRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=64, verbose_name='LINE userId')),
+                ('batch', models.PositiveIntegerField(blank=True, null=True, verbose_name='批次')),
+                ('status', models.CharField(choices=[('pending', '等待中'), ('sent', '已送出'), ('failed', '失敗')], default='pending', max_length=16, verbose_name='狀態')),
+                ('error', models.TextField(blank=True, default='', verbose_name='錯誤')),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='bot.campaign', verbose_name='行銷推播')),
+            ],
+            options={
+                'verbose_name': '推播收件者',
+                'verbose_name_plural': '推播收件者',
+                'indexes': [models.Index(fields=['campaign', 'status', 'batch'], name='bot_campaign_progress_idx')],
+                'constraints': [models.UniqueConstraint(fields=('campaign', 'user_id'), name='bot_campaign_recipient_unique')],
+            },
+        ),
+    ]
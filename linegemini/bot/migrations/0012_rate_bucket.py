@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0011_campaign'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=150, unique=True, verbose_name='名稱')),
+                ('tokens', models.FloatField(verbose_name='剩餘令牌 (負數代表已預約到未來)')),
+                ('updated', models.FloatField(db_index=True, verbose_name='最後更新 (epoch 秒)')),
+            ],
+            options={
+                'verbose_name': '限流令牌桶',
+                'verbose_name_plural': '限流令牌桶',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:45
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0012_rate_bucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=64, unique=True, verbose_name='webhookEventId')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='收到時間')),
+            ],
+            options={
+                'verbose_name': '已收到的 webhook 事件',
+                'verbose_name_plural': '已收到的 webhook 事件',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0013_webhook_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CircuitBreaker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True, verbose_name='名稱')),
+                ('state', models.CharField(choices=[('closed', '正常'), ('open', '開路 (暫停使用)'), ('half_open', '試探中')], default='closed', max_length=16, verbose_name='狀態')),
+                ('failures', models.PositiveIntegerField(default=0, verbose_name='連續失敗次數')),
+                ('opened_until', models.DateTimeField(blank=True, null=True, verbose_name='暫停到')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新時間')),
+            ],
+            options={
+                'verbose_name': '斷路器',
+                'verbose_name_plural': '斷路器',
+            },
+        ),
+    ]
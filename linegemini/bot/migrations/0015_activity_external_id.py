@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0014_circuit_breaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True, verbose_name='外部編號'),
+        ),
+    ]
@@ -1,12 +1,33 @@
 from django.db import models
+from django.utils import timezone
+
+
+class ActivityQuerySet(models.QuerySet):
+    # 產生 Flex 卡片需要的欄位
+    RENDERED_FIELDS = ("name", "end_date", "location", "description", "image_url", "activity_link", "updated_at")
+
+    def upcoming(self, today=None):
+        """
+        尚未結束的活動 (end_date >= 今天)，依結束日期排序，會用到 end_date 索引
+        """
+        return self.filter(end_date__gte=today or timezone.localdate()).order_by("end_date", "pk")
+
+    def for_rendering(self):
+        return self.only(*self.RENDERED_FIELDS)
+
 
 class Activity(models.Model):
     name = models.CharField(max_length=100, verbose_name="活動名稱")
-    end_date = models.DateField(verbose_name="活動結束日期")
+    end_date = models.DateField(verbose_name="活動結束日期", db_index=True)
     location = models.CharField(max_length=100, verbose_name="地點")
     description = models.TextField(verbose_name="描述")
     image_url = models.URLField(verbose_name="圖片網址", blank=True, null=True)
     activity_link = models.TextField(verbose_name="活動連結", blank=True, null=True)
+    # 售票系統等外部來源的編號，大量匯入時以它比對 (後台手動新增的活動沒有)
+    external_id = models.CharField(max_length=100, unique=True, blank=True, null=True, verbose_name="外部編號")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新時間")
+
+    objects = ActivityQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -14,3 +35,231 @@ class Activity(models.Model):
     class Meta:
         verbose_name = "活動"
         verbose_name_plural = "活動列表"
+
+
+class Job(models.Model):
+    """
+    本機持久化工作佇列 (SQLite)，webhook 收到事件後先寫入這裡，再由 worker 取出處理
+    """
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "等待中"),
+        (STATUS_RUNNING, "處理中"),
+        (STATUS_DONE, "完成"),
+        (STATUS_FAILED, "失敗"),
+    ]
+
+    kind = models.CharField(max_length=32, verbose_name="工作類型")
+    payload = models.JSONField(verbose_name="內容")
+    user_key = models.CharField(max_length=64, blank=True, default="", verbose_name="使用者 (同一使用者依序處理)")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name="狀態")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="嘗試次數")
+    available_at = models.DateTimeField(verbose_name="可執行時間")
+    locked_until = models.DateTimeField(blank=True, null=True, verbose_name="鎖定到期")
+    last_error = models.TextField(blank=True, default="", verbose_name="最後錯誤")
+    result = models.JSONField(blank=True, null=True, verbose_name="結果")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="建立時間")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新時間")
+
+    def __str__(self):
+        return f"{self.kind}#{self.pk} ({self.status})"
+
+    class Meta:
+        verbose_name = "背景工作"
+        verbose_name_plural = "背景工作列表"
+        indexes = [
+            models.Index(fields=["kind", "status", "available_at"], name="bot_job_claim_idx"),
+            models.Index(fields=["kind", "user_key", "status"], name="bot_job_user_idx"),
+        ]
+
+
+class WebhookEvent(models.Model):
+    """
+    已收過的 webhookEventId (LINE 重送同一事件時略過)，超過保留時間後刪除
+    """
+    event_id = models.CharField(max_length=64, unique=True, verbose_name="webhookEventId")
+    created_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="收到時間")
+
+    class Meta:
+        verbose_name = "已收到的 webhook 事件"
+        verbose_name_plural = "已收到的 webhook 事件"
+
+    def __str__(self):
+        return self.event_id
+
+
+class ReplyCacheEntry(models.Model):
+    """
+    get_gemini_response 的回覆快取 (各 gunicorn worker 共用同一個 SQLite)
+    """
+    key = models.CharField(max_length=64, unique=True, verbose_name="正規化訊息雜湊")
+    value = models.JSONField(verbose_name="回覆 (文字或 Flex Message)")
+    expires_at = models.DateTimeField(verbose_name="到期時間")
+    last_access = models.DateTimeField(db_index=True, verbose_name="最後使用時間")
+
+    class Meta:
+        verbose_name = "回覆快取"
+        verbose_name_plural = "回覆快取"
+
+
+class Conversation(models.Model):
+    """
+    每位 LINE 使用者的對話記憶 (各 worker 共用)：較早的對話濃縮成摘要，只保留最近幾輪原文
+    """
+    user_id = models.CharField(max_length=64, unique=True, verbose_name="LINE userId")
+    summary = models.TextField(blank=True, default="", verbose_name="先前對話摘要")
+    turns = models.JSONField(default=list, verbose_name="最近對話")  # [["u", 文字], ["m", 文字], ...]
+    tokens = models.PositiveIntegerField(default=0, verbose_name="估計 token 數")
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name="最後對話時間")
+
+    class Meta:
+        verbose_name = "對話記憶"
+        verbose_name_plural = "對話記憶"
+
+    def __str__(self):
+        return self.user_id
+
+
+class StoredImage(models.Model):
+    """
+    media/generated_images 中的圖片索引 (大小與最後使用時間)，超過磁碟配額時依 LRU 淘汰
+    """
+    name = models.CharField(max_length=100, unique=True, verbose_name="原圖檔名")
+    preview_name = models.CharField(max_length=120, blank=True, default="", verbose_name="預覽圖檔名")
+    size = models.PositiveIntegerField(default=0, verbose_name="原圖與預覽圖合計大小 (bytes)")
+    last_access = models.DateTimeField(db_index=True, verbose_name="最後使用時間")
+
+    class Meta:
+        verbose_name = "生成圖片"
+        verbose_name_plural = "生成圖片"
+
+    def __str__(self):
+        return self.name
+
+
+class Counter(models.Model):
+    """
+    跨 worker 共用的計數器 (快取命中率等)
+    """
+    name = models.CharField(max_length=100, unique=True, verbose_name="名稱")
+    value = models.BigIntegerField(default=0, verbose_name="數值")
+
+    def __str__(self):
+        return f"{self.name}={self.value}"
+
+    class Meta:
+        verbose_name = "計數器"
+        verbose_name_plural = "計數器"
+
+
+class RateBucket(models.Model):
+    """
+    跨 worker 共用的令牌桶 (例如 chat:user:U123、image:global)，以條件式 UPDATE 原子地預約令牌
+    """
+    key = models.CharField(max_length=150, unique=True, verbose_name="名稱")
+    tokens = models.FloatField(verbose_name="剩餘令牌 (負數代表已預約到未來)")
+    updated = models.FloatField(db_index=True, verbose_name="最後更新 (epoch 秒)")
+
+    class Meta:
+        verbose_name = "限流令牌桶"
+        verbose_name_plural = "限流令牌桶"
+
+    def __str__(self):
+        return f"{self.key}={self.tokens:.2f}"
+
+
+class CircuitBreaker(models.Model):
+    """
+    跨 worker 共用的斷路器狀態 (例如生圖主模型)：連續失敗後開路一段時間，期間直接走備援
+    """
+    STATE_CLOSED = "closed"
+    STATE_OPEN = "open"
+    STATE_HALF_OPEN = "half_open"
+    STATE_CHOICES = [
+        (STATE_CLOSED, "正常"),
+        (STATE_OPEN, "開路 (暫停使用)"),
+        (STATE_HALF_OPEN, "試探中"),
+    ]
+
+    name = models.CharField(max_length=64, unique=True, verbose_name="名稱")
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_CLOSED, verbose_name="狀態")
+    failures = models.PositiveIntegerField(default=0, verbose_name="連續失敗次數")
+    opened_until = models.DateTimeField(blank=True, null=True, verbose_name="暫停到")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新時間")
+
+    class Meta:
+        verbose_name = "斷路器"
+        verbose_name_plural = "斷路器"
+
+    def __str__(self):
+        return f"{self.name} ({self.state})"
+
+
+class Campaign(models.Model):
+    """
+    行銷推播：把同一組訊息 (活動卡片與文字) 以 multicast 分批送給一群使用者，
+    每位收件者的進度記在 CampaignRecipient，中斷後可以接續發送
+    """
+    STATUS_DRAFT = "draft"
+    STATUS_SENDING = "sending"
+    STATUS_DONE = "done"
+    STATUS_CHOICES = [
+        (STATUS_DRAFT, "草稿"),
+        (STATUS_SENDING, "發送中"),
+        (STATUS_DONE, "已完成"),
+    ]
+
+    name = models.CharField(max_length=100, unique=True, verbose_name="名稱")
+    activity_ids = models.JSONField(default=list, blank=True, verbose_name="活動 (依序組成卡片或輪播)")
+    text = models.TextField(blank=True, default="", verbose_name="文字訊息")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_DRAFT, verbose_name="狀態")
+    sent_count = models.PositiveIntegerField(default=0, verbose_name="已送出")
+    failed_count = models.PositiveIntegerField(default=0, verbose_name="失敗")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="建立時間")
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name="開始發送")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="發送完成")
+
+    class Meta:
+        verbose_name = "行銷推播"
+        verbose_name_plural = "行銷推播"
+
+    def __str__(self):
+        return self.name
+
+
+class CampaignRecipient(models.Model):
+    """
+    推播收件者與發送進度；batch 是送出時分配的批次編號 (決定 X-Line-Retry-Key)，
+    重送同一批時 LINE 不會重複發送
+    """
+    STATUS_PENDING = "pending"
+    STATUS_SENT = "sent"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "等待中"),
+        (STATUS_SENT, "已送出"),
+        (STATUS_FAILED, "失敗"),
+    ]
+
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name="recipients",
+                                 verbose_name="行銷推播")
+    user_id = models.CharField(max_length=64, verbose_name="LINE userId")
+    batch = models.PositiveIntegerField(blank=True, null=True, verbose_name="批次")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name="狀態")
+    error = models.TextField(blank=True, default="", verbose_name="錯誤")
+
+    class Meta:
+        verbose_name = "推播收件者"
+        verbose_name_plural = "推播收件者"
+        constraints = [
+            models.UniqueConstraint(fields=["campaign", "user_id"], name="bot_campaign_recipient_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["campaign", "status", "batch"], name="bot_campaign_progress_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.campaign_id}:{self.user_id} ({self.status})"
@@ -0,0 +1,170 @@
+import os
+import re
+import time
+import uuid
+
+from django.conf import settings
+
+from . import media_store, metrics
+
+# 使用者照片 (合成用) 的參數 (可用環境變數調整)
+PHOTO_MAX_UPLOAD_MB = int(os.getenv("PHOTO_MAX_UPLOAD_MB", "20"))  # 單張原始照片的大小上限
+PHOTO_MAX_PIXELS = int(os.getenv("PHOTO_MAX_PIXELS", str(60_000_000)))  # 解碼前先檢查，超過就拒絕
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1024"))  # 送給生圖模型前縮到的最長邊 (px)
+PHOTO_MAX_BYTES = 1024 * 1024
+# 在聊天室傳了第一張照片後，等第二張照片的秒數
+PHOTO_SESSION_TTL = int(os.getenv("PHOTO_SESSION_TTL", "1800"))
+# 沒被用掉的照片 (例如生圖失敗) 保留多久後由 run_worker 刪除
+PHOTO_RETENTION = int(os.getenv("PHOTO_RETENTION", str(60 * 60 * 24)))
+
+UPLOAD_DIR = "uploads"
+
+
+class PhotoError(ValueError):
+    """
+    無法使用的照片 (太大、不是圖片)
+    """
+
+
+def upload_dir(*parts) -> str:
+    # 放在 BOT_STATE_DIR 而不是 MEDIA_ROOT：使用者的原始照片不對外提供
+    path = os.path.join(settings.BOT_STATE_DIR, UPLOAD_DIR, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def save_stream(chunks, max_bytes: int = None) -> str:
+    """
+    把逐段產生的 bytes 寫到暫存檔並回傳路徑 (記憶體只會放一段)；
+    超過 max_bytes 立即停止並丟出 PhotoError
+    """
+    if max_bytes is None:
+        max_bytes = PHOTO_MAX_UPLOAD_MB * 1024 * 1024
+    path = os.path.join(upload_dir("tmp"), f"{uuid.uuid4().hex}.raw")
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PhotoError(f"photo larger than {max_bytes} bytes")
+                f.write(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+    return path
+
+
+def prepare(raw_path: str, dest_dir: str) -> str:
+    """
+    把原始照片轉成最長邊 PHOTO_MAX_SIDE 的 JPEG (依 EXIF 轉正) 存到 dest_dir，回傳路徑。
+    JPEG 以 draft 模式直接在解碼時縮小 (1/2 ~ 1/8)，大照片也不必先解出全尺寸的像素
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(raw_path) as image:
+            if image.width * image.height > PHOTO_MAX_PIXELS:
+                raise PhotoError(f"photo has too many pixels ({image.width}x{image.height})")
+            image.draft("RGB", (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+            data = media_store._encode_jpeg(image, PHOTO_MAX_BYTES, quality=85)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise PhotoError(f"not a usable image: {e}") from e
+
+    path = os.path.join(dest_dir, f"{time.time_ns()}-{uuid.uuid4().hex[:8]}.jpg")
+    media_store._write_atomic(path, data)
+    return path
+
+
+def ingest(chunks, dest_dir: str) -> str:
+    """
+    串流存檔 → 縮小轉檔 → 刪除原始檔，回傳縮小後的照片路徑
+    """
+    with metrics.span("photo_ingest"):
+        raw_path = save_stream(chunks)
+        try:
+            return prepare(raw_path, dest_dir)
+        finally:
+            _remove(raw_path)
+
+
+def _user_dir(user_id: str) -> str:
+    return upload_dir("pending", re.sub(r"[^A-Za-z0-9_-]", "", user_id or "")[:64] or "anonymous")
+
+
+def add_pending(user_id: str, chunks) -> list:
+    """
+    記下使用者在聊天室傳來的照片，回傳目前等待合成的照片 (由舊到新，過期的會先刪除)
+    """
+    directory = _user_dir(user_id)
+    ingest(chunks, directory)
+    cutoff = time.time() - PHOTO_SESSION_TTL
+    pending = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.getmtime(path) < cutoff:
+            _remove(path)
+        else:
+            pending.append(path)
+    return pending
+
+
+def take_pending(user_id: str, count: int = 2) -> list:
+    """
+    取出最早的 count 張照片 (移到工作目錄，交給生圖工作)，其餘的丟棄；不足 count 張時回傳空 list
+    """
+    directory = _user_dir(user_id)
+    names = sorted(os.listdir(directory))
+    if len(names) < count:
+        return []
+    taken = []
+    for name in names[:count]:
+        path = os.path.join(upload_dir("jobs"), name)
+        os.replace(os.path.join(directory, name), path)
+        taken.append(path)
+    for name in names[count:]:
+        _remove(os.path.join(directory, name))
+    return taken
+
+
+def read(paths: list) -> list:
+    """
+    讀取縮小後的照片，回傳 [(bytes, mime_type), ...] (每張最多 PHOTO_MAX_BYTES)
+    """
+    photos = []
+    for path in paths:
+        with open(path, "rb") as f:
+            photos.append((f.read(), "image/jpeg"))
+    return photos
+
+
+def discard(paths: list):
+    for path in paths:
+        _remove(path)
+
+
+def purge(max_age: int = PHOTO_RETENTION) -> int:
+    """
+    刪除超過 max_age 秒的照片 (生圖失敗或沒等到第二張的)
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    for root, _, names in os.walk(upload_dir()):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+    return removed
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Least
+
+from . import stats
+from .models import RateBucket
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# 令牌桶閒置多久 (秒) 後刪除；此時早已補滿，刪掉與保留的效果相同
+RATE_LIMIT_IDLE_TTL = int(os.getenv("RATE_LIMIT_IDLE_TTL", "3600"))
+
+
+class TokenBucket:
+    """
+    令牌桶：每秒補充 rate 個令牌，最多累積 capacity 個；acquire() 在令牌不足時等待。
+    可在多個執行緒之間共用
+    """
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        令牌足夠時取走並回傳 0，否則回傳還要等幾秒
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        等到取得 tokens 個令牌，回傳等待的秒數
+        """
+        if tokens > self.capacity:
+            raise ValueError(f"cannot acquire {tokens} tokens from a bucket of {self.capacity}")
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(tokens)
+            if not delay:
+                return waited
+            self._sleep(delay)
+            waited += delay
+
+
+class RateLimited(Exception):
+    """
+    超過限流且排隊時間會超過上限；scope 為 "user" (這位使用者太頻繁) 或 "global" (整體配額用完)
+    """
+
+    def __init__(self, limit_name: str, scope: str):
+        super().__init__(f"{limit_name} rate limit exceeded ({scope})")
+        self.limit_name = limit_name
+        self.scope = scope
+
+
+class Limit:
+    """
+    一種 Gemini 呼叫的限流設定：每位使用者一個令牌桶、所有人共用一個令牌桶。
+    rate 為每秒補充的令牌數 (0 表示不限制)，burst 為最多累積的令牌數，
+    max_wait 為超過限制時最多排隊等待的秒數
+    """
+
+    def __init__(self, name: str, user_rate: float, user_burst: float, global_rate: float,
+                 global_burst: float, max_wait: float):
+        self.name = name
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_wait = max_wait
+
+    def __repr__(self):
+        return f"<Limit {self.name}>"
+
+
+def _env_limit(name: str, user_rate: str, user_burst: str, global_rate: str, global_burst: str,
+               max_wait: str) -> Limit:
+    prefix = name.upper()
+    return Limit(
+        name,
+        user_rate=float(os.getenv(f"{prefix}_USER_RATE", user_rate)),
+        user_burst=float(os.getenv(f"{prefix}_USER_BURST", user_burst)),
+        global_rate=float(os.getenv(f"{prefix}_GLOBAL_RATE", global_rate)),
+        global_burst=float(os.getenv(f"{prefix}_GLOBAL_BURST", global_burst)),
+        max_wait=float(os.getenv(f"{prefix}_MAX_WAIT", max_wait)),
+    )
+
+
+# 對話：每人平均 5 秒一則 (可連發 5 則)，全體每秒 10 次；生圖：每人每分鐘 1 張 (可連發 3 張)，全體每 2 秒 1 張
+CHAT = _env_limit("chat", "0.2", "5", "10", "20", "5")
+IMAGE = _env_limit("image", "0.0167", "3", "0.5", "2", "60")
+
+
+def _reserve(key: str, rate: float, burst: float, max_wait: float, tokens: float = 1.0):
+    """
+    在共用令牌桶預約 tokens 個令牌，回傳要等幾秒才輪到 (0 表示立即可用)；
+    需要等超過 max_wait 秒時不預約並回傳 None。
+    令牌可以預約到負數，後來的請求排在前面的預約之後，等待順序與到達順序相同
+    """
+    now = time.time()
+    available = Least(Value(float(burst)), F("tokens") + (Value(now) - F("updated")) * Value(float(rate)))
+    # UPDATE 會先取得 SQLite 的寫入鎖，之後同一個 transaction 內讀到的就是自己寫入的值
+    with transaction.atomic():
+        reserved = (RateBucket.objects.filter(key=key)
+                    .alias(available=available)
+                    .filter(available__gte=tokens - rate * max_wait)
+                    .update(tokens=available - tokens, updated=now))
+        if reserved:
+            left = RateBucket.objects.filter(key=key).values_list("tokens", flat=True).get()
+        elif RateBucket.objects.filter(key=key).exists():
+            return None
+        else:
+            left = float(burst) - tokens
+            RateBucket.objects.create(key=key, tokens=left, updated=now)
+    return max(0.0, -left / rate)
+
+
+def _refund(key: str, burst: float, tokens: float = 1.0):
+    RateBucket.objects.filter(key=key).update(tokens=Least(Value(float(burst)), F("tokens") + tokens))
+
+
+def reserve(limit: Limit, user_id: str = None) -> float:
+    """
+    依序預約使用者與全體的令牌，回傳需要等待的秒數；
+    任一邊要等超過 limit.max_wait 時取消預約並丟出 RateLimited
+    """
+    if not RATE_LIMIT_ENABLED:
+        return 0.0
+
+    user_key = f"{limit.name}:user:{user_id}" if user_id and limit.user_rate > 0 else None
+    user_wait = 0.0
+    if user_key:
+        user_wait = _reserve(user_key, limit.user_rate, limit.user_burst, limit.max_wait)
+        if user_wait is None:
+            stats.incr(f"ratelimit.{limit.name}.rejected_user")
+            raise RateLimited(limit.name, "user")
+
+    global_wait = 0.0
+    if limit.global_rate > 0:
+        global_wait = _reserve(f"{limit.name}:global", limit.global_rate, limit.global_burst, limit.max_wait)
+        if global_wait is None:
+            # 整體配額用完：把剛才預約的使用者令牌還回去
+            if user_key:
+                _refund(user_key, limit.user_burst)
+            stats.incr(f"ratelimit.{limit.name}.rejected_global")
+            raise RateLimited(limit.name, "global")
+
+    wait = max(user_wait, global_wait)
+    stats.incr(f"ratelimit.{limit.name}.{'delayed' if wait else 'allowed'}")
+    return wait
+
+
+def acquire(limit: Limit, user_id: str = None) -> float:
+    """
+    取得呼叫許可 (必要時排隊等待)，回傳等待的秒數；等不到時丟出 RateLimited
+    """
+    wait = reserve(limit, user_id)
+    if wait:
+        time.sleep(wait)
+    return wait
+
+
+async def aacquire(limit: Limit, user_id: str = None) -> float:
+    """
+    acquire 的 async 版本：排隊時不佔用執行緒
+    """
+    wait = await sync_to_async(reserve)(limit, user_id)
+    if wait:
+        await asyncio.sleep(wait)
+    return wait
+
+
+def purge_idle() -> int:
+    """
+    刪除閒置過久 (早已補滿) 的令牌桶
+    """
+    deleted, _ = RateBucket.objects.filter(updated__lt=time.time() - RATE_LIMIT_IDLE_TTL).delete()
+    return deleted
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import unicodedata
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.utils import timezone
+
+from . import stats
+from .models import ReplyCacheEntry
+
+# 快取參數 (可用環境變數調整)
+REPLY_CACHE_ENABLED = os.getenv("REPLY_CACHE_ENABLED", "1") == "1"
+REPLY_CACHE_TTL = int(os.getenv("REPLY_CACHE_TTL", "600"))  # 秒
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "500"))
+# 命中時更新最後使用時間的最小間隔，避免熱門問題每次都寫資料庫
+REPLY_CACHE_TOUCH_INTERVAL = int(os.getenv("REPLY_CACHE_TOUCH_INTERVAL", "30"))
+
+
+def normalize(text: str) -> str:
+    """
+    正規化使用者訊息：全形/半形統一 (NFKC)、英文不分大小寫、去掉空白與標點符號。
+    例如「 最近有什麼活動？」與「最近有什麼活動?」會得到同一個結果。
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return "".join(
+        ch for ch in text
+        if not unicodedata.category(ch).startswith(("P", "Z", "C"))
+    )
+
+
+def make_key(text: str):
+    normalized = normalize(text)
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def get(text: str):
+    """
+    取得快取的回覆，沒有或已過期回傳 None
+    """
+    key = make_key(text)
+    if not REPLY_CACHE_ENABLED or key is None:
+        return None
+
+    now = timezone.now()
+    entry = ReplyCacheEntry.objects.filter(key=key, expires_at__gt=now).only("value", "last_access").first()
+    if entry is None:
+        stats.incr("reply_cache.miss")
+        return None
+
+    if now - entry.last_access > timedelta(seconds=REPLY_CACHE_TOUCH_INTERVAL):
+        ReplyCacheEntry.objects.filter(pk=entry.pk).update(last_access=now)
+    stats.incr("reply_cache.hit")
+    return entry.value
+
+
+def set(text: str, value):
+    """
+    寫入快取，超過數量上限時淘汰最久沒被使用的項目 (LRU)
+    """
+    key = make_key(text)
+    if not REPLY_CACHE_ENABLED or key is None:
+        return
+    if hasattr(value, "to_dict"):
+        # 預先序列化的 Flex Message 以一般 dict 存入
+        value = value.to_dict()
+
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=REPLY_CACHE_TTL)
+    try:
+        ReplyCacheEntry.objects.update_or_create(
+            key=key, defaults={"value": value, "expires_at": expires_at, "last_access": now}
+        )
+    except IntegrityError:
+        # 另一個 worker 同時寫入同一個 key，以對方的結果為準
+        return
+
+    ReplyCacheEntry.objects.filter(expires_at__lte=now).delete()
+    stale = list(
+        ReplyCacheEntry.objects.order_by("-last_access").values_list("id", flat=True)[REPLY_CACHE_MAX_ENTRIES:]
+    )
+    if stale:
+        ReplyCacheEntry.objects.filter(id__in=stale).delete()
+        stats.incr("reply_cache.evicted", len(stale))
+
+
+def clear():
+    """
+    清除所有快取 (活動資料異動時呼叫)
+    """
+    ReplyCacheEntry.objects.all().delete()
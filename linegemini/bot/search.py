@@ -0,0 +1,198 @@
+import heapq
+import os
+import threading
+from collections import Counter, defaultdict
+from itertools import chain
+from operator import itemgetter
+
+from . import versioning
+from .models import Activity
+from .reply_cache import normalize
+
+# 活動搜尋參數 (可用環境變數調整)
+ACTIVITY_SEARCH_MIN_SCORE = float(os.getenv("ACTIVITY_SEARCH_MIN_SCORE", "0.3"))
+ACTIVITY_SEARCH_INDEX_LOCATION = os.getenv("ACTIVITY_SEARCH_INDEX_LOCATION", "1") == "1"
+LOCATION_WEIGHT = 0.1  # 地點符合只當作加分，不會蓋過名稱
+# 只對共同 bigram 最多的前幾名計算精確分數，活動很多時仍能維持在毫秒以下
+CANDIDATE_POOL = 64
+
+VERSION_NAME = versioning.ACTIVITIES
+
+# 常見繁體/簡體字對照 (統一轉成簡體再切 bigram)，讓「臺北」「台北」「马拉松」都能對到
+_VARIANTS = (
+    "臺台灣湾馬马會会節节藝艺術术覽览樂乐動动遊游園园區区東东門门廣广場场電电腦脑書书圖图館馆華华"
+    "麗丽龍龙鳳凤鬧闹躍跃運运賽赛隊队兒儿親亲愛爱體体驗验發发現现實实際际國国經经濟济業业產产農农"
+    "漁渔縣县鄉乡鎮镇島岛陽阳陰阴燈灯煙烟講讲學学習习課课營营宮宫廟庙聖圣誕诞慶庆歡欢聯联誼谊鐘钟"
+    "聲声見见觀观導导飲饮廳厅湯汤魚鱼雞鸡鳥鸟貓猫寵宠車车鐵铁機机飛飞線线網网絡络設设計计師师攝摄"
+    "視视聽听讀读寫写畫画詩诗詞词劇剧戲戏團团員员創创聞闻報报雜杂誌志紀纪錄录歷历傳传統统風风時时"
+    "間间問问題题點点處处個个們们這这麼么為为與与來来後后裡里過过還还對对說说話话請请謝谢讓让給给"
+    "從从開开關关長长萬万兩两幾几級级號号碼码價价錢钱買买賣卖優优獎奖禮礼贈赠預预約约參参環环綠绿"
+    "藍蓝紅红黃黄銀银寶宝貝贝夢梦蹟迹懷怀舊旧鬆松"
+)
+_FOLD = str.maketrans(_VARIANTS[0::2], _VARIANTS[1::2])
+
+
+def fold(text: str) -> str:
+    """
+    搜尋用的正規化：全半形、大小寫、標點 (同回覆快取) 再加上繁簡統一
+    """
+    return normalize(text).translate(_FOLD)
+
+
+def bigrams(text: str) -> set:
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class ActivityIndex:
+    """
+    活動名稱 (與地點) 的字元 bigram 倒排索引，每個 worker 在記憶體中保留一份。
+    分數取「活動名稱被查詢涵蓋的比例」與 Dice 係數的較大者，再加上地點的加分。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._name_postings = {}  # bigram -> frozenset(pk)；地點只用來加分，不需要倒排
+        self._docs = {}  # pk -> (name, 名稱 bigrams, 地點 bigrams)
+        self.version = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    # 寫入時一律換成新的 set (copy-on-write)，查詢不必加鎖也不會遇到迭代中被修改
+
+    def add(self, pk, name: str, location: str = ""):
+        with self._lock:
+            self._remove(pk)
+            self._add(self._name_postings, self._docs, pk, name, location)
+
+    @staticmethod
+    def _grams(name, location):
+        name_grams = bigrams(fold(name))
+        location_grams = bigrams(fold(location or "")) if ACTIVITY_SEARCH_INDEX_LOCATION else set()
+        return name_grams, location_grams
+
+    @classmethod
+    def _add(cls, name_postings, docs, pk, name, location):
+        name_grams, location_grams = cls._grams(name, location)
+        for gram in name_grams:
+            name_postings[gram] = name_postings.get(gram, frozenset()) | {pk}
+        docs[pk] = (name, name_grams, location_grams)
+
+    def remove(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    def _remove(self, pk):
+        doc = self._docs.pop(pk, None)
+        if doc is None:
+            return
+        for gram in doc[1]:
+            remaining = self._name_postings.get(gram, frozenset()) - {pk}
+            if remaining:
+                self._name_postings[gram] = remaining
+            else:
+                self._name_postings.pop(gram, None)
+
+    def rebuild(self, rows):
+        """
+        rows: (pk, name, location) 的序列；建好新的索引後一次換上
+        """
+        name_postings, docs = defaultdict(set), {}
+        for pk, name, location in rows:
+            name_grams, location_grams = self._grams(name, location)
+            for gram in name_grams:
+                name_postings[gram].add(pk)
+            docs[pk] = (name, name_grams, location_grams)
+        name_postings = {gram: frozenset(pks) for gram, pks in name_postings.items()}
+        with self._lock:
+            self._name_postings, self._docs = name_postings, docs
+
+    def search(self, query: str, limit: int = 5, min_score: float = 0.0) -> list:
+        """
+        回傳依分數排序的 [(分數, pk, 活動名稱), ...]
+        """
+        query_grams = bigrams(fold(query))
+        if not query_grams:
+            return []
+
+        name_postings, docs = self._name_postings, self._docs
+        # Counter 的計數在 C 裡完成，比逐一 += 1 快很多
+        name_hits = Counter(chain.from_iterable(name_postings.get(gram, ()) for gram in query_grams))
+        if not name_hits:
+            return []
+
+        # 共同 bigram 數比最多者少 2 個以上的活動幾乎不可能排到前面，先略過
+        pool = max(CANDIDATE_POOL, limit)
+        if len(name_hits) > pool:
+            floor = max(1, max(name_hits.values()) - 1)
+            candidates = [(pk, common) for pk, common in name_hits.items() if common >= floor]
+            if len(candidates) > pool:
+                candidates = heapq.nlargest(pool, candidates, key=itemgetter(1))
+        else:
+            candidates = name_hits.items()
+
+        results = []
+        for pk, common in candidates:
+            doc = docs.get(pk)
+            if doc is None:
+                continue
+            name, name_grams, location_grams = doc
+            score = max(common / len(name_grams), 2 * common / (len(query_grams) + len(name_grams)))
+            if location_grams:
+                location_common = len(query_grams & location_grams)
+                if location_common:
+                    score += LOCATION_WEIGHT * location_common / len(location_grams)
+            if score >= min_score:
+                results.append((score, pk, name))
+
+        results.sort(key=lambda r: (-r[0], r[1]))
+        return results[:limit]
+
+
+_index = ActivityIndex()
+_build_lock = threading.Lock()
+
+
+def get_index() -> ActivityIndex:
+    """
+    取得本 worker 的活動索引；其他 process 修改過活動 (版本號不同) 時整份重建
+    """
+    version = versioning.current(VERSION_NAME)
+    if _index.version != version:
+        with _build_lock:
+            if _index.version != version:
+                _index.rebuild(Activity.objects.values_list("pk", "name", "location").iterator())
+                _index.version = version
+    return _index
+
+
+def on_activity_saved(activity):
+    """
+    由 post_save signal 呼叫：本 worker 增量更新索引，再通知其他 worker
+    """
+    old, new = versioning.bump(VERSION_NAME)
+    with _build_lock:
+        if _index.version == old:
+            _index.add(activity.pk, activity.name, activity.location)
+            _index.version = new
+
+
+def on_activity_deleted(pk):
+    old, new = versioning.bump(VERSION_NAME)
+    with _build_lock:
+        if _index.version == old:
+            _index.remove(pk)
+            _index.version = new
+
+
+def invalidate():
+    """
+    大量匯入等不經過 signal 的異動後呼叫，所有 worker 下次查詢時重建
+    """
+    versioning.bump(VERSION_NAME)
+
+
+def search_activities(query: str, limit: int = 5, min_score: float = ACTIVITY_SEARCH_MIN_SCORE) -> list:
+    return get_index().search(query, limit=limit, min_score=min_score)
@@ -0,0 +1,38 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import flex, reply_cache, search
+from .models import Activity
+
+
+def activities_changed():
+    """
+    活動資料異動後要清掉的快取都集中在這裡 (大量匯入後也只需呼叫一次)
+    """
+    reply_cache.clear()
+    search.invalidate()
+    flex.clear()
+
+
+# 等交易 commit 之後才通知，避免其他 worker 在 commit 前就用舊資料重建
+
+
+@receiver(post_save, sender=Activity, dispatch_uid="bot_activity_saved")
+def on_activity_saved(sender, instance, **kwargs):
+    def changed():
+        reply_cache.clear()
+        search.on_activity_saved(instance)
+        flex.forget(instance.pk)
+    transaction.on_commit(changed)
+
+
+@receiver(post_delete, sender=Activity, dispatch_uid="bot_activity_deleted")
+def on_activity_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+
+    def changed():
+        reply_cache.clear()
+        search.on_activity_deleted(pk)
+        flex.forget(pk)
+    transaction.on_commit(changed)
@@ -0,0 +1,35 @@
+import os
+import threading
+
+from django.utils import timezone
+
+from . import flex, versioning
+from .models import Activity
+
+RECENT_ACTIVITIES_LIMIT = int(os.getenv("RECENT_ACTIVITIES_LIMIT", "5"))
+
+# (日期, 活動版本號, 輪播訊息或 None)
+_recent = None
+_lock = threading.Lock()
+
+
+def recent_activities():
+    """
+    取得「最近活動」輪播的快照；日期沒變且活動沒被修改 (版本號相同) 時直接回傳，
+    不查資料庫。沒有進行中的活動時回傳 None。
+    """
+    global _recent
+    today = timezone.localdate()
+    version = versioning.current(versioning.ACTIVITIES)
+    snapshot = _recent
+    if snapshot is not None and snapshot[0] == today and snapshot[1] == version:
+        return snapshot[2]
+
+    with _lock:
+        snapshot = _recent
+        if snapshot is not None and snapshot[0] == today and snapshot[1] == version:
+            return snapshot[2]
+        activities = list(Activity.objects.upcoming(today).for_rendering()[:RECENT_ACTIVITIES_LIMIT])
+        message = flex.activity_carousel(activities, alt_text="最近活動列表") if activities else None
+        _recent = (today, version, message)
+        return message
@@ -0,0 +1,102 @@
+import atexit
+import os
+import threading
+import time
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import Counter
+
+# 計數器先累積在記憶體，每隔幾秒 (由下一次 incr 順便) 一次寫入資料庫；
+# 回覆、生圖等熱路徑上不必每加一次就開一個 SQLite 寫入交易
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+
+_pending = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def incr(name: str, amount: int = 1):
+    """
+    計數器加 amount (累積在記憶體，超過 STATS_FLUSH_INTERVAL 秒才寫入)
+    """
+    with _lock:
+        _pending[name] = _pending.get(name, 0) + amount
+    flush_if_due()
+
+
+def due() -> bool:
+    """
+    是否有累積的計數且距離上次寫入已超過 STATS_FLUSH_INTERVAL 秒
+    """
+    return bool(_pending) and time.monotonic() - _last_flush >= STATS_FLUSH_INTERVAL
+
+
+def flush_if_due():
+    """
+    需要時寫入累積的計數 (閒置的 worker 迴圈也會定期呼叫)；寫入失敗就留到下一次，不影響呼叫端
+    """
+    if not due():
+        return
+    try:
+        flush()
+    except Exception as e:
+        print(f"Stats flush failed: {e}")
+
+
+def flush():
+    """
+    把累積的計數寫入資料庫 (一個交易；以 UPDATE ... SET value = value + n 執行，多個 worker 同時加也不會掉數)
+    """
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, {}
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+    try:
+        with transaction.atomic():
+            for name, amount in pending.items():
+                if not Counter.objects.filter(name=name).update(value=F("value") + amount):
+                    counter, created = Counter.objects.get_or_create(name=name, defaults={"value": amount})
+                    if not created:
+                        Counter.objects.filter(name=name).update(value=F("value") + amount)
+    except Exception:
+        with _lock:
+            for name, amount in pending.items():
+                _pending[name] = _pending.get(name, 0) + amount
+        raise
+
+
+def snapshot(prefix: str = "") -> dict:
+    """
+    取得目前所有 (或指定前綴) 計數器的值；其他 process 尚未寫入的部分最多晚 STATS_FLUSH_INTERVAL 秒。
+    資料庫忙碌而寫不進去時回傳上次已寫入的值，累積的計數留到下一次
+    """
+    try:
+        flush()
+    except Exception as e:
+        print(f"Stats flush failed: {e}")
+    qs = Counter.objects.all()
+    if prefix:
+        qs = qs.filter(name__startswith=prefix)
+    return dict(qs.order_by("name").values_list("name", "value"))
+
+
+def _flush_at_exit():
+    global _last_flush
+    _last_flush = float("-inf")
+    flush_if_due()
+
+
+def _after_fork():
+    # gunicorn --preload 的 worker 不繼承 master 還沒寫入的計數 (否則會重複計算)
+    global _lock, _pending
+    _lock = threading.Lock()
+    _pending = {}
+
+
+atexit.register(_flush_at_exit)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -1,3 +1,2118 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import jobs, stats, views
+from .models import Job
+
+# 測試時計數器每次都直接寫入，不會把上一個測試累積的計數帶進下一個測試的交易
+stats.STATS_FLUSH_INTERVAL = 0
+
+
+def _signed(body: bytes, secret: str) -> str:
+    mac = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(mac).decode("utf-8")
+
+
+def _text_event(text, user_id="U1", token="r1"):
+    return {
+        "type": "message",
+        "replyToken": token,
+        "source": {"type": "user", "userId": user_id},
+        "message": {"type": "text", "text": text},
+    }
+
+
+class WebhookQueueTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(views, "LINE_CHANNEL_SECRET", "secret")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_webhook_enqueues_events_without_calling_gemini(self):
+        body = json.dumps({"events": [_text_event("hi"), _text_event("yo", "U2")]}).encode()
+        with mock.patch("bot.ai_reply.get_gemini_response") as gemini:
+            resp = self.client.post(
+                "/bot/webhook/", body, content_type="application/json",
+                HTTP_X_LINE_SIGNATURE=_signed(body, "secret"),
+            )
+        self.assertEqual(resp.status_code, 200)
+        gemini.assert_not_called()
+        self.assertEqual(Job.objects.filter(kind=jobs.KIND_LINE_EVENT).count(), 2)
+
+    def _post(self, events):
+        body = json.dumps({"events": events}).encode()
+        return self.client.post("/bot/webhook/", body, content_type="application/json",
+                                HTTP_X_LINE_SIGNATURE=_signed(body, "secret"))
+
+    def test_redelivered_event_is_dropped(self):
+        from . import dedupe
+
+        dedupe.clear()
+        self.addCleanup(dedupe.clear)
+        event = dict(_text_event("hi"), webhookEventId="01HEVENT1")
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post([event])
+        self.assertTrue(dedupe._seen_recently("01HEVENT1"))
+        redelivery = dict(event, deliveryContext={"isRedelivery": True})
+        self._post([redelivery])
+        # 另一個 worker (記憶體中沒有紀錄) 收到重送也要靠資料表擋下
+        dedupe.clear()
+        self._post([redelivery, dict(_text_event("yo"), webhookEventId="01HEVENT2")])
+
+        self.assertEqual(Job.objects.count(), 2)
+        self.assertEqual(stats.snapshot("webhook."), {"webhook.duplicates": 2, "webhook.redeliveries": 2})
+
+    def test_concurrent_registration_keeps_one_copy(self):
+        from . import dedupe
+        from .models import WebhookEvent
+
+        dedupe.clear()
+        self.addCleanup(dedupe.clear)
+        events = [dict(_text_event("hi"), webhookEventId="01HEVENT1"),
+                  dict(_text_event("hi"), webhookEventId="01HEVENT1"), _text_event("no id")]
+        # 模擬另一個 worker 在查詢之後、寫入之前先登記了 01HEVENT2
+        WebhookEvent.objects.create(event_id="01HEVENT2")
+        with mock.patch.object(dedupe, "_existing", return_value=set()):
+            jobs.enqueue_line_events(events + [dict(_text_event("x"), webhookEventId="01HEVENT2")])
+
+        self.assertEqual([job.payload["message"]["text"] for job in Job.objects.order_by("pk")], ["hi", "no id"])
+
+    def test_expired_event_ids_are_purged(self):
+        from . import dedupe
+        from .models import WebhookEvent
+
+        WebhookEvent.objects.create(event_id="old", created_at=timezone.now() - timedelta(days=2))
+        WebhookEvent.objects.create(event_id="new")
+        self.assertEqual(dedupe.purge_expired(), 1)
+        self.assertEqual(list(WebhookEvent.objects.values_list("event_id", flat=True)), ["new"])
+
+    def test_invalid_signature_is_rejected(self):
+        body = json.dumps({"events": [_text_event("hi")]}).encode()
+        resp = self.client.post("/bot/webhook/", body, content_type="application/json",
+                                HTTP_X_LINE_SIGNATURE="bad")
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Job.objects.exists())
+
+
+class JobQueueTests(TestCase):
+    def test_claim_locks_jobs(self):
+        jobs.enqueue_line_events([_text_event("a"), _text_event("b")])
+        first = jobs.claim(jobs.KIND_LINE_EVENT, 5)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(jobs.claim(jobs.KIND_LINE_EVENT, 5), [])
+
+    def test_expired_lock_is_reclaimed(self):
+        jobs.enqueue_line_events([_text_event("a")])
+        job = jobs.claim(jobs.KIND_LINE_EVENT, 1)[0]
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        again = jobs.claim(jobs.KIND_LINE_EVENT, 1)
+        self.assertEqual([j.pk for j in again], [job.pk])
+        self.assertEqual(again[0].attempts, 2)
+
+    def test_retry_then_fail(self):
+        jobs.enqueue_line_events([_text_event("a")])
+        job = jobs.claim(jobs.KIND_LINE_EVENT, 1)[0]
+        jobs.retry_or_fail(job, RuntimeError("boom"), max_attempts=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_PENDING)
+        self.assertGreater(job.available_at, timezone.now())
+
+        Job.objects.filter(pk=job.pk).update(available_at=timezone.now())
+        job = jobs.claim(jobs.KIND_LINE_EVENT, 1, max_attempts=2)[0]
+        jobs.retry_or_fail(job, RuntimeError("boom"), max_attempts=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+
+    def test_permanent_error_is_not_retried(self):
+        jobs.enqueue_line_events([_text_event("a")])
+        job = jobs.claim(jobs.KIND_LINE_EVENT, 1)[0]
+        jobs.retry_or_fail(job, jobs.PermanentJobError("token expired"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+
+    def test_lane_extends_lock_before_each_job(self):
+        jobs.enqueue_line_events([_text_event("a", "U1"), _text_event("b", "U1")])
+        first, second = jobs.claim(jobs.KIND_LINE_EVENT, 5, visibility_timeout=60)
+        # 前一個工作做了快 60 秒，輪到 "b" 時它的鎖快到期：開始前重新鎖定 60 秒
+        Job.objects.filter(pk=second.pk).update(locked_until=timezone.now() + timedelta(seconds=5))
+        second.refresh_from_db()
+        self.assertTrue(jobs.extend_lock(second, 60))
+        second.refresh_from_db()
+        self.assertGreater(second.locked_until, timezone.now() + timedelta(seconds=50))
+
+    def test_reclaimed_job_is_not_run_or_released(self):
+        jobs.enqueue_line_events([_text_event("a", "U1"), _text_event("b", "U1")])
+        first, second = jobs.claim(jobs.KIND_LINE_EVENT, 5, visibility_timeout=60)
+        # 鎖過期後另一個 worker 重新取走 "b"
+        Job.objects.filter(pk=second.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        jobs.complete(first)
+        stale = Job.objects.get(pk=second.pk)
+        self.assertEqual([j.pk for j in jobs.claim(jobs.KIND_LINE_EVENT, 5)], [second.pk])
+
+        self.assertFalse(jobs.extend_lock(stale, 60))
+        jobs.release(stale)
+        second.refresh_from_db()
+        self.assertEqual(second.status, Job.STATUS_RUNNING)
+        self.assertEqual(second.attempts, 2)
+
+
+    def test_claim_keeps_per_user_order(self):
+        jobs.enqueue_line_events([_text_event("a", "U1"), _text_event("b", "U2")])
+        first = jobs.claim(jobs.KIND_LINE_EVENT, 5)
+        jobs.enqueue_line_events([_text_event("c", "U1"), _text_event("d", "U3")])
+        # U1 還有處理中的事件，後來的 "c" 不能先被取走
+        second = jobs.claim(jobs.KIND_LINE_EVENT, 5)
+        self.assertEqual([j.payload["message"]["text"] for j in second], ["d"])
+
+        jobs.complete(first[0])
+        third = jobs.claim(jobs.KIND_LINE_EVENT, 5)
+        self.assertEqual([j.payload["message"]["text"] for j in third], ["c"])
+
+
+class LaneDispatchTests(TestCase):
+    # 併發與順序以執行中的數量、barrier 與事件的先後判斷；耗時只用寬鬆的上限 (CI 負載高時秒數不可靠)
+    def _run_batch(self, events, max_workers, before=None):
+        log = []
+        lock = threading.Lock()
+        inflight = {"now": 0, "peak": 0}
+
+        def handle(event):
+            with lock:
+                inflight["now"] += 1
+                inflight["peak"] = max(inflight["peak"], inflight["now"])
+            if before:
+                before(event)
+            time.sleep(event["delay"])
+            with lock:
+                inflight["now"] -= 1
+                log.append((event["user"], event["seq"]))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            started = time.perf_counter()
+            for future in jobs.run_in_lanes(pool, events, key=lambda e: e["user"], fn=handle):
+                future.result()
+            elapsed = time.perf_counter() - started
+        return elapsed, inflight["peak"], log
+
+    def test_batch_latency_close_to_slowest_event(self):
+        delays = [0.05, 0.1, 0.15, 0.2, 0.1, 0.05, 0.15, 0.2, 0.1, 0.05]
+        events = [{"user": f"U{i}", "seq": 0, "delay": d} for i, d in enumerate(delays)]
+
+        elapsed, _, log = self._run_batch(events, max_workers=10)
+
+        self.assertEqual(len(log), 10)
+        # 依序處理要 sum(delays)=1.15 秒，併發後應接近最慢的單一事件 0.2 秒
+        self.assertLess(elapsed, sum(delays) / 2)
+        self.assertLess(elapsed, max(delays) * 3)
+
+    def test_different_users_run_concurrently(self):
+        delays = [0.05, 0.1, 0.15, 0.2, 0.1, 0.05, 0.15, 0.2, 0.1, 0.05]
+        events = [{"user": f"U{i}", "seq": 0, "delay": d} for i, d in enumerate(delays)]
+        # 10 位使用者的事件必須同時在處理中才能通過 barrier (依序處理會逾時)
+        barrier = threading.Barrier(len(events), timeout=10)
+
+        _, peak, log = self._run_batch(events, max_workers=10, before=lambda e: barrier.wait())
+
+        self.assertEqual(len(log), 10)
+        self.assertEqual(peak, 10)
+
+    def test_same_user_events_stay_ordered(self):
+        events = [
+            {"user": "U1", "seq": 0, "delay": 0.01},
+            {"user": "U2", "seq": 0, "delay": 0.01},
+            {"user": "U1", "seq": 1, "delay": 0.01},
+            {"user": "U1", "seq": 2, "delay": 0.0},
+        ]
+        u2_started = threading.Event()
+        waited = []
+
+        def before(event):
+            if event["user"] == "U2":
+                u2_started.set()
+            elif event["seq"] == 0:
+                # U1 的第一則處理到一半時 U2 就要開始，U2 不需要等 U1
+                waited.append(u2_started.wait(timeout=10))
+
+        _, _, log = self._run_batch(events, max_workers=4, before=before)
+        self.assertEqual([seq for user, seq in log if user == "U1"], [0, 1, 2])
+        self.assertEqual(waited, [True])
+
+    def test_concurrency_is_bounded(self):
+        events = [{"user": f"U{i}", "seq": 0, "delay": 0.05} for i in range(6)]
+        _, peak, log = self._run_batch(events, max_workers=2)
+        self.assertEqual(len(log), 6)
+        self.assertLessEqual(peak, 2)
+
+    def test_failed_event_releases_rest_of_lane(self):
+        skipped = []
+        items = ["a", "b", "c"]
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            wait(jobs.run_in_lanes(pool, items, key=lambda _: "U1",
+                                   fn=lambda item: item != "a", on_skip=skipped.append))
+        self.assertEqual(skipped, ["b", "c"])
+
+
+class WorkerCommandTests(TransactionTestCase):
+    @mock.patch("bot.handlers.line_reply")
+    @mock.patch("bot.handlers.send_loading_animation")
+    @mock.patch("bot.handlers.get_gemini_response", return_value="hello")
+    def test_worker_drains_queue(self, gemini, loading, reply):
+        from django.core.management import call_command
+
+        jobs.enqueue_line_events([_text_event("a"), {"type": "follow"}])
+        call_command("run_worker", "--once", "--poll-interval", "0.01", stdout=mock.MagicMock())
+        reply.assert_called_once_with("r1", "hello")
+        self.assertEqual(Job.objects.filter(status=Job.STATUS_DONE).count(), 2)
+
+
+class ImageJobTests(TestCase):
+    def test_generate_returns_job_id_without_generating(self):
+        with mock.patch("bot.handlers.gen_ai_img") as gen:
+            response = self.client.post("/bot/liff/generate/", data=json.dumps({"prompt": "cat"}),
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        gen.assert_not_called()
+        data = response.json()
+        job = Job.objects.get(pk=data["job_id"])
+        self.assertEqual(job.kind, jobs.KIND_IMAGE)
+        self.assertEqual(job.payload["base_url"], "http://testserver/")
+
+        status = self.client.get(data["status_url"]).json()
+        self.assertEqual(status, {"job_id": job.pk, "status": "queued"})
+
+    def test_status_reports_result(self):
+        from .handlers import handle_image_job
+
+        job = jobs.enqueue_image("cat", base_url="https://example.com/", user_id="U1", push=True)
+        claimed = jobs.claim(jobs.KIND_IMAGE, 1)[0]
+        status_url = f"/bot/liff/generate/{job.pk}/?userId=U1"
+        self.assertEqual(self.client.get(status_url).json()["status"], "running")
+
+        with mock.patch("bot.handlers.gen_ai_img", return_value="https://example.com/media/a.png") as gen, \
+                mock.patch("bot.handlers.push_generated_image") as push:
+            jobs.complete(claimed, handle_image_job(claimed.payload))
+        gen.assert_called_once_with("cat", base_url="https://example.com/", fresh=False, user_id="U1")
+        push.assert_called_once_with("U1", "https://example.com/media/a.png")
+
+        status = self.client.get(status_url).json()
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(status["image_url"], "https://example.com/media/a.png")
+        self.assertTrue(status["pushed"])
+        self.assertEqual(self.client.get("/bot/liff/generate/999999/").status_code, 404)
+
+    def test_status_is_only_visible_to_owner(self):
+        response = self.client.post("/bot/liff/generate/", data=json.dumps({"prompt": "cat", "userId": "U1"}),
+                                    content_type="application/json")
+        data = response.json()
+        self.assertTrue(data["status_url"].endswith(f"/{data['job_id']}/?userId=U1"))
+        self.assertEqual(self.client.get(data["status_url"]).json()["status"], "queued")
+
+        # 沒帶 userId 或帶別人的 userId 都當作不存在
+        self.assertEqual(self.client.get(f"/bot/liff/generate/{data['job_id']}/").status_code, 404)
+        self.assertEqual(self.client.get(f"/bot/liff/generate/{data['job_id']}/?userId=U2").status_code, 404)
+
+    def test_global_concurrency_cap(self):
+        for prompt in "abcd":
+            jobs.enqueue_image(prompt)
+        # 兩個 worker 各自還有空位，但全域上限為 2
+        first = jobs.claim(jobs.KIND_IMAGE, 4, max_running=2)
+        second = jobs.claim(jobs.KIND_IMAGE, 4, max_running=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(second, [])
+
+        jobs.complete(first[0], {"image_url": "x"})
+        self.assertEqual(len(jobs.claim(jobs.KIND_IMAGE, 4, max_running=2)), 1)
+
+        # 鎖定逾時 (worker 重啟) 的工作不佔名額，會被重新取出
+        Job.objects.filter(status=Job.STATUS_RUNNING).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(jobs.claim(jobs.KIND_IMAGE, 4, max_running=2)), 2)
+
+
+class _TempMediaMixin:
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.media_root = tmp.name + "/media"
+        override = override_settings(MEDIA_ROOT=self.media_root, BOT_STATE_DIR=tmp.name + "/var")
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class ImageCacheTests(_TempMediaMixin, TransactionTestCase):
+
+    def _generator(self, delay=0.0):
+        calls = []
+
+        def generate():
+            calls.append(1)
+            time.sleep(delay)
+            return b"png-bytes", "image/png"
+        return generate, calls
+
+    def test_repeat_prompt_served_from_disk(self):
+        from . import ai_reply
+
+        generate, calls = self._generator()
+        with mock.patch.object(ai_reply, "GEMINI_API_KEY", "key"), \
+                mock.patch.object(ai_reply, "_generate_image", side_effect=lambda prompt, photos=(): generate()):
+            first = ai_reply.gen_ai_img("cute robot", base_url="https://example.com/")
+            again = ai_reply.gen_ai_img("  cute   robot ", base_url="https://example.com/")
+            fresh = ai_reply.gen_ai_img("cute robot", base_url="https://example.com/", fresh=True)
+
+        self.assertEqual(first, again)
+        self.assertTrue(first.startswith("https://example.com/media/generated_images/"))
+        self.assertNotEqual(fresh, first)
+        self.assertEqual(len(calls), 2)
+
+    def test_concurrent_identical_prompts_generate_once(self):
+        from . import image_cache
+
+        generate, calls = self._generator(delay=0.1)
+        key = image_cache.cache_key("m", "cute robot", {})
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            names = list(pool.map(lambda _: image_cache.get_or_generate(key, generate), range(8)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(set(names), {key + ".png"})
+        self.assertEqual(stats.snapshot("image_cache."), {"image_cache.miss": 1, "image_cache.shared": 7})
+
+    def test_waits_for_other_process_holding_lock(self):
+        from . import image_cache, media_store, versioning
+
+        generate, calls = self._generator()
+        key = image_cache.cache_key("m", "brand", {})
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # 模擬另一個 process 正在生成同一張圖
+            with versioning.lock(f"image-{key}"):
+                future = pool.submit(image_cache.get_or_generate, key, generate)
+                time.sleep(0.05)
+                self.assertFalse(future.done())
+                media_store.write(b"other", "image/png", stem=key)
+            self.assertEqual(future.result(timeout=5), key + ".png")
+        self.assertEqual(calls, [])
+
+
+class ImageHedgeTests(_TempMediaMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from . import ai_reply
+
+        self.ai_reply = ai_reply
+        self.patches = [
+            mock.patch.object(ai_reply, "GEMINI_API_KEY", "key"),
+            mock.patch.object(ai_reply, "IMAGE_HEDGE_DELAY", 0.05),
+            mock.patch.object(ai_reply, "IMAGE_DEADLINE", 1.0),
+            mock.patch.object(ai_reply, "IMAGE_BREAKER_THRESHOLD", 2),
+            mock.patch.object(ai_reply.image_cache, "IMAGE_CACHE_ENABLED", False),
+            mock.patch.object(ai_reply, "_primary_latencies", ai_reply.deque(maxlen=200)),
+        ]
+        # 各測試自己的執行緒池，結束前等落後的主模型跑完，才不會寫到其他測試的目錄
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        self.patches.append(mock.patch.object(ai_reply, "_image_pool", return_value=self.pool))
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        self.pool.shutdown(wait=True)
+        for patch in self.patches:
+            patch.stop()
+        super().tearDown()
+
+    def _primary(self, delay=0.0, fail=False):
+        def generate(prompt, photos=()):
+            time.sleep(delay)
+            if fail:
+                raise RuntimeError("model overloaded")
+            return b"primary", "image/png"
+        return mock.patch.object(self.ai_reply, "_generate_image", side_effect=generate)
+
+    def _fallback(self, delay=0.0):
+        def download(prompt, timeout):
+            time.sleep(delay)
+            return b"fallback", "image/png"
+        return mock.patch.object(self.ai_reply, "_fallback_image", side_effect=download)
+
+    def _read(self, url):
+        from . import media_store
+
+        with open(os.path.join(media_store.image_dir(), url.rsplit("/", 1)[1]), "rb") as f:
+            return f.read()
+
+    def test_fast_primary_never_hedges(self):
+        with self._primary(), self._fallback() as fallback:
+            url = self.ai_reply.gen_ai_img("robot", base_url="https://example.com/")
+        self.assertEqual(self._read(url), b"primary")
+        fallback.assert_not_called()
+        self.assertEqual(self.ai_reply.image_monitor()["paths"]["primary"]["wins"], 1)
+
+    def test_slow_primary_is_hedged_by_fallback(self):
+        with self._primary(delay=0.5), self._fallback():
+            url = self.ai_reply.gen_ai_img("robot", base_url="https://example.com/")
+        self.assertEqual(self._read(url), b"fallback")
+        counters = stats.snapshot("image.")
+        self.assertEqual(counters["image.hedged"], 1)
+        self.assertEqual(counters["image.fallback.win"], 1)
+
+    def test_failed_primary_falls_back_immediately(self):
+        with self._primary(fail=True), self._fallback():
+            started = time.monotonic()
+            url = self.ai_reply.gen_ai_img("robot", base_url="https://example.com/")
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(self._read(url), b"fallback")
+
+    def test_deadline_returns_placeholder(self):
+        with mock.patch.object(self.ai_reply, "IMAGE_DEADLINE", 0.2), \
+                self._primary(delay=0.5), self._fallback(delay=0.5):
+            started = time.monotonic()
+            url = self.ai_reply.gen_ai_img("robot", base_url="https://example.com/")
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertIn("Generation+Failed", url)
+        self.assertEqual(stats.snapshot("image.failed"), {"image.failed": 1})
+
+    def test_breaker_opens_and_skips_primary(self):
+        from . import breaker
+
+        with self._primary(fail=True) as primary, self._fallback():
+            self.ai_reply.gen_ai_img("a", base_url="https://example.com/")
+            self.ai_reply.gen_ai_img("b", base_url="https://example.com/")
+            self.assertEqual(primary.call_count, 2)
+            self.assertEqual(breaker.state(self.ai_reply.IMAGE_BREAKER)["state"], "open")
+
+            url = self.ai_reply.gen_ai_img("c", base_url="https://example.com/")
+        self.assertEqual(primary.call_count, 2)
+        self.assertEqual(self._read(url), b"fallback")
+        self.assertEqual(stats.snapshot("image.breaker_skipped"), {"image.breaker_skipped": 1})
+
+    def test_half_open_allows_one_trial(self):
+        from . import breaker
+        from .models import CircuitBreaker
+
+        name = "svc"
+        self.assertTrue(breaker.record_failure(name, threshold=1, cooldown=60))
+        self.assertFalse(breaker.allow(name, cooldown=60))
+
+        CircuitBreaker.objects.filter(name=name).update(opened_until=timezone.now())
+        self.assertTrue(breaker.allow(name, cooldown=60))
+        self.assertFalse(breaker.allow(name, cooldown=60))  # 試探期間其他請求仍走備援
+
+        breaker.record_success(name)
+        self.assertEqual(breaker.state(name)["state"], "closed")
+        self.assertTrue(breaker.allow(name, cooldown=60))
+
+    def test_failed_trial_reopens(self):
+        from . import breaker
+        from .models import CircuitBreaker
+
+        breaker.record_failure("svc", threshold=1, cooldown=60)
+        CircuitBreaker.objects.filter(name="svc").update(opened_until=timezone.now())
+        self.assertTrue(breaker.allow("svc", cooldown=60))
+        self.assertTrue(breaker.record_failure("svc", threshold=5, cooldown=60))
+        self.assertFalse(breaker.allow("svc", cooldown=60))
+
+    def test_hedge_delay_tracks_primary_p95(self):
+        self.assertEqual(self.ai_reply.hedge_delay(), 0.05)
+        self.ai_reply._primary_latencies.extend([0.1] * 19 + [0.9])
+        self.assertEqual(self.ai_reply.hedge_delay(), 0.1)
+        # nearest-rank：30 個樣本的 p95 是第 ceil(28.5) = 29 個
+        self.ai_reply._primary_latencies.clear()
+        self.ai_reply._primary_latencies.extend([i / 100 for i in range(1, 31)])
+        self.assertEqual(self.ai_reply.hedge_delay(), 0.29)
+
+    def test_rate_limit_wait_is_not_counted_against_primary(self):
+        from . import breaker, ratelimit
+
+        def slow_acquire(limit, user_id=None):
+            time.sleep(0.3)  # 排隊等限流，超過 hedge 時間
+            return 0.3
+
+        with mock.patch.object(ratelimit, "acquire", side_effect=slow_acquire) as acquire, \
+                self._primary(), self._fallback() as fallback:
+            url = self.ai_reply.gen_ai_img("robot", base_url="https://example.com/", user_id="U1")
+        acquire.assert_called_once_with(ratelimit.IMAGE, "U1")
+        self.assertEqual(self._read(url), b"primary")
+        fallback.assert_not_called()
+        self.assertEqual(breaker.state(self.ai_reply.IMAGE_BREAKER)["failures"], 0)
+
+    def test_rate_limited_before_any_call(self):
+        from . import ratelimit
+
+        with mock.patch.object(ratelimit, "acquire", side_effect=ratelimit.RateLimited("image", "user")), \
+                self._primary() as primary, self._fallback() as fallback, \
+                self.assertRaises(ratelimit.RateLimited):
+            self.ai_reply.gen_ai_img("robot", base_url="https://example.com/", user_id="U1")
+        primary.assert_not_called()
+        fallback.assert_not_called()
+
+    def test_monitor_endpoint(self):
+        with self._primary(delay=0.5), self._fallback():
+            self.ai_reply.gen_ai_img("robot", base_url="https://example.com/")
+        data = self.client.get("/bot/stats/image/").json()
+        self.assertEqual(data["breaker"]["state"], "closed")
+        self.assertEqual(data["hedged"], 1)
+        self.assertEqual(data["paths"]["fallback"]["wins"], 1)
+        self.assertEqual(data["paths"]["fallback"]["count"], 1)
+
+
+def _png(width, height):
+    import io
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class MediaStoreTests(_TempMediaMixin, TestCase):
+    def test_caps_original_and_writes_preview(self):
+        import os
+        from PIL import Image
+        from . import media_store
+        from .models import StoredImage
+
+        name = media_store.write(_png(3000, 1500), "image/png", stem="big")
+        self.assertEqual(name, "big.jpg")
+        directory = os.path.join(self.media_root, "generated_images")
+        with Image.open(os.path.join(directory, name)) as original:
+            self.assertEqual(original.size, (2048, 1024))
+
+        stored = StoredImage.objects.get(name=name)
+        preview_path = os.path.join(directory, stored.preview_name)
+        with Image.open(preview_path) as preview:
+            self.assertEqual(preview.format, "JPEG")
+            self.assertEqual(max(preview.size), media_store.PREVIEW_MAX_SIDE)
+        self.assertLess(os.path.getsize(preview_path), media_store.PREVIEW_MAX_BYTES)
+
+        # 在限制內的 PNG 原樣保存
+        self.assertEqual(media_store.write(_png(64, 64), "image/png", stem="small"), "small.png")
+
+    def test_lru_eviction_under_quota(self):
+        from . import media_store
+        from .models import StoredImage
+
+        for stem in ("a", "b", "c"):
+            media_store.write(_png(64, 64), "image/png", stem=stem)
+        StoredImage.objects.filter(name="a.png").update(last_access=timezone.now() - timedelta(hours=2))
+        StoredImage.objects.filter(name="b.png").update(last_access=timezone.now() - timedelta(hours=1))
+        media_store.touch("a.png")  # a 剛被使用過，應該淘汰 b
+
+        size = StoredImage.objects.get(name="c.png").size
+        self.assertEqual(media_store.enforce_quota(quota_bytes=size * 2), 1)
+        self.assertEqual(sorted(StoredImage.objects.values_list("name", flat=True)), ["a.png", "c.png"])
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, "generated_images", "b.png")))
+
+    def test_send_uses_preview_url(self):
+        from . import media_store
+
+        media_store.write(_png(64, 64), "image/png", stem="cat")
+        url = "https://example.com/media/generated_images/cat.png"
+        self.assertEqual(media_store.preview_url(url), "https://example.com/media/generated_images/previews/cat.jpg")
+        self.assertEqual(media_store.preview_url("https://other.example/x.png"), "https://other.example/x.png")
+
+        with mock.patch.object(views, "get_line_client") as client:
+            views.push_generated_image("U1", url)
+        image = client.return_value.push.call_args[0][1][0]
+        self.assertEqual(image["originalContentUrl"], url)
+        self.assertEqual(image["previewImageUrl"], "https://example.com/media/generated_images/previews/cat.jpg")
+
+        # LIFF 的傳送按鈕走 async view 與 async client
+        async_client = mock.MagicMock(push=mock.AsyncMock())
+        with mock.patch.object(views, "get_async_line_client", return_value=async_client):
+            response = self.client.post("/bot/liff/send/", data=json.dumps({"userId": "U1", "imageUrl": url}),
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(async_client.push.call_args[0][1], views.generated_image_messages(url))
+
+
+def _jpeg(width, height):
+    import io
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (30, 120, 200)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def _chunks(data, size=64 * 1024):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def _image_event(message_id, user_id="U1", token="r1"):
+    return {
+        "type": "message",
+        "replyToken": token,
+        "source": {"type": "user", "userId": user_id},
+        "message": {"type": "image", "id": message_id, "contentProvider": {"type": "line"}},
+        "baseUrl": "https://example.com/",
+    }
+
+
+class PhotoTests(_TempMediaMixin, TestCase):
+
+    def test_large_photo_is_downscaled_to_bounded_jpeg(self):
+        from PIL import Image
+        from . import photos
+
+        path = photos.ingest(_chunks(_jpeg(4000, 3000)), photos.upload_dir("jobs"))
+        with Image.open(path) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(max(image.size), photos.PHOTO_MAX_SIDE)
+        self.assertLessEqual(os.path.getsize(path), photos.PHOTO_MAX_BYTES)
+        self.assertEqual(os.listdir(photos.upload_dir("tmp")), [])
+
+    def test_oversized_or_invalid_upload_is_rejected(self):
+        from . import photos
+
+        with self.assertRaises(photos.PhotoError):
+            photos.save_stream(_chunks(b"x" * 300 * 1024), max_bytes=200 * 1024)
+        with self.assertRaises(photos.PhotoError):
+            photos.ingest([b"not an image"], photos.upload_dir("jobs"))
+        with mock.patch.object(photos, "PHOTO_MAX_PIXELS", 100):
+            with self.assertRaises(photos.PhotoError):
+                photos.ingest([_jpeg(20, 20)], photos.upload_dir("jobs"))
+        self.assertEqual(os.listdir(photos.upload_dir("tmp")), [])
+        self.assertEqual(os.listdir(photos.upload_dir("jobs")), [])
+
+    def test_liff_upload_enqueues_composite_job(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post("/bot/liff/photos/", {
+            "portrait": SimpleUploadedFile("me.jpg", _jpeg(2000, 3000), content_type="image/jpeg"),
+            "scene": SimpleUploadedFile("park.jpg", _jpeg(3000, 2000), content_type="image/jpeg"),
+            "prompt": "夕陽", "userId": "U1", "push": "true",
+        })
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(pk=response.json()["job_id"])
+        self.assertEqual((job.kind, job.payload["prompt"], job.payload["push"]), (jobs.KIND_IMAGE, "夕陽", True))
+        self.assertEqual(len(job.payload["photos"]), 2)
+        self.assertTrue(all(os.path.getsize(p) <= 1024 * 1024 for p in job.payload["photos"]))
+
+        missing = self.client.post("/bot/liff/photos/", {
+            "portrait": SimpleUploadedFile("me.jpg", _jpeg(20, 20), content_type="image/jpeg")})
+        self.assertEqual(missing.status_code, 400)
+
+        with mock.patch("bot.photos.PHOTO_MAX_UPLOAD_MB", 0):
+            too_large = self.client.post("/bot/liff/photos/", {
+                "portrait": SimpleUploadedFile("me.jpg", b"x" * 100 * 1024, content_type="image/jpeg"),
+                "scene": SimpleUploadedFile("park.jpg", b"x", content_type="image/jpeg")})
+        self.assertEqual(too_large.status_code, 413)
+
+    def test_chat_photos_are_collected_then_composited(self):
+        from . import handlers
+
+        line = mock.Mock()
+        line.iter_content.side_effect = lambda message_id: _chunks(_jpeg(1600, 1200), 8 * 1024)
+        with mock.patch("bot.handlers.get_line_client", return_value=line), \
+                mock.patch("bot.handlers.line_reply") as reply:
+            handlers.handle_line_event(_image_event("m1", token="r1"))
+            self.assertFalse(Job.objects.filter(kind=jobs.KIND_IMAGE).exists())
+            handlers.handle_line_event(_image_event("m2", token="r2"))
+
+        self.assertEqual(reply.call_args_list, [
+            mock.call("r1", handlers.PHOTO_RECEIVED_REPLY), mock.call("r2", handlers.PHOTO_COMPOSING_REPLY)])
+        self.assertEqual([c.args for c in line.iter_content.call_args_list], [("m1",), ("m2",)])
+        job = Job.objects.get(kind=jobs.KIND_IMAGE)
+        self.assertEqual((job.payload["user_id"], job.payload["push"], job.payload["base_url"]),
+                         ("U1", True, "https://example.com/"))
+        portrait, scene = job.payload["photos"]
+        self.assertLess(os.path.basename(portrait), os.path.basename(scene))
+
+        with mock.patch("bot.handlers.gen_composite_img", return_value="https://example.com/media/c.jpg") as gen, \
+                mock.patch("bot.handlers.push_generated_image") as push:
+            result = handlers.handle_image_job(job.payload)
+        prompt, inputs = gen.call_args.args
+        self.assertEqual([mime for _, mime in inputs], ["image/jpeg", "image/jpeg"])
+        push.assert_called_once_with("U1", "https://example.com/media/c.jpg")
+        self.assertEqual(result["image_url"], "https://example.com/media/c.jpg")
+        self.assertFalse(os.path.exists(portrait) or os.path.exists(scene))
+
+    def test_invalid_chat_photo_gets_a_reply(self):
+        from . import handlers
+
+        line = mock.Mock()
+        line.iter_content.return_value = [b"garbage"]
+        with mock.patch("bot.handlers.get_line_client", return_value=line), \
+                mock.patch("bot.handlers.line_reply") as reply:
+            handlers.handle_line_event(_image_event("m1"))
+        reply.assert_called_once_with("r1", handlers.PHOTO_INVALID_REPLY)
+
+    def test_composite_sends_photos_with_prompt_and_saves_result(self):
+        from . import ai_reply
+
+        inputs = [(b"portrait", "image/jpeg"), (b"scene", "image/jpeg")]
+        with mock.patch.object(ai_reply, "GEMINI_API_KEY", "key"), \
+                mock.patch.object(ai_reply, "_generate_image", return_value=(_png(64, 64), "image/png")) as gen:
+            url = ai_reply.gen_composite_img("海邊", inputs, base_url="https://example.com/")
+        prompt, photos = gen.call_args.args
+        self.assertTrue(prompt.startswith(ai_reply.COMPOSITE_PROMPT) and prompt.endswith("海邊"))
+        self.assertEqual(photos, inputs)
+        self.assertTrue(url.startswith("https://example.com/media/generated_images/"))
+
+    def test_webhook_records_base_url_for_image_messages(self):
+        image = _image_event("m1")
+        del image["baseUrl"]
+        body = json.dumps({"events": [image, _text_event("hi", token="r2")]}).encode()
+        with mock.patch.object(views, "LINE_CHANNEL_SECRET", "s"):
+            self.client.post("/bot/webhook/", body, content_type="application/json",
+                             HTTP_X_LINE_SIGNATURE=_signed(body, "s"))
+        payloads = [job.payload for job in Job.objects.order_by("id")]
+        self.assertEqual(payloads[0]["baseUrl"], "http://testserver/")
+        self.assertNotIn("baseUrl", payloads[1])
+
+
+class MediaServingTests(_TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        directory = os.path.join(self.media_root, "generated_images")
+        os.makedirs(directory)
+        self.data = bytes(range(256)) * 8
+        with open(os.path.join(directory, "abc.png"), "wb") as f:
+            f.write(self.data)
+        self.url = "/media/generated_images/abc.png"
+
+    def test_full_response_is_cacheable(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        self.assertEqual(response["Content-Type"], "image/png")
+        # 以快取 key 命名的圖片可能被淘汰後以同一個網址重新生成，不能 immutable
+        self.assertEqual(response["Cache-Control"], "public, max-age=3600, must-revalidate")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], response["ETag"])
+
+    def test_uuid_named_images_are_immutable(self):
+        import uuid
+
+        name = f"{uuid.uuid4()}.png"
+        with open(os.path.join(self.media_root, "generated_images", name), "wb") as f:
+            f.write(self.data)
+        response = self.client.get(f"/media/generated_images/{name}")
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.data)}")
+
+        suffix = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(suffix.streaming_content), self.data[-5:])
+
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE="bytes=99999-").status_code, 416)
+        # 無效的 Range (結尾在起點之前) 依 RFC 9110 忽略，回傳整個檔案
+        invalid = self.client.get(self.url, HTTP_RANGE="bytes=5-3")
+        self.assertEqual(invalid.status_code, 200)
+        self.assertEqual(b"".join(invalid.streaming_content), self.data)
+        # If-Range 不符 (檔案已變更) 時回傳整個檔案
+        stale = self.client.get(self.url, HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"old"')
+        self.assertEqual(stale.status_code, 200)
+
+    def test_missing_or_outside_files(self):
+        self.assertEqual(self.client.get("/media/generated_images/nope.png").status_code, 404)
+        self.assertEqual(self.client.get("/media/generated_images/../../etc/passwd").status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+
+class AsyncWorkerTests(TransactionTestCase):
+    def test_hundreds_of_conversations_in_flight(self):
+        from django.core.management import call_command
+
+        inflight = {"now": 0, "peak": 0}
+
+        async def fake_gemini(text, user_id=None, remember=True):
+            inflight["now"] += 1
+            inflight["peak"] = max(inflight["peak"], inflight["now"])
+            await asyncio.sleep(0.3)
+            inflight["now"] -= 1
+            return f"re:{text}"
+
+        events = [_text_event(f"m{i}", user_id=f"U{i}", token=f"r{i}") for i in range(200)]
+        events.append(_text_event("second", user_id="U0", token="r-second"))
+        jobs.enqueue_line_events(events)
+
+        with mock.patch("bot.handlers.aget_gemini_response", side_effect=fake_gemini), \
+                mock.patch("bot.handlers.asend_loading_animation", new=mock.AsyncMock()), \
+                mock.patch("bot.handlers.aline_reply", new=mock.AsyncMock()) as reply, \
+                mock.patch("bot.handlers._compact"):
+            started = time.perf_counter()
+            call_command("run_worker", "--async", "--once", "--concurrency", "300",
+                         "--poll-interval", "0.01", stdout=mock.MagicMock())
+            elapsed = time.perf_counter() - started
+
+        self.assertEqual(Job.objects.filter(status=Job.STATUS_DONE).count(), 201)
+        self.assertGreaterEqual(inflight["peak"], 200)
+        # 依序處理要 60 秒，async 下接近單一對話的 0.3 秒 (再加上資料庫操作)
+        self.assertLess(elapsed, 10)
+        tokens = [c.args[0] for c in reply.call_args_list]
+        # 同一使用者的訊息仍依序回覆
+        self.assertLess(tokens.index("r0"), tokens.index("r-second"))
+
+
+class LoadTestKitTests(TestCase):
+
+    def test_signed_webhook_passes_signature_check(self):
+        from . import loadtest
+
+        events = loadtest.text_events(3, run_id="t", users=2)
+        self.assertEqual([e["source"]["userId"] for e in events], ["Ut0", "Ut1", "Ut0"])
+        self.assertEqual(len({e["webhookEventId"] for e in events}), 3)
+
+        body, signature = loadtest.signed_webhook(events, "secret")
+        with mock.patch.object(views, "LINE_CHANNEL_SECRET", "secret"):
+            resp = self.client.post("/bot/webhook/", body, content_type="application/json",
+                                    HTTP_X_LINE_SIGNATURE=signature)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Job.objects.count(), 3)
+
+    def test_percentiles_nearest_rank(self):
+        from . import loadtest
+
+        self.assertEqual(loadtest.percentiles(list(range(1, 101))), {50: 50, 95: 95, 99: 99})
+        self.assertEqual(loadtest.percentiles([0.2]), {50: 0.2, 95: 0.2, 99: 0.2})
+        self.assertEqual(loadtest.percentiles([]), {50: None, 95: None, 99: None})
+
+    def test_fake_upstream_speaks_gemini_and_line(self):
+        from google import genai
+        from google.genai import types
+
+        from . import loadtest
+        from .line_api import LineClient
+
+        upstream = loadtest.FakeUpstream(line_ms=0, gemini_ms=0, token_ms=0, image_ms=0,
+                                         function_call_ratio=0.5, image_model="image-model")
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(upstream.handle, "127.0.0.1", 0))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.close()
+        self.addCleanup(stop)
+
+        base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        client = genai.Client(api_key="k", http_options=types.HttpOptions(base_url=base_url))
+
+        first = client.models.generate_content(model="chat-model", contents="hi")
+        second = client.models.generate_content(model="chat-model", contents="hi")
+        self.assertEqual(first.text, loadtest.FAKE_REPLY)
+        self.assertEqual(second.function_calls[0].name, loadtest.FAKE_TOOL)
+
+        chunks = [c.text for c in client.models.generate_content_stream(model="chat-model", contents="hi")]
+        self.assertEqual("".join(chunks), loadtest.FAKE_REPLY)
+        self.assertGreater(len(chunks), 1)
+
+        image = next(iter(client.models.generate_content_stream(model="image-model", contents="cat")))
+        self.assertEqual(image.candidates[0].content.parts[0].inline_data.mime_type, "image/png")
+
+        line = LineClient("t", base_url=base_url)
+        line.reply("r1", [{"type": "text", "text": "hi"}])
+        stats = requests.get(base_url + "/__stats", timeout=5).json()
+        self.assertEqual(stats["counts"]["line.message.reply"], 1)
+        self.assertEqual(stats["counts"]["gemini.chat.generateContent"], 2)
+
+
+class LineClientTests(TestCase):
+    def _serve(self, statuses):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                seen.append((self.headers.get("X-Line-Retry-Key"),
+                             self.rfile.read(int(self.headers["Content-Length"]))))
+                status = statuses.pop(0) if statuses else 200
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}", seen
+
+    def test_push_retries_429_with_same_retry_key(self):
+        from .line_api import LineClient
+
+        base_url, seen = self._serve([429, 503])
+        client = LineClient("t", base_url=base_url, backoff=0)
+        client.push("U1", [{"type": "text", "text": "嗨"}])
+
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len({key for key, _ in seen}), 1)
+        # 精簡序列化：不跳脫中文、沒有多餘空白
+        self.assertEqual(seen[0][1], '{"to":"U1","messages":[{"type":"text","text":"嗨"}]}'.encode())
+
+    async def test_async_push_retries_429_with_same_retry_key(self):
+        from .line_api import AsyncLineClient
+
+        base_url, seen = self._serve([429, 503])
+        client = AsyncLineClient("t", base_url=base_url, backoff=0)
+        try:
+            await client.push("U1", [{"type": "text", "text": "嗨"}])
+            self.assertEqual(len(seen), 3)
+            self.assertEqual(len({key for key, _ in seen}), 1)
+            self.assertEqual(seen[0][1], '{"to":"U1","messages":[{"type":"text","text":"嗨"}]}'.encode())
+
+            # 400 不重試
+            base_url, seen = self._serve([400])
+            client.client.base_url = base_url
+            with self.assertRaises(httpx.HTTPStatusError):
+                await client.reply("r1", [{"type": "text", "text": "x"}])
+        finally:
+            await client.aclose()
+
+    def test_async_client_is_only_cached_on_long_lived_loops(self):
+        from asgiref.sync import async_to_sync
+
+        from . import line_api
+
+        async def client_for(long_lived):
+            if long_lived:
+                line_api.mark_long_lived_loop()
+            client = line_api.get_async_line_client()
+            same = client is line_api.get_async_line_client()
+            if long_lived:
+                await line_api.close_async_line_client()
+            return client, same
+
+        # async_to_sync 每次都是新的 loop：改走同步 LineClient，不會留下沒關閉的 httpx client
+        before = len(line_api._async_clients)
+        for _ in range(3):
+            client, _same = async_to_sync(client_for)(False)
+            self.assertIsInstance(client, line_api.ThreadedLineClient)
+        self.assertEqual(len(line_api._async_clients), before)
+
+        client, same = async_to_sync(client_for)(True)
+        self.assertIsInstance(client, line_api.AsyncLineClient)
+        self.assertTrue(same)
+        self.assertTrue(client.client.is_closed)
+        self.assertEqual(len(line_api._async_clients), before)
+
+        with mock.patch.object(line_api.LineClient, "push") as push:
+            async_to_sync(line_api.ThreadedLineClient().push)("U1", [{"type": "text", "text": "x"}])
+        push.assert_called_once_with("U1", [{"type": "text", "text": "x"}], retry_key=None)
+
+    def test_to_messages(self):
+        from .line_api import to_messages
+
+        flex = {"type": "flex", "altText": "x", "contents": {}}
+        self.assertEqual(to_messages(flex), [flex])
+        self.assertEqual(to_messages("a" * 6000), [{"type": "text", "text": "a" * 4900}])
+
+
+class _FakeFunctionCall:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+class _FakeResponse:
+    def __init__(self, text="", function_calls=None):
+        self.text = text
+        self.function_calls = function_calls
+
+
+class GeminiClientTests(TestCase):
+    def setUp(self):
+        from . import gemini
+
+        gemini.reset()
+        self.addCleanup(gemini.reset)
+        patcher = mock.patch("bot.ai_reply.GEMINI_API_KEY", "key")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_and_config_are_built_once(self):
+        from . import ai_reply
+
+        with mock.patch("google.genai.Client") as client_cls:
+            client_cls.return_value.models.generate_content.return_value = _FakeResponse("你好")
+            self.assertEqual(ai_reply.get_gemini_response("hi"), "你好")
+            self.assertEqual(ai_reply.get_gemini_response("hi again"), "你好")
+
+        client_cls.assert_called_once()
+        configs = [c.kwargs["config"] for c in client_cls.return_value.models.generate_content.call_args_list]
+        self.assertIs(configs[0], configs[1])
+
+    def test_function_call_dispatches_tool(self):
+        from . import ai_reply
+
+        response = _FakeResponse(function_calls=[_FakeFunctionCall("get_studio_introduction", {})])
+        with mock.patch("google.genai.Client") as client_cls:
+            client_cls.return_value.models.generate_content.return_value = response
+            result = ai_reply.get_gemini_response("介紹工作室")
+
+        self.assertEqual(result["altText"], "工作室介紹影片")
+
+
+class _FakeMulticastClient:
+    def __init__(self, errors=None):
+        self.calls = []
+        self.errors = errors or {}  # retry key -> 狀態碼
+        self._lock = threading.Lock()
+
+    def multicast(self, to, messages, retry_key=None):
+        with self._lock:
+            self.calls.append((list(to), messages, retry_key))
+        if retry_key in self.errors:
+            response = requests.Response()
+            response.status_code = self.errors[retry_key]
+            raise requests.HTTPError(f"{response.status_code} error", response=response)
+
+
+class CampaignTests(TestCase):
+    def setUp(self):
+        from .models import Activity, Campaign
+
+        self.activity = Activity.objects.create(name="台北馬拉松", end_date=timezone.localdate() + timedelta(days=3),
+                                                location="台北", description="路跑")
+        self.campaign = Campaign.objects.create(name="spring", activity_ids=[self.activity.pk], text="春季活動開跑")
+
+    def test_sends_multicast_in_chunks_with_flex_card(self):
+        from . import campaigns
+        from .flex import FlexMessage
+        from .models import Campaign, CampaignRecipient
+
+        users = [f"U{i}" for i in range(1201)]
+        self.assertEqual(campaigns.add_recipients(self.campaign, users + ["U0", "", "# comment"]), 1201)
+        client = _FakeMulticastClient()
+        result = campaigns.send(self.campaign, client=client, rate=1000, concurrency=4)
+
+        self.assertEqual(sorted(len(to) for to, _, _ in client.calls), [201, 500, 500])
+        self.assertEqual(sorted(u for to, _, _ in client.calls for u in to), sorted(users))
+        self.assertEqual(len({key for _, _, key in client.calls}), 3)
+        text, card = client.calls[0][1]
+        self.assertEqual(text, {"type": "text", "text": "春季活動開跑"})
+        self.assertIsInstance(card, FlexMessage)
+        self.assertEqual(card["altText"], "台北馬拉松 活動資訊")
+        self.assertEqual((result["recipients"], result["requests"], result["failed"]), (1201, 3, 0))
+
+        self.campaign.refresh_from_db()
+        self.assertEqual((self.campaign.status, self.campaign.sent_count), (Campaign.STATUS_DONE, 1201))
+        self.assertFalse(CampaignRecipient.objects.exclude(status=CampaignRecipient.STATUS_SENT).exists())
+
+    def test_recent_chatters_skips_idle_conversations(self):
+        from django.core.management import call_command
+
+        from .models import Conversation
+
+        Conversation.objects.create(user_id="U-recent")
+        idle = Conversation.objects.create(user_id="U-idle")
+        Conversation.objects.filter(pk=idle.pk).update(updated_at=timezone.now() - timedelta(hours=2))
+
+        result = {"recipients": 1, "requests": 1, "failed": 0, "seconds": 0.1, "per_second": 10}
+        with mock.patch("bot.campaigns.send", return_value=result):
+            call_command("send_campaign", "spring", "--recent-chatters", stdout=mock.MagicMock())
+        self.assertEqual(list(self.campaign.recipients.values_list("user_id", flat=True)), ["U-recent"])
+
+    def test_resume_resends_unconfirmed_batch_with_same_retry_key(self):
+        from . import campaigns
+        from .models import CampaignRecipient
+
+        campaigns.add_recipients(self.campaign, [f"U{i}" for i in range(1000)])
+        pks = list(self.campaign.recipients.order_by("pk").values_list("pk", flat=True))
+        # 上次執行：第 1 批已確認送出，第 2 批送出後還沒記錄就中斷
+        CampaignRecipient.objects.filter(pk__in=pks[:500]).update(batch=1, status=CampaignRecipient.STATUS_SENT)
+        CampaignRecipient.objects.filter(pk__in=pks[500:]).update(batch=2)
+        client = _FakeMulticastClient(errors={campaigns.retry_key(self.campaign, 2): 409})
+
+        campaigns.send(self.campaign, client=client, rate=1000, concurrency=2)
+
+        self.assertEqual(len(client.calls), 1)
+        to, _, key = client.calls[0]
+        self.assertEqual((len(to), key), (500, campaigns.retry_key(self.campaign, 2)))
+        self.assertEqual(self.campaign.recipients.filter(status=CampaignRecipient.STATUS_SENT).count(), 1000)
+
+    def test_failed_batch_is_recorded_and_can_be_retried(self):
+        from . import campaigns
+        from .models import Campaign, CampaignRecipient
+
+        campaigns.add_recipients(self.campaign, ["U1", "U2"])
+        key = campaigns.retry_key(self.campaign, 1)
+        result = campaigns.send(self.campaign, client=_FakeMulticastClient(errors={key: 400}), rate=1000)
+
+        self.assertEqual(result["failed"], 2)
+        self.campaign.refresh_from_db()
+        self.assertEqual((self.campaign.status, self.campaign.failed_count), (Campaign.STATUS_DONE, 2))
+
+        self.assertEqual(campaigns.retry_failed(self.campaign), 2)
+        client = _FakeMulticastClient()
+        campaigns.send(self.campaign, client=client, rate=1000)
+        self.assertEqual(client.calls[0][2], key)
+        self.assertEqual(self.campaign.recipients.filter(status=CampaignRecipient.STATUS_SENT).count(), 2)
+
+    def test_token_bucket_waits_for_refill(self):
+        from .ratelimit import TokenBucket
+
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(rate=10, capacity=2, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([bucket.acquire() for _ in range(2)], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertAlmostEqual(bucket.acquire(2), 0.2)
+        self.assertEqual(len(sleeps), 2)
+        with self.assertRaises(ValueError):
+            bucket.acquire(3)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        from . import ratelimit
+
+        self.limit = ratelimit.Limit("chat", user_rate=1, user_burst=2, global_rate=10, global_burst=3, max_wait=0)
+        patcher = mock.patch("bot.ratelimit.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_per_user_bucket_rejects_spammer_but_not_others(self):
+        from . import ratelimit
+
+        ratelimit.acquire(self.limit, "U1")
+        ratelimit.acquire(self.limit, "U1")
+        with self.assertRaises(ratelimit.RateLimited) as ctx:
+            ratelimit.acquire(self.limit, "U1")
+        self.assertEqual(ctx.exception.scope, "user")
+        self.assertEqual(ratelimit.acquire(self.limit, "U2"), 0.0)
+
+        counters = stats.snapshot("ratelimit.chat.")
+        self.assertEqual((counters["ratelimit.chat.allowed"], counters["ratelimit.chat.rejected_user"]), (3, 1))
+
+    def test_global_rejection_refunds_user_token(self):
+        from . import ratelimit
+        from .models import RateBucket
+
+        for user in ("U1", "U2", "U3"):
+            ratelimit.acquire(self.limit, user)
+        with self.assertRaises(ratelimit.RateLimited) as ctx:
+            ratelimit.acquire(self.limit, "U4")
+
+        self.assertEqual(ctx.exception.scope, "global")
+        self.assertAlmostEqual(RateBucket.objects.get(key="chat:user:U4").tokens, 2, places=1)
+        self.assertEqual(stats.snapshot("ratelimit.chat.rejected_global"), {"ratelimit.chat.rejected_global": 1})
+
+    def test_over_limit_requests_queue_in_arrival_order(self):
+        from . import ratelimit
+
+        limit = ratelimit.Limit("image", user_rate=0, user_burst=0, global_rate=10, global_burst=1, max_wait=1)
+        waits = [ratelimit.acquire(limit, f"U{i}") for i in range(4)]
+
+        self.assertEqual(waits[0], 0.0)
+        for previous, current, expected in zip(waits[1:], waits[2:], (0.2, 0.3)):
+            self.assertGreater(current, previous)
+            self.assertAlmostEqual(current, expected, delta=0.05)
+        self.assertEqual(self.sleep.call_count, 3)
+        self.assertEqual(stats.snapshot("ratelimit.image.delayed"), {"ratelimit.image.delayed": 3})
+
+    def test_chat_reply_when_user_is_rate_limited(self):
+        from . import ai_reply, ratelimit
+
+        with mock.patch("bot.ai_reply.GEMINI_API_KEY", "key"), \
+                mock.patch("bot.ai_reply.reply_cache.REPLY_CACHE_ENABLED", False), \
+                mock.patch("bot.conversations.CONVERSATION_ENABLED", False), \
+                mock.patch.object(ratelimit, "CHAT", self.limit), \
+                mock.patch("bot.gemini.get_client") as get_client:
+            get_client.return_value.models.generate_content.return_value = _FakeResponse("好的")
+            replies = [ai_reply.get_gemini_response("明天天氣如何", user_id="U1") for _ in range(3)]
+
+        self.assertEqual(replies, ["好的", "好的", ai_reply.SLOW_DOWN_REPLY])
+        self.assertEqual(get_client.return_value.models.generate_content.call_count, 2)
+
+
+class MetricsTests(_TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        from . import metrics
+
+        self.metrics = metrics
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def _write_worker_file(self, pid, data, instance_id="old"):
+        path = os.path.join(self.metrics._directory(), f"{pid}-{instance_id}.json")
+        with open(path, "w") as f:
+            json.dump(dict(data, pid=pid), f)
+        return path
+
+    def test_span_records_latency_inflight_and_errors(self):
+        metrics = self.metrics
+        with metrics.span("gemini"):
+            inflight = dict(((n, tuple(map(tuple, l))), v) for n, l, v in metrics.local_snapshot()["gauges"])
+            self.assertEqual(inflight[(metrics.STAGE_INFLIGHT, (("stage", "gemini"),))], 1)
+        with self.assertRaises(ValueError):
+            with metrics.span("gemini"):
+                raise ValueError("boom")
+
+        data = metrics.collect()
+        key = (metrics.STAGE_SECONDS, (("stage", "gemini"),))
+        self.assertEqual(sum(data["histograms"][key][:-1]), 2)
+        self.assertEqual(data["gauges"][(metrics.STAGE_INFLIGHT, (("stage", "gemini"),))], 0)
+        self.assertEqual(data["counters"][(metrics.STAGE_ERRORS, (("stage", "gemini"),))], 1)
+
+    def test_collect_sums_workers_and_ignores_gauges_of_dead_workers(self):
+        metrics = self.metrics
+        labels = [["stage", "line_reply"]]
+        buckets = [0] * (len(metrics.BUCKETS) + 1)
+        buckets[3] = 2
+        self._write_worker_file(2147483000, {
+            "counters": [[metrics.TOOL_CALLS, [["tool", "get_recent_activities"]], 5]],
+            "gauges": [[metrics.STAGE_INFLIGHT, labels, 3]],
+            "histograms": [[metrics.STAGE_SECONDS, labels, buckets + [0.04]]],
+        })
+        metrics.inc(metrics.TOOL_CALLS, tool="get_recent_activities")
+        metrics.observe(metrics.STAGE_SECONDS, 0.02, stage="line_reply")
+        with metrics.span("line_reply"):
+            data = metrics.collect()
+
+        self.assertEqual(data["counters"][(metrics.TOOL_CALLS, (("tool", "get_recent_activities"),))], 6)
+        self.assertEqual(data["gauges"][(metrics.STAGE_INFLIGHT, (("stage", "line_reply"),))], 1)
+        merged = data["histograms"][(metrics.STAGE_SECONDS, (("stage", "line_reply"),))]
+        self.assertEqual((merged[3], merged[-1]), (3, 0.06))
+
+    def test_reused_pid_does_not_overwrite_exited_process(self):
+        metrics = self.metrics
+        key = (metrics.TOOL_CALLS, (("tool", "get_recent_activities"),))
+        # 容器重啟前同一個 pid 的 process 已經累計 5 次
+        self._write_worker_file(os.getpid(), {
+            "counters": [[metrics.TOOL_CALLS, [["tool", "get_recent_activities"]], 5]],
+        })
+        metrics.inc(metrics.TOOL_CALLS, tool="get_recent_activities")
+        self.assertEqual(metrics.collect()["counters"][key], 6)
+
+    def test_metrics_endpoint_renders_prometheus_text(self):
+        from . import ai_reply
+
+        stats.incr("reply_cache.hit", 2)
+        ai_reply.call_tool("get_studio_introduction", {})
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn("# TYPE bot_stage_duration_seconds histogram", body)
+        self.assertIn('bot_stage_duration_seconds_bucket{stage="tool",tool="get_studio_introduction",le="+Inf"} 1',
+                      body)
+        self.assertIn('bot_stage_duration_seconds_count{stage="tool",tool="get_studio_introduction"} 1', body)
+        self.assertIn('bot_tool_calls_total{tool="get_studio_introduction"} 1', body)
+        self.assertIn('bot_stats_total{name="reply_cache.hit"} 2', body)
+
+        with mock.patch.object(views, "METRICS_TOKEN", "secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    def test_purge_dead_keeps_live_workers(self):
+        live = self._write_worker_file(os.getpid(), {})
+        dead = self._write_worker_file(2147483000, {})
+        os.utime(live, (0, 0))
+        os.utime(dead, (0, 0))
+        self.assertEqual(self.metrics.purge_dead(retention=60), 1)
+        self.assertTrue(os.path.exists(live))
+        self.assertFalse(os.path.exists(dead))
+
+    def test_span_overhead_is_microseconds(self):
+        # 取三次中最快的一次，並留很寬的上限：只擋住每個 span 都做 I/O 之類的退化，不因 CI 負載而失敗
+        n = 2000
+        runs = []
+        for _ in range(3):
+            started = time.perf_counter()
+            for _ in range(n):
+                with self.metrics.span("tool", tool="get_activity_card"):
+                    pass
+            runs.append((time.perf_counter() - started) / n)
+        self.assertLess(min(runs), 500e-6)
+
+
+class WarmupTests(TestCase):
+    def setUp(self):
+        from . import gemini
+
+        gemini.reset()
+        self.addCleanup(gemini.reset)
+
+    def test_importing_views_does_not_load_gemini_sdk(self):
+        import subprocess
+        import sys
+
+        from django.conf import settings
+
+        code = ("import os, sys; os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'linegemini.settings'); "
+                "import django; django.setup(); import linegemini.urls; print('google.genai' in sys.modules)")
+        out = subprocess.run([sys.executable, "-c", code], cwd=settings.BASE_DIR,
+                             capture_output=True, text=True, check=True).stdout
+        self.assertEqual(out.strip().splitlines()[-1], "False")
+
+    def test_warm_endpoint_opens_db_line_and_gemini(self):
+        async_client = mock.Mock(bot_info=mock.AsyncMock(return_value={}))
+        with mock.patch("bot.warmup.GEMINI_API_KEY", "key"), \
+                mock.patch("google.genai.Client") as client_cls, \
+                mock.patch("bot.warmup.get_line_client") as get_line_client, \
+                mock.patch("bot.warmup.get_async_line_client", return_value=async_client):
+            client_cls.return_value.aio.models.get = mock.AsyncMock()
+            response = self.client.get("/bot/healthz/warm")
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual({name for name, step in data.items() if step["ok"]},
+                         {"db", "line", "line_async", "gemini", "gemini_async"})
+        get_line_client.return_value.bot_info.assert_called_once()
+        client_cls.return_value.models.get.assert_called_once()
+
+    def test_warm_endpoint_requires_metrics_token(self):
+        with mock.patch.object(views, "METRICS_TOKEN", "secret"), \
+                mock.patch("bot.warmup.awarm", new=mock.AsyncMock(return_value={"db": {"ok": True}})) as awarm:
+            self.assertEqual(self.client.get("/bot/healthz/warm").status_code, 401)
+            awarm.assert_not_called()
+            response = self.client.get("/bot/healthz/warm", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        awarm.assert_called_once()
+
+    def test_warm_endpoint_reports_failures_without_failing(self):
+        with mock.patch("bot.warmup.GEMINI_API_KEY", None), \
+                mock.patch("bot.warmup.get_line_client", side_effect=RuntimeError("offline")), \
+                mock.patch("bot.warmup.get_async_line_client", side_effect=RuntimeError("offline")):
+            response = self.client.get("/bot/healthz/warm")
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data["db"]["ok"])
+        self.assertEqual(data["line"], {"ok": False, "error": "offline"})
+        self.assertFalse(data["gemini"]["ok"])
+        self.assertNotIn("gemini_async", data)
+
+
+class ConversationTests(TestCase):
+    def setUp(self):
+        from . import gemini
+
+        gemini.reset()
+        self.addCleanup(gemini.reset)
+        for patcher in (mock.patch("bot.ai_reply.GEMINI_API_KEY", "key"),
+                        mock.patch("google.genai.Client")):
+            self.addCleanup(patcher.stop)
+            self.client_cls = patcher.start()
+        self.models = self.client_cls.return_value.models
+
+    def _texts(self, contents):
+        return [(c.role, c.parts[0].text) for c in contents]
+
+    def test_previous_turn_is_sent_as_context(self):
+        from . import ai_reply
+
+        self.models.generate_content.return_value = _FakeResponse("台北有國際書展")
+        ai_reply.get_gemini_response("台北有什麼展覽", user_id="U1")
+        self.models.generate_content.return_value = _FakeResponse("在世貿一館")
+        ai_reply.get_gemini_response("在哪裡", user_id="U1")
+
+        contents = self.models.generate_content.call_args.kwargs["contents"]
+        self.assertEqual(self._texts(contents), [
+            ("user", "台北有什麼展覽"), ("model", "台北有國際書展"), ("user", "在哪裡"),
+        ])
+        # 其他使用者不會看到這段對話
+        ai_reply.get_gemini_response("在哪裡", user_id="U2")
+        self.assertEqual(self.models.generate_content.call_args.kwargs["contents"], "在哪裡")
+
+    def test_compaction_keeps_prompt_size_flat(self):
+        from . import ai_reply, conversations
+        from .models import Conversation
+
+        self.models.generate_content.return_value = _FakeResponse("這是一段比較長的回覆內容" * 3)
+        # 同一位使用者連續 12 則訊息會被每人限流延後，這裡只測濃縮
+        with mock.patch.object(conversations, "CONVERSATION_TOKEN_BUDGET", 120), \
+                mock.patch("bot.ratelimit.RATE_LIMIT_ENABLED", False), \
+                mock.patch.object(conversations, "summarize", return_value="使用者在問台北的展覽") as summarize:
+            sizes = []
+            for i in range(12):
+                ai_reply.get_gemini_response(f"第{i}個問題是什麼", user_id="U1")
+                conversations.compact("U1")
+                sizes.append(Conversation.objects.get(user_id="U1").tokens)
+
+        self.assertTrue(summarize.called)
+        self.assertLessEqual(max(sizes[4:]), 120)
+        conversation = Conversation.objects.get(user_id="U1")
+        self.assertEqual(len(conversation.turns), conversations.CONVERSATION_KEEP_TURNS)
+        history = self._texts(conversations.history(conversation))
+        self.assertEqual(history[0], ("user", "(先前對話摘要) 使用者在問台北的展覽"))
+
+    def test_idle_conversation_expires(self):
+        from . import conversations
+        from .models import Conversation
+
+        conversations.record(conversations.load("U1"), "hi", "hello")
+        Conversation.objects.filter(user_id="U1").update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(conversations.history(conversations.load("U1")), [])
+        self.assertEqual(conversations.purge_idle(), 1)
+
+    def test_concurrent_record_and_compact_keep_every_turn(self):
+        from . import conversations
+        from .models import Conversation
+
+        # 兩個 worker 載入同一份對話後各自記下一輪，後寫的不會蓋掉先寫的
+        first, second = conversations.load("U1"), conversations.load("U1")
+        conversations.record(first, "問題一", "回覆一")
+        conversations.record(second, "問題二", "回覆二")
+        self.assertEqual([text for _, text in Conversation.objects.get(user_id="U1").turns],
+                         ["問題一", "回覆一", "問題二", "回覆二"])
+
+        # 濃縮摘要期間又記下一輪：只換掉被濃縮的部分
+        def summarize(summary, turns):
+            conversations.record(conversations.load("U1"), "問題三", "回覆三")
+            return "先前問了兩個問題"
+
+        with mock.patch.object(conversations, "CONVERSATION_TOKEN_BUDGET", 1), \
+                mock.patch.object(conversations, "CONVERSATION_KEEP_TURNS", 2), \
+                mock.patch.object(conversations, "summarize", side_effect=summarize):
+            self.assertTrue(conversations.compact("U1"))
+        conversation = Conversation.objects.get(user_id="U1")
+        self.assertEqual(conversation.summary, "先前問了兩個問題")
+        self.assertEqual([text for _, text in conversation.turns], ["問題二", "回覆二", "問題三", "回覆三"])
+
+    def test_flex_reply_is_remembered_by_alt_text(self):
+        from . import ai_reply, conversations
+
+        ai_reply.get_gemini_response("介紹工作室", user_id="U1")
+        self.assertEqual(conversations.load("U1").turns[-1], ["m", "工作室介紹影片"])
+
+    def test_turn_is_recorded_once_after_reply_is_sent(self):
+        from . import conversations
+        from .handlers import handle_line_event
+
+        failed = requests.Response()
+        failed.status_code = 500
+        with mock.patch("bot.ai_reply._respond", return_value="回覆") as respond, \
+                mock.patch("bot.handlers.send_loading_animation"), \
+                mock.patch("bot.handlers._compact"), \
+                mock.patch("bot.handlers.line_reply",
+                           side_effect=[requests.HTTPError("500", response=failed), None]):
+            # 回覆失敗：工作會重試，這一輪還不能記下
+            with self.assertRaises(requests.HTTPError):
+                handle_line_event(_text_event("在哪裡"))
+            self.assertEqual(conversations.load("U1").turns, [])
+            handle_line_event(_text_event("在哪裡"))
+
+        self.assertEqual(respond.call_count, 2)
+        self.assertEqual(conversations.load("U1").turns, [["u", "在哪裡"], ["m", "回覆"]])
+
+
+def _parse_sse(raw: bytes) -> list:
+    events = []
+    for block in raw.decode("utf-8").strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class ChatStreamTests(TransactionTestCase):
+    def setUp(self):
+        from . import gemini
+
+        gemini.reset()
+        self.addCleanup(gemini.reset)
+        for patcher in (mock.patch("bot.ai_reply.GEMINI_API_KEY", "key"),
+                        mock.patch("google.genai.Client")):
+            self.addCleanup(patcher.stop)
+            self.client_cls = patcher.start()
+        self.models = self.client_cls.return_value.models
+
+    def test_tokens_are_streamed_as_events(self):
+        from .models import Conversation
+
+        self.models.generate_content_stream.return_value = iter(
+            [_FakeResponse("台北"), _FakeResponse("有書展"), _FakeResponse("")])
+        response = self.client.get("/bot/liff/chat/", {"text": "台北有什麼好玩的", "userId": "U1"})
+
+        self.assertEqual(response["Content-Type"], "text/event-stream; charset=utf-8")
+        events = _parse_sse(b"".join(response.streaming_content))
+        self.assertEqual(events, [
+            ("token", {"text": "台北"}), ("token", {"text": "有書展"}), ("done", {}),
+        ])
+        self.assertEqual(Conversation.objects.get(user_id="U1").turns[-1], ["m", "台北有書展"])
+
+    def test_conversation_is_compacted_after_stream(self):
+        from . import conversations
+
+        self.models.generate_content_stream.return_value = iter([_FakeResponse("台北有書展")])
+        with mock.patch.object(conversations, "compact", side_effect=RuntimeError("boom")) as compact:
+            response = self.client.get("/bot/liff/chat/", {"text": "台北有什麼好玩的", "userId": "U1"})
+            events = _parse_sse(b"".join(response.streaming_content))
+        # 濃縮在 done 之後才執行，失敗也不影響回覆
+        self.assertEqual(events[-1], ("done", {}))
+        compact.assert_called_once_with("U1")
+
+    def test_tool_call_emits_flex_event(self):
+        self.models.generate_content_stream.return_value = iter(
+            [_FakeResponse(function_calls=[_FakeFunctionCall("get_studio_introduction", {})])])
+        response = self.client.get("/bot/liff/chat/", {"text": "你們是做什麼的"})
+        events = _parse_sse(b"".join(response.streaming_content))
+        self.assertEqual(events[0][0], "flex")
+        self.assertEqual(events[0][1]["altText"], "工作室介紹影片")
+        self.assertEqual(events[-1], ("done", {}))
+        self.assertEqual(self.client.get("/bot/liff/chat/").status_code, 400)
+
+    async def test_first_token_arrives_before_generation_finishes(self):
+        from django.test import AsyncRequestFactory
+
+        release = threading.Event()
+
+        def fake_stream(**kwargs):
+            yield _FakeResponse("第一段")
+            release.wait(5)
+            yield _FakeResponse("第二段")
+
+        self.models.generate_content_stream.side_effect = fake_stream
+        request = AsyncRequestFactory().get("/bot/liff/chat/", {"text": "台北有什麼好玩的"})
+        response = views.liff_chat_stream(request)
+
+        chunks = response.streaming_content.__aiter__()
+        first = await asyncio.wait_for(chunks.__anext__(), timeout=5)
+        # 模型還沒產生第二段，第一段就已經送出
+        self.assertEqual(_parse_sse(first), [("token", {"text": "第一段"})])
+        release.set()
+        rest = [chunk async for chunk in chunks]
+        self.assertEqual([e for e, _ in _parse_sse(b"".join(rest))], ["token", "done"])
+
+
+class ReplyCacheTests(TestCase):
+    def test_normalize_folds_width_whitespace_and_punctuation(self):
+        from .reply_cache import normalize
+
+        self.assertEqual(normalize(" 最近有什麼活動？ "), normalize("最近有什麼活動?"))
+        self.assertEqual(normalize("ＡＩ　Brand！"), normalize("ai brand"))
+
+    def test_hit_miss_counters(self):
+        from . import reply_cache, stats
+
+        self.assertIsNone(reply_cache.get("介紹工作室"))
+        reply_cache.set("介紹工作室", {"type": "flex", "altText": "工作室介紹影片"})
+        self.assertEqual(reply_cache.get("介紹 工作室！")["altText"], "工作室介紹影片")
+        self.assertEqual(stats.snapshot("reply_cache."), {"reply_cache.hit": 1, "reply_cache.miss": 1})
+
+    def test_counters_are_buffered_between_flushes(self):
+        from .models import Counter
+
+        with mock.patch.object(stats, "STATS_FLUSH_INTERVAL", 60):
+            stats.flush()
+            with self.assertNumQueries(0):
+                for _ in range(5):
+                    stats.incr("reply_cache.hit")
+                stats.incr("reply_cache.miss", 2)
+            self.assertFalse(Counter.objects.filter(name__startswith="reply_cache.").exists())
+            self.assertFalse(stats.due())
+            # 讀取時先寫入本 process 累積的計數
+            self.assertEqual(stats.snapshot("reply_cache."), {"reply_cache.hit": 5, "reply_cache.miss": 2})
+
+    def test_snapshot_survives_locked_database(self):
+        from django.db import OperationalError
+
+        stats.incr("reply_cache.hit", 2)
+        with mock.patch.object(stats, "STATS_FLUSH_INTERVAL", 60):
+            stats.incr("reply_cache.hit")
+            with mock.patch("bot.stats.transaction.atomic", side_effect=OperationalError("database is locked")):
+                # 寫不進去時回傳已寫入的值，累積的 1 次留到下一次
+                self.assertEqual(stats.snapshot("reply_cache."), {"reply_cache.hit": 2})
+            self.assertEqual(stats.snapshot("reply_cache."), {"reply_cache.hit": 3})
+
+    def test_stats_endpoints_require_metrics_token(self):
+        with mock.patch.object(views, "METRICS_TOKEN", "secret"):
+            for url in ("/bot/stats/", "/bot/stats/image/"):
+                self.assertEqual(self.client.get(url).status_code, 401)
+                self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    def test_ttl_and_lru_eviction(self):
+        from . import reply_cache
+        from .models import ReplyCacheEntry
+
+        with mock.patch.object(reply_cache, "REPLY_CACHE_MAX_ENTRIES", 2):
+            reply_cache.set("a", "1")
+            reply_cache.set("b", "2")
+            ReplyCacheEntry.objects.filter(key=reply_cache.make_key("a")).update(
+                last_access=timezone.now() + timedelta(seconds=1))
+            reply_cache.set("c", "3")
+        self.assertIsNone(reply_cache.get("b"))
+        self.assertEqual(reply_cache.get("a"), "1")
+
+        ReplyCacheEntry.objects.update(expires_at=timezone.now())
+        self.assertIsNone(reply_cache.get("a"))
+
+    def test_activity_change_invalidates(self):
+        from . import reply_cache
+        from .models import Activity
+
+        reply_cache.set("最近有什麼活動", "cached")
+        with self.captureOnCommitCallbacks(execute=True):
+            Activity.objects.create(name="跨年晚會", end_date="2026-12-31", location="台北", description="x")
+        self.assertIsNone(reply_cache.get("最近有什麼活動"))
+
+    def test_gemini_response_is_cached(self):
+        from . import ai_reply, gemini
+
+        gemini.reset()
+        self.addCleanup(gemini.reset)
+        with mock.patch("bot.ai_reply.GEMINI_API_KEY", "key"), mock.patch("google.genai.Client") as client_cls:
+            client_cls.return_value.models.generate_content.return_value = _FakeResponse("推薦鼎泰豐")
+            ai_reply.get_gemini_response("台北有什麼好吃的")
+            self.assertEqual(ai_reply.get_gemini_response("台北有什麼好吃的？"), "推薦鼎泰豐")
+        self.assertEqual(client_cls.return_value.models.generate_content.call_count, 1)
+
+
+# 意圖判斷的標註資料：(使用者訊息, 預期工具；None 表示應交給 Gemini)
+INTENT_LABELLED = [
+    ("介紹工作室", "get_studio_introduction"),
+    ("請介紹一下你們的工作室", "get_studio_introduction"),
+    ("關於我們", "get_studio_introduction"),
+    ("你們是誰？", "get_studio_introduction"),
+    ("工作室介紹", "get_studio_introduction"),
+    ("想認識一下工作室", "get_studio_introduction"),
+    ("最近有什麼活動", "get_recent_activities"),
+    ("最近有什麼活動？", "get_recent_activities"),
+    ("有哪些活動", "get_recent_activities"),
+    ("近期活動", "get_recent_activities"),
+    ("活動列表", "get_recent_activities"),
+    ("最近有甚麼好玩的活動嗎", "get_recent_activities"),
+    ("最近的活動", "get_recent_activities"),
+    ("現在有什麼活動呢", "get_recent_activities"),
+    ("台北馬拉松", "get_activity_card"),
+    ("台北馬拉松活動", "get_activity_card"),
+    ("跨年晚會在哪裡", "get_activity_card"),
+    ("科技展什麼時候結束？", "get_activity_card"),
+    ("日月潭花火節", "get_activity_card"),
+    ("花火節", "get_activity_card"),
+    ("你好", None),
+    ("今天天氣如何", None),
+    ("幫我寫一首詩", None),
+    ("謝謝", None),
+    ("可以退票嗎", None),
+    ("營業時間是幾點", None),
+    ("工作室在哪裡", None),
+    ("我想報名", None),
+    ("活動可以帶寵物嗎", None),
+    ("台北有什麼好吃的", None),
+    ("晚會", None),
+    ("你們的活動要收費嗎", None),
+]
+
+
+class IntentRouterTests(TestCase):
+    def setUp(self):
+        from . import search
+        from .models import Activity
+
+        search.invalidate()
+
+        for name in ["台北馬拉松", "跨年晚會", "科技展", "日月潭花火節"]:
+            Activity.objects.create(name=name, end_date="2026-12-31", location="台灣", description="x")
+
+    def test_labelled_set_precision_and_skip_rate(self):
+        from .ai_reply import route_intent
+
+        routed = correct = 0
+        mistakes = []
+        for text, expected in INTENT_LABELLED:
+            result = route_intent(text)
+            tool = result[0] if result else None
+            if tool is not None:
+                routed += 1
+                correct += tool == expected
+            if tool != expected:
+                mistakes.append((text, expected, tool))
+
+        precision = correct / routed
+        skip_rate = routed / len(INTENT_LABELLED)
+        summary = (f"precision={precision:.2%} skip_llm={skip_rate:.2%} "
+                   f"({routed}/{len(INTENT_LABELLED)} routed), mistakes={mistakes}")
+        self.assertEqual(precision, 1.0, summary)
+        self.assertGreaterEqual(skip_rate, 0.55, summary)
+
+    def test_activity_match_passes_stored_name(self):
+        from .ai_reply import route_intent
+
+        self.assertEqual(route_intent("台北馬拉松活動")[:2], ("get_activity_card", {"activity_name": "台北馬拉松"}))
+
+    def test_thresholds_are_tunable(self):
+        from . import ai_reply
+
+        with mock.patch.object(ai_reply, "INTENT_MIN_CONFIDENCE", 0.99), \
+                mock.patch.object(ai_reply, "INTENT_ACTIVITY_MIN_SCORE", 1.01):
+            self.assertIsNone(ai_reply.route_intent("介紹工作室"))
+            self.assertIsNone(ai_reply.route_intent("台北馬拉松"))
+
+    def test_routed_message_skips_gemini(self):
+        from . import ai_reply
+
+        with mock.patch("google.genai.Client") as client_cls:
+            result = ai_reply.get_gemini_response("介紹工作室")
+        self.assertEqual(result["altText"], "工作室介紹影片")
+        client_cls.assert_not_called()
+
+
+class ActivitySearchTests(TestCase):
+    def setUp(self):
+        from . import search
+        from .models import Activity
+
+        search.invalidate()
+        self.marathon = Activity.objects.create(name="台北馬拉松", end_date="2026-12-20", location="台北市政府", description="x")
+        self.concert = Activity.objects.create(name="跨年晚會", end_date="2026-12-31", location="高雄", description="x")
+        Activity.objects.create(name="科技展", end_date="2026-11-01", location="台北世貿", description="x")
+
+    def test_fuzzy_and_variant_names(self):
+        from .search import search_activities
+
+        for query in ["台北馬拉松活動", "臺北馬拉松", "台北马拉松", "馬拉松"]:
+            self.assertEqual(search_activities(query)[0][1], self.marathon.pk, query)
+
+    def test_activity_card_uses_index(self):
+        from .ai_reply import get_activity_card
+
+        self.assertEqual(get_activity_card("臺北馬拉松活動")["altText"], "台北馬拉松 活動資訊")
+        self.assertEqual(get_activity_card("演唱會"), "找不到相關活動資訊。")
+
+    def test_short_query_matches_long_name(self):
+        from . import search
+        from .ai_reply import get_activity_card
+        from .models import Activity
+
+        carnival = Activity.objects.create(name="2024台北國際馬拉松嘉年華", end_date="2026-10-01",
+                                           location="台北", description="x")
+        search.invalidate()
+
+        self.assertEqual(search.search_activities("台北國際馬拉松嘉年華")[0][1], carnival.pk)
+        # 短查詢對長名稱的分數低於門檻，索引找不到時退回資料庫模糊搜尋
+        self.assertEqual(search.search_activities("嘉年華"), [])
+        for query in ["嘉年華", "馬拉松嘉年華", "台北國際"]:
+            self.assertEqual(get_activity_card(query)["altText"], "2024台北國際馬拉松嘉年華 活動資訊", query)
+        self.assertEqual(get_activity_card("台北馬拉松")["altText"], "台北馬拉松 活動資訊")
+
+    def test_location_only_breaks_ties(self):
+        from . import search
+        from .models import Activity
+
+        Activity.objects.create(name="花火節", end_date="2026-08-01", location="台中", description="x")
+        penghu = Activity.objects.create(name="花火節", end_date="2026-08-01", location="澎湖", description="x")
+        search.invalidate()
+
+        self.assertEqual(search.search_activities("澎湖花火節")[0][1], penghu.pk)
+        self.assertEqual(search.search_activities("澎湖"), [])
+
+    def test_signals_update_index_incrementally(self):
+        from . import search
+        from .models import Activity
+
+        search.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            lantern = Activity.objects.create(name="元宵燈會", end_date="2027-02-01", location="台中", description="x")
+        with mock.patch.object(search.ActivityIndex, "rebuild") as rebuild:
+            self.assertEqual(search.search_activities("燈會")[0][1], lantern.pk)
+        rebuild.assert_not_called()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            lantern.delete()
+        self.assertEqual(search.search_activities("元宵燈會"), [])
+
+    def test_other_worker_change_triggers_rebuild(self):
+        from . import search
+        from .models import Activity
+
+        search.get_index()
+        Activity.objects.filter(pk=self.concert.pk).update(name="跨年煙火")
+        search.invalidate()  # 模擬另一個 worker 的異動
+        self.assertEqual(search.search_activities("煙火")[0][1], self.concert.pk)
+
+
+class ActivityImportTests(TestCase):
+    CSV = (
+        "external_id,name,end_date,location,description,image_url\n"
+        "T1,台北馬拉松,2026-12-20,台北市政府,跑步,https://example.com/a.png\n"
+        "T2,跨年晚會,2026/12/31,高雄,,\n"
+        "T3,,2026-12-31,高雄,缺名稱,\n"
+        "T4,科技展,明天,台北世貿,日期錯誤,\n"
+    )
+
+    def _run(self, text, *args):
+        import io
+        import tempfile
+        from django.core.management import call_command
+
+        tmp = tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8", delete=False)
+        self.addCleanup(os.remove, tmp.name)
+        with tmp:
+            tmp.write(text)
+        out, err = io.StringIO(), io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_activities", tmp.name, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_command_creates_and_reports_invalid_rows(self):
+        from . import signals
+        from .models import Activity
+
+        with mock.patch.object(signals, "activities_changed") as changed:
+            out, err = self._run(self.CSV)
+
+        self.assertIn("2 created, 0 updated, 0 unchanged, 2 invalid", out)
+        self.assertIn("rows/s", out)
+        self.assertIn("row 4: missing name", err)
+        self.assertIn("row 5: invalid end_date '明天'", err)
+        marathon = Activity.objects.get(external_id="T1")
+        self.assertEqual(str(marathon.end_date), "2026-12-20")
+        self.assertIsNone(Activity.objects.get(external_id="T2").image_url)
+        changed.assert_called_once_with()
+
+    def test_reimport_updates_only_changed_rows_and_invalidates_once(self):
+        from . import reply_cache, search, versioning
+        from .models import Activity
+
+        self._run(self.CSV)
+        before = Activity.objects.get(external_id="T1").updated_at
+        version = versioning.current(search.VERSION_NAME)
+
+        with mock.patch.object(reply_cache, "clear") as clear:
+            out, _ = self._run(self.CSV.replace("台北市政府", "市府廣場"))
+        self.assertIn("0 created, 1 updated, 1 unchanged", out)
+        marathon = Activity.objects.get(external_id="T1")
+        self.assertEqual(marathon.location, "市府廣場")
+        self.assertGreater(marathon.updated_at, before)
+        self.assertEqual(versioning.current(search.VERSION_NAME), version + 1)
+        clear.assert_called_once_with()
+
+        out, _ = self._run(self.CSV, "--dry-run")
+        self.assertIn("Dry run: 4 rows", out)
+        self.assertEqual(Activity.objects.get(external_id="T1").location, "市府廣場")
+
+    def test_streams_rows_in_batches(self):
+        from . import activity_import
+
+        consumed = []
+
+        def rows():
+            for i in range(25):
+                consumed.append(i)
+                yield i + 1, {"id": f"E{i}", "name": f"活動{i}", "end_date": "2027-01-01", "location": "台中"}
+
+        batches = []
+        summary = activity_import.import_rows(
+            rows(), key="id", batch_size=10, progress=lambda s: batches.append((s["rows"], len(consumed))))
+        # 每批只從來源多讀一批的量
+        self.assertEqual(batches, [(10, 10), (20, 20), (25, 25)])
+        self.assertEqual(summary["created"], 25)
+
+    def test_failure_after_committed_batch_still_invalidates(self):
+        from . import activity_import, signals
+        from .models import Activity
+
+        def rows():
+            for i in range(15):
+                yield i + 1, {"external_id": f"E{i}", "name": f"活動{i}", "end_date": "2027-01-01", "location": "台中"}
+            raise ValueError("invalid JSON after item 15")
+
+        with mock.patch.object(signals, "activities_changed") as changed:
+            with self.captureOnCommitCallbacks(execute=True), self.assertRaises(ValueError):
+                activity_import.import_rows(rows(), batch_size=10)
+        # 第一批已寫入，第二批沒有
+        self.assertEqual(Activity.objects.filter(external_id__startswith="E").count(), 10)
+        changed.assert_called_once_with()
+
+    def test_json_array_is_parsed_incrementally(self):
+        import io
+        from . import activity_import
+
+        items = [{"external_id": f"J{i}", "name": "活動 [1], {2}", "end_date": "2027-01-01"} for i in range(50)]
+        text = " \n" + json.dumps(items, ensure_ascii=False, indent=1)
+        rows = list(activity_import._json_array(io.StringIO(text), read_size=7))
+        self.assertEqual([number for number, _ in rows], list(range(1, 51)))
+        self.assertEqual([item for _, item in rows], items)
+
+        with self.assertRaises(ValueError):
+            list(activity_import._json_array(io.StringIO('[{"a": 1}, {"b": '), read_size=7))
+        with self.assertRaises(ValueError):
+            list(activity_import._json_array(io.StringIO('{"a": 1}')))
+
+
+def _legacy_bubble(data):
+    # 改用 bot.flex 之前 get_activity_card / get_recent_activities 手寫的 bubble
+    return {
+        "type": "bubble",
+        "hero": {
+            "type": "image",
+            "url": data.image_url if data.image_url else "https://via.placeholder.com/1024x768",
+            "size": "full",
+            "aspectRatio": "20:13",
+            "aspectMode": "cover",
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": data.name, "weight": "bold", "size": "xl"},
+                {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "結束日期", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                        {"type": "text", "text": str(data.end_date), "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
+                    ]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "地點", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                        {"type": "text", "text": data.location, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}
+                    ]}
+                ]},
+                {"type": "text", "text": data.description, "wrap": True, "margin": "md", "color": "#666666"}
+            ]
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": [
+                {"type": "button", "style": "link", "height": "sm", "action": {"type": "uri", "label": "活動詳情", "uri": data.activity_link if data.activity_link else "https://line.me/"}}
+            ],
+            "flex": 0
+        }
+    }
+
+
+class FlexRenderingTests(TestCase):
+    def setUp(self):
+        from . import flex, search
+        from .models import Activity
+
+        flex.clear()
+        search.invalidate()
+        self.activities = [
+            Activity.objects.create(name="台北馬拉松", end_date="2099-12-20", location="台北", description="路跑",
+                                    image_url="https://example.com/a.jpg", activity_link="https://example.com/a"),
+            Activity.objects.create(name="跨年晚會", end_date="2099-12-31", location="高雄", description="煙火"),
+        ]
+
+    def test_card_and_carousel_match_legacy_output(self):
+        from .ai_reply import get_activity_card, get_recent_activities
+
+        card = get_activity_card("台北馬拉松")
+        self.assertEqual(json.loads(card.to_json()), {
+            "type": "flex", "altText": "台北馬拉松 活動資訊", "contents": _legacy_bubble(self.activities[0]),
+        })
+        carousel = get_recent_activities()
+        self.assertEqual(json.loads(carousel.to_json()), {
+            "type": "flex", "altText": "最近活動列表",
+            "contents": {"type": "carousel", "contents": [_legacy_bubble(a) for a in self.activities]},
+        })
+
+    def test_bubble_cache_is_keyed_on_update_time(self):
+        from . import flex
+
+        activity = self.activities[0]
+        first = flex.bubble_json(activity)
+        with mock.patch.object(flex, "activity_bubble") as build:
+            self.assertIs(flex.bubble_json(activity), first)
+        build.assert_not_called()
+
+        activity.name = "新北馬拉松"
+        activity.save()
+        self.assertIn("新北馬拉松".encode(), flex.bubble_json(activity))
+
+    def test_line_client_splices_prerendered_bytes(self):
+        from . import flex
+        from .line_api import dumps, encode_payload
+
+        card = flex.activity_card(self.activities[1])
+        payload = {"replyToken": "r", "messages": [card, {"type": "text", "text": "嗨"}]}
+        encoded = encode_payload(payload)
+        self.assertIn(card.to_json(), encoded)
+        self.assertEqual(json.loads(encoded), json.loads(dumps(
+            {"replyToken": "r", "messages": [card.to_dict(), {"type": "text", "text": "嗨"}]})))
+
+    def test_reply_cache_stores_flex_as_dict(self):
+        from . import flex, reply_cache
+
+        card = flex.activity_card(self.activities[0])
+        reply_cache.set("台北馬拉松", card)
+        self.assertEqual(reply_cache.get("台北馬拉松"), card.to_dict())
+
+
+class RecentActivitiesSnapshotTests(TestCase):
+    def setUp(self):
+        from . import search
+        from .models import Activity
+
+        search.invalidate()
+        today = timezone.localdate()
+        Activity.objects.create(name="已結束活動", end_date=today - timedelta(days=1), location="台北", description="x")
+        Activity.objects.create(name="今天結束", end_date=today, location="台北", description="x")
+        for i in range(6):
+            Activity.objects.create(name=f"活動{i}", end_date=today + timedelta(days=10 - i), location="台北",
+                                    description="x")
+
+    def _names(self, message):
+        return [bubble["body"]["contents"][0]["text"] for bubble in message["contents"]["contents"]]
+
+    def test_upcoming_excludes_ended_and_orders_by_end_date(self):
+        from .ai_reply import get_recent_activities
+
+        self.assertEqual(self._names(get_recent_activities()), ["今天結束", "活動5", "活動4", "活動3", "活動2"])
+
+    def test_steady_state_costs_no_query(self):
+        from .ai_reply import get_recent_activities
+
+        first = get_recent_activities()
+        with self.assertNumQueries(0):
+            self.assertIs(get_recent_activities(), first)
+
+    def test_refreshes_on_change_and_date_rollover(self):
+        from .ai_reply import get_recent_activities
+        from .models import Activity
+
+        get_recent_activities()
+        with self.captureOnCommitCallbacks(execute=True):
+            Activity.objects.create(name="新活動", end_date=timezone.localdate(), location="台北", description="x")
+        self.assertIn("新活動", self._names(get_recent_activities()))
+
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        with mock.patch("bot.snapshots.timezone.localdate", return_value=tomorrow):
+            self.assertNotIn("今天結束", self._names(get_recent_activities()))
+
+    def test_query_uses_end_date_index(self):
+        from django.db import connection
+        from .models import Activity
+
+        qs = Activity.objects.upcoming().for_rendering()[:5]
+        with connection.cursor() as cursor:
+            sql, params = qs.query.sql_with_params()
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = " ".join(str(row) for row in cursor.fetchall())
+        self.assertIn("USING INDEX", plan)
+        self.assertIn("end_date", plan)
@@ -1,10 +1,18 @@
 from django.urls import path
-from .views import webhook, liff_entry, liff_trigger, generate_image_api, send_generated_image
+from .views import (webhook, liff_entry, liff_trigger, generate_image_api, composite_photo_api,
+                    send_generated_image, image_job_status, liff_chat_stream, stats_view, image_stats_view,
+                    warm_view)
 
 urlpatterns = [
     path("webhook/", webhook, name="line_webhook"),
     path("liff/", liff_entry, name="liff_entry"),
     path("liff/trigger/", liff_trigger, name="liff_trigger"),
     path("liff/generate/", generate_image_api, name="generate_image"),
+    path("liff/generate/<int:job_id>/", image_job_status, name="image_job_status"),
+    path("liff/photos/", composite_photo_api, name="composite_photo"),
     path("liff/send/", send_generated_image, name="send_image"),
+    path("liff/chat/", liff_chat_stream, name="liff_chat_stream"),
+    path("stats/", stats_view, name="stats"),
+    path("stats/image/", image_stats_view, name="image_stats"),
+    path("healthz/warm", warm_view, name="warm"),
 ]
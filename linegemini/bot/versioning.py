@@ -0,0 +1,65 @@
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows 開發環境沒有 fcntl，只在單一 process 下使用
+    fcntl = None
+
+# 活動資料的版本號 (活動索引、最近活動快照共用)
+ACTIVITIES = "activities"
+
+
+def _path(name: str) -> str:
+    os.makedirs(settings.BOT_STATE_DIR, exist_ok=True)
+    return os.path.join(settings.BOT_STATE_DIR, f"{name}.version")
+
+
+def current(name: str) -> int:
+    """
+    讀取共用的版本號 (各 worker 用它判斷自己記憶體中的資料是否過期)
+    """
+    try:
+        with open(_path(name), "rb") as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump(name: str) -> tuple:
+    """
+    版本號加一並回傳 (舊版本, 新版本)；以檔案鎖保證多個 process 同時呼叫也不會重複
+    """
+    with open(_path(name), "a+b") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            old = int(f.read() or 0)
+        except ValueError:
+            old = 0
+        new = old + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(new).encode())
+        f.flush()
+        return old, new
+
+
+@contextmanager
+def lock(name: str):
+    """
+    跨 process 的互斥鎖 (同一時間只有一個 process 能進入)，例如避免多個 worker 重複生成同一張圖
+    """
+    lock_dir = os.path.join(settings.BOT_STATE_DIR, "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{name}.lock"), "a+b") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
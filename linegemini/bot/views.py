@@ -1,72 +1,73 @@
+import asyncio
 import base64
 import hashlib
 import hmac
 import json
 import os
-import requests
+from urllib.parse import urlencode
 
-from django.http import HttpResponse, JsonResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render
-from .ai_reply import get_gemini_response, get_studio_introduction, gen_ai_img
+from django.urls import reverse
+from .ai_reply import BUSY_REPLY, get_studio_introduction, public_base_url, stream_gemini_response
+from .jobs import KIND_IMAGE, enqueue_image, enqueue_line_events, public_state
+from .models import Job
+from .line_api import get_async_line_client, get_line_client, to_messages
+from . import ai_reply, conversations, media_store, metrics, photos, stats, warmup
 
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# 設定時 /metrics、/bot/healthz/warm 與 /bot/stats/ 需要帶 Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+def _has_metrics_token(request) -> bool:
+    return not METRICS_TOKEN or hmac.compare_digest(request.headers.get("Authorization", ""),
+                                                    f"Bearer {METRICS_TOKEN}")
+
+
+def line_signature(body: bytes, secret: str) -> str:
+    """
+    LINE 的 X-Line-Signature：以 channel secret 對 request body 做 HMAC-SHA256 後 base64
+    """
+    mac = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(mac).decode("utf-8")
 
 def verify_line_signature(body: bytes, signature: str) -> bool:
     if not LINE_CHANNEL_SECRET:
         print("Error: LINE_CHANNEL_SECRET is not set.")
         return False
-    mac = hmac.new(LINE_CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
-    expected = base64.b64encode(mac).decode("utf-8")
+    expected = line_signature(body, LINE_CHANNEL_SECRET)
     res = hmac.compare_digest(expected, signature)
     if not res:
         print(f"Signature verification failed. Expected: {expected}, Got: {signature}")
     return res
 
 def line_reply(reply_token: str, message):
-    token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-    if not token:
-        print("CRITICAL ERROR: LINE_CHANNEL_ACCESS_TOKEN is not set in environment variables!")
-    else:
-        print(f"Using LINE_CHANNEL_ACCESS_TOKEN starting with: {token[:5]}...")
-
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    
-    # 判斷是 Flex Message (dict) 還是純文字 (str)
-    if isinstance(message, dict) and message.get("type") == "flex":
-        payload = {
-            "replyToken": reply_token,
-            "messages": [message],
-        }
-    else:
-        payload = {
-            "replyToken": reply_token,
-            "messages": [{"type": "text", "text": str(message)[:4900]}],
-        }
-
-    r = requests.post(url, headers=headers, json=payload, timeout=30)
-    r.raise_for_status()
+    # 判斷是 Flex Message (dict) 還是純文字 (str)，轉成 messages 陣列後送出
+    with metrics.span("line_reply"):
+        get_line_client().reply(reply_token, to_messages(message))
 
 def send_loading_animation(chat_id: str, loading_seconds: int = 20):
-    token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-    url = "https://api.line.me/v2/bot/chat/loading/start"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "chatId": chat_id,
-        "loadingSeconds": loading_seconds,
-    }
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
-        r.raise_for_status()
+        with metrics.span("line_loading"):
+            get_line_client().show_loading(chat_id, loading_seconds)
+    except Exception as e:
+        print(f"Failed to send loading animation: {e}")
+
+async def aline_reply(reply_token: str, message):
+    with metrics.span("line_reply"):
+        await get_async_line_client().reply(reply_token, to_messages(message))
+
+async def asend_loading_animation(chat_id: str, loading_seconds: int = 20):
+    try:
+        with metrics.span("line_loading"):
+            await get_async_line_client().show_loading(chat_id, loading_seconds)
     except Exception as e:
         print(f"Failed to send loading animation: {e}")
 
@@ -77,7 +78,7 @@ def liff_entry(request):
     return render(request, 'liff_index.html')
 
 @csrf_exempt
-def liff_trigger(request):
+async def liff_trigger(request):
     """
     接收 LIFF 傳來的 userId，並主動推播訊息給使用者
     """
@@ -95,27 +96,8 @@ def liff_trigger(request):
         # 範例：回傳工作室介紹卡片
         welcome_message = get_studio_introduction()
         
-        # 使用 Push Message API 主動推播
-        token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-        url = "https://api.line.me/v2/bot/message/push"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
-        
-        # 判斷是 Flex Message 還是純文字
-        if isinstance(welcome_message, dict) and welcome_message.get("type") == "flex":
-            messages = [welcome_message]
-        else:
-            messages = [{"type": "text", "text": str(welcome_message)}]
-
-        payload = {
-            "to": user_id,
-            "messages": messages
-        }
-        
-        r = requests.post(url, headers=headers, json=payload, timeout=30)
-        r.raise_for_status()
+        # 使用 Push Message API 主動推播 (async client，等待 LINE 時不佔用 worker)
+        await get_async_line_client().push(user_id, to_messages(welcome_message))
         
         return JsonResponse({"status": "success"})
 
@@ -124,45 +106,41 @@ def liff_trigger(request):
         return JsonResponse({"error": str(e)}, status=500)
 
 @csrf_exempt
-def webhook(request):
+async def webhook(request):
     if request.method != "POST":
         return HttpResponse("OK")
 
     body = request.body
     signature = request.headers.get("X-Line-Signature", "")
 
-    if not verify_line_signature(body, signature):
+    with metrics.span("signature"):
+        valid = verify_line_signature(body, signature)
+    if not valid:
         return JsonResponse({"error": "Invalid signature"}, status=400)
 
     payload = json.loads(body.decode("utf-8"))
     events = payload.get("events", [])
 
+    # 只做驗證與寫入佇列，實際的 Gemini 呼叫與回覆交給背景 worker (manage.py run_worker)
+    # 照片合成完成後要推播圖片網址，先替圖片訊息記下對外網址給 worker 使用
+    base_url = public_base_url(request)
     for event in events:
-        if event.get("type") != "message":
-            continue
-        msg = event.get("message", {})
-        if msg.get("type") != "text":
-            continue
-
-        user_text = msg.get("text", "")
-        reply_token = event.get("replyToken")
-        user_id = event.get("source", {}).get("userId")
-        print(user_text, reply_token)
-
-        if user_id:
-            send_loading_animation(user_id)
+        if event.get("message", {}).get("type") == "image":
+            event["baseUrl"] = base_url
 
-        # 使用 Gemini AI 生成回應
-        ai_text = get_gemini_response(user_text)
-        line_reply(reply_token, ai_text)
+    if events:
+        with metrics.span("enqueue"):
+            await sync_to_async(enqueue_line_events)(events)
 
     return HttpResponse("OK")
 
 @csrf_exempt
-def generate_image_api(request):
+async def generate_image_api(request):
     """
-    模擬 AI 生圖 API
-    接收 prompt，回傳生成的圖片網址
+    AI 生圖 API
+    接收 prompt 後放入佇列立即回傳 job_id，由背景 worker (run_worker --kind image) 生成，
+    前端再用 status_url 查詢進度；push 為 true 時完成後直接推播給 userId，
+    fresh 為 true 時不使用相同提示詞已生成的圖片
     """
     if request.method != "POST":
         return JsonResponse({"error": "Method not allowed"}, status=405)
@@ -170,17 +148,114 @@ def generate_image_api(request):
     try:
         data = json.loads(request.body)
         prompt = data.get("prompt", "cute robot")
-        
-        # 使用 ai_reply.py 中的 gen_ai_img 函式，並傳入 request 以建立完整 URL
-        image_url = gen_ai_img(prompt, request)
-        
-        return JsonResponse({"status": "success", "image_url": image_url})
+
+        # 記下對外網址，worker 才能產生完整的圖片 URL
+        job = await sync_to_async(enqueue_image)(
+            prompt, base_url=public_base_url(request), user_id=data.get("userId", ""),
+            push=data.get("push", False), fresh=data.get("fresh", False))
+
+        return JsonResponse({
+            "status": "queued",
+            "job_id": job.pk,
+            "status_url": _status_url(job),
+        }, status=202)
 
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
+def _save_photos(request) -> tuple:
+    """
+    解析 multipart 並把人像、場景照片逐段複製後縮小存檔，回傳 (照片路徑, 表單欄位)
+    """
+    paths = []
+    try:
+        for field in ("portrait", "scene"):
+            upload = request.FILES.get(field)
+            if upload is None:
+                raise photos.PhotoError(f"{field} is required")
+            paths.append(photos.ingest(upload.chunks(), photos.upload_dir("jobs")))
+    except BaseException:
+        photos.discard(paths)
+        raise
+    return paths, request.POST
+
 @csrf_exempt
-def send_generated_image(request):
+async def composite_photo_api(request):
+    """
+    照片合成 API (LIFF 拍照任務)
+    multipart/form-data：portrait (人像)、scene (場景照片)，可另外帶 prompt、userId、push。
+    上傳的檔案由 Django 分段寫入暫存檔，再逐段複製並縮小成 JPEG，不會把整張原圖讀進記憶體；
+    之後與 /liff/generate/ 相同，放入佇列立即回傳 job_id，前端用 status_url 查詢進度
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    # 兩張照片加上表單欄位，超過就不必讀取內容
+    limit = 2 * photos.PHOTO_MAX_UPLOAD_MB * 1024 * 1024 + 64 * 1024
+    if int(request.META.get("CONTENT_LENGTH") or 0) > limit:
+        return JsonResponse({"error": "Upload too large"}, status=413)
+
+    try:
+        paths, form = await sync_to_async(_save_photos)(request)
+    except photos.PhotoError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    user_id = form.get("userId", "")
+    job = await sync_to_async(enqueue_image)(
+        form.get("prompt", ""), base_url=public_base_url(request), user_id=user_id,
+        push=form.get("push") in ("1", "true"), photos=paths)
+    return JsonResponse({
+        "status": "queued",
+        "job_id": job.pk,
+        "status_url": _status_url(job),
+    }, status=202)
+
+def _status_url(job: Job) -> str:
+    # 查詢狀態要帶建立工作的 userId，前端直接使用 status_url 即可
+    url = reverse("image_job_status", args=[job.pk])
+    user_id = job.payload.get("user_id", "")
+    return f"{url}?{urlencode({'userId': user_id})}" if user_id else url
+
+def image_job_status(request, job_id: int):
+    """
+    查詢生圖工作狀態：queued / running / done / failed
+    帶 userId 建立的工作只有同一個 userId (?userId=) 能查詢，其他人一律當作不存在
+    """
+    job = Job.objects.filter(pk=job_id, kind=KIND_IMAGE).only("status", "result", "last_error", "payload").first()
+    if job is None or request.GET.get("userId", "") != job.payload.get("user_id", ""):
+        return JsonResponse({"error": "Job not found"}, status=404)
+
+    data = {"job_id": job.pk, "status": public_state(job)}
+    if job.status == Job.STATUS_DONE:
+        data.update(job.result or {})
+    elif job.status == Job.STATUS_FAILED:
+        data["error"] = job.last_error
+    return JsonResponse(data)
+
+def generated_image_messages(image_url: str) -> list:
+    """
+    生成圖片的推播訊息；本站生成的圖片會自動改用小張的預覽圖，聊天室不必先下載原圖
+    """
+    return [
+        {
+            "type": "image",
+            "originalContentUrl": image_url,
+            "previewImageUrl": media_store.preview_url(image_url)
+        },
+        {
+            "type": "text",
+            "text": "這是您剛剛生成的 AI 圖片！"
+        }
+    ]
+
+def push_generated_image(user_id: str, image_url: str):
+    """
+    推播生成的圖片給 LINE 使用者 (生圖工作完成時由 worker 使用)
+    """
+    with metrics.span("line_push"):
+        get_line_client().push(user_id, generated_image_messages(image_url))
+
+@csrf_exempt
+async def send_generated_image(request):
     """
     將生成的圖片發送給 LINE 使用者
     """
@@ -195,34 +270,113 @@ def send_generated_image(request):
         if not user_id or not image_url:
             return JsonResponse({"error": "Missing userId or imageUrl"}, status=400)
 
-        token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-        url = "https://api.line.me/v2/bot/message/push"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
-        
-        # 建構圖片訊息
-        payload = {
-            "to": user_id,
-            "messages": [
-                {
-                    "type": "image",
-                    "originalContentUrl": image_url,
-                    "previewImageUrl": image_url
-                },
-                {
-                    "type": "text",
-                    "text": "這是您剛剛生成的 AI 圖片！"
-                }
-            ]
-        }
-        
-        r = requests.post(url, headers=headers, json=payload, timeout=30)
-        r.raise_for_status()
+        messages = await sync_to_async(generated_image_messages)(image_url)
+        await get_async_line_client().push(user_id, messages)
         
         return JsonResponse({"status": "success"})
 
     except Exception as e:
         print(f"Send image failed: {e}")
         return JsonResponse({"error": str(e)}, status=500)
+
+CHAT_MAX_LENGTH = 1000
+_END = object()
+
+
+def _sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _sse_events(events, user_id: str = None):
+    try:
+        for event, data in events:
+            yield _sse(event, data)
+    except Exception as e:
+        print(f"Chat stream failed: {e}")
+        yield _sse("error", {"text": BUSY_REPLY})
+    yield _sse("done", {})
+
+    if user_id:
+        # 與 LINE 對話相同，回覆送完 (done) 之後才整理對話記憶，前端不必等濃縮摘要
+        try:
+            conversations.compact(user_id)
+        except Exception as e:
+            print(f"Conversation compaction failed: {e}")
+
+
+async def _iterate_in_thread(iterator):
+    """
+    在背景執行緒跑同步的 generator，每產生一段就交給 event loop 送出；
+    ASGI 下若直接交給 StreamingHttpResponse，Django 會先把整個 generator 讀完才送出
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def pump():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            close_old_connections()
+            loop.call_soon_threadsafe(queue.put_nowait, _END)
+
+    loop.run_in_executor(None, pump)
+    while (item := await queue.get()) is not _END:
+        yield item
+
+
+def liff_chat_stream(request):
+    """
+    LIFF 聊天的串流端點 (Server-Sent Events)：GET ?text=...&userId=...
+    Gemini 每產生一段文字就送出 token 事件，觸發工具時送出 flex 事件，最後送出 done
+    """
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+    user_text = request.GET.get("text", "").strip()[:CHAT_MAX_LENGTH]
+    if not user_text:
+        return JsonResponse({"error": "text is required"}, status=400)
+
+    user_id = request.GET.get("userId") or None
+    events = _sse_events(stream_gemini_response(user_text, user_id=user_id), user_id)
+    if isinstance(request, ASGIRequest):
+        events = _iterate_in_thread(events)
+    response = StreamingHttpResponse(events, content_type="text/event-stream; charset=utf-8")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # 避免 nginx 等反向代理緩衝
+    return response
+
+async def warm_view(request):
+    """
+    預熱 (冷啟動後由平台的 health check 或排程呼叫)：開好資料庫、LINE 與 Gemini 的連線並回傳各項耗時；
+    資料庫無法使用時回 503；設定 METRICS_TOKEN 時與 /metrics 一樣需要帶 token
+    """
+    if not _has_metrics_token(request):
+        return HttpResponse(status=401)
+    results = await warmup.awarm()
+    return JsonResponse(results, status=200 if results["db"]["ok"] else 503)
+
+def stats_view(request):
+    """
+    回傳各項計數器 (例如回覆快取的命中/未命中次數)；設定 METRICS_TOKEN 時需要帶 token
+    """
+    if not _has_metrics_token(request):
+        return HttpResponse(status=401)
+    return JsonResponse(stats.snapshot())
+
+
+def image_stats_view(request):
+    """
+    生圖監控：斷路器狀態、備援啟動時間與主模型/備援各自的耗時與成功次數；設定 METRICS_TOKEN 時需要帶 token
+    """
+    if not _has_metrics_token(request):
+        return HttpResponse(status=401)
+    return JsonResponse(ai_reply.image_monitor())
+
+
+def metrics_view(request):
+    """
+    Prometheus 格式的統計 (所有 worker 加總)：各階段耗時分布、錯誤次數、進行中數量與工具呼叫次數
+    """
+    if not _has_metrics_token(request):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,72 @@
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+
+from . import gemini
+from .ai_reply import _chat_config
+from .gemini import GEMINI_API_KEY
+from .line_api import get_async_line_client, get_line_client
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _step(results: dict, name: str, fn):
+    started = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        print(f"Warm-up {name} failed: {e}")
+        results[name] = {"ok": False, "error": str(e)}
+    else:
+        results[name] = {"ok": True, "ms": _elapsed_ms(started)}
+
+
+async def _astep(results: dict, name: str, coro_fn):
+    started = time.perf_counter()
+    try:
+        await coro_fn()
+    except Exception as e:
+        print(f"Warm-up {name} failed: {e}")
+        results[name] = {"ok": False, "error": str(e)}
+    else:
+        results[name] = {"ok": True, "ms": _elapsed_ms(started)}
+
+
+def _open_db():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+
+
+def _open_gemini():
+    # 載入 SDK、建立 client 與對話設定 (工具宣告)，再打一次 models.get 建立 TLS 連線
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY is not set")
+    _chat_config()
+    gemini.get_client().models.get(model=gemini.CHAT_MODEL)
+
+
+def warm() -> dict:
+    """
+    預先開好資料庫連線、LINE HTTP 連線與 Gemini client，回傳各項是否成功與耗時 (ms)。
+    冷啟動後第一則訊息就不必再等 SDK 載入與 TLS 握手
+    """
+    results = {}
+    _step(results, "db", _open_db)
+    _step(results, "line", lambda: get_line_client().bot_info())
+    _step(results, "gemini", _open_gemini)
+    return results
+
+
+async def awarm() -> dict:
+    """
+    warm() 再加上目前 event loop 的 async client (ASGI view 與 run_worker --async 使用)
+    """
+    results = await sync_to_async(warm)()
+    await _astep(results, "line_async", lambda: get_async_line_client().bot_info())
+    if results["gemini"]["ok"]:
+        await _astep(results, "gemini_async",
+                     lambda: gemini.get_client().aio.models.get(model=gemini.CHAT_MODEL))
+    return results
@@ -13,4 +13,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'linegemini.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from bot.line_api import mark_long_lived_loop  # noqa: E402 (Django 初始化之後才匯入 app)
+
+
+async def application(scope, receive, send):
+    # uvicorn worker 整個生命週期只有這個 event loop，讓 LINE 的 httpx 連線在請求之間重複使用
+    mark_long_lived_loop()
+    await django_application(scope, receive, send)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +43,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # 靜態檔 (admin、LIFF 資源) 由 WhiteNoise 直接回應，不經過 view
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -77,7 +80,12 @@ WSGI_APPLICATION = 'linegemini.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        # 壓力測試 (bench_load) 會指到暫存的資料庫
+        'NAME': os.getenv('DATABASE_PATH', BASE_DIR / 'db.sqlite3'),
+        # web 與 worker 會同時寫入佇列，等待鎖的時間拉長避免 "database is locked"；
+        # transaction.atomic() 一開始就取得寫入鎖 (BEGIN IMMEDIATE)，先讀後寫的交易才會排隊等鎖，
+        # 不會因為 WAL 的讀取快照過期而直接失敗
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
     }
 }
 
@@ -117,10 +125,22 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic 產生帶內容雜湊的檔名與壓縮檔，WhiteNoise 對這些檔案回傳一年期的 immutable 快取
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+# 尚未執行 collectstatic (本機開發、測試) 時退回原本的檔名
+WHITENOISE_MANIFEST_STRICT = False
 
 # Media files (User uploaded files)
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+
+# 跨 worker 共用的小型狀態檔 (版本戳記、檔案鎖等)
+BOT_STATE_DIR = os.getenv('BOT_STATE_DIR', BASE_DIR / 'var')
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
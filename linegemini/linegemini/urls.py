@@ -19,9 +19,15 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from bot.media_views import serve_generated_image
+from bot.views import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("bot/", include("bot.urls")),
+    path("metrics", metrics_view, name="metrics"),
+    # 生成圖片不論 DEBUG 與否都由專用 view 提供 (快取標頭、304、Range)
+    path("media/generated_images/<path:path>", serve_generated_image, name="generated_image"),
 ]
 
 if settings.DEBUG:
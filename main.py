@@ -1,4 +1,5 @@
 import os
+import subprocess
 import sys
 
 # 這是為了滿足 Zeabur 預設尋找 main.py 的行為
@@ -9,9 +10,17 @@ if __name__ == "__main__":
     if os.path.exists("linegemini"):
         os.chdir("linegemini")
     
+    # webhook 只負責寫入佇列，需要同時啟動背景 worker 來處理事件
+    print("Starting webhook worker from main.py...")
+    worker = subprocess.Popen([sys.executable, "manage.py", "run_worker", "--async", "--concurrency", "200"])
+    image_worker = subprocess.Popen([sys.executable, "manage.py", "run_worker", "--kind", "image", "--concurrency", "2"])
+
     print("Starting Gunicorn from main.py...")
     
     # 執行 Gunicorn
     # 注意：Zeabur 會自動分配 PORT 環境變數，但 Gunicorn 預設 8000
     # 我們這裡直接綁定 0.0.0.0:8000，Zeabur Service Port 設定也要記得設為 8000
-    os.system("gunicorn linegemini.wsgi --bind 0.0.0.0:8000 --log-file -")
+    # --preload：master 先載入 app 再 fork，worker 共用已載入的程式碼，不必各自重新 import
+    os.system("gunicorn linegemini.asgi:application -k uvicorn_worker.UvicornWorker --preload --bind 0.0.0.0:8000 --log-file -")
+    worker.terminate()
+    image_worker.terminate()